@@ -350,6 +350,64 @@ const PersonalityModal: FC<{
   );
 };
 
+const WAV_HEADER_SIZE = 44;
+
+// Plays a 16 bits mono WAV of unknown length while it downloads, each received chunk
+// being scheduled right after the previous one. Resolves once everything has played.
+const playStreamedWav = async (body: ReadableStream<Uint8Array>, onStart: () => void) => {
+  const audioContext = new AudioContext();
+  const reader = body.getReader();
+  let pending = new Uint8Array(0);
+  let sampleRate = 0;
+  let playTime = 0;
+  let lastSource: AudioBufferSourceNode | null = null;
+  try {
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      const bytes = new Uint8Array(pending.length + value.length);
+      bytes.set(pending, 0);
+      bytes.set(value, pending.length);
+      let offset = 0;
+      if (!sampleRate) {
+        if (bytes.length < WAV_HEADER_SIZE) {
+          pending = bytes;
+          continue;
+        }
+        sampleRate = new DataView(bytes.buffer).getUint32(24, true);
+        offset = WAV_HEADER_SIZE;
+      }
+      const numSamples = Math.floor((bytes.length - offset) / 2);
+      pending = bytes.slice(offset + numSamples * 2);
+      if (!numSamples) continue;
+      const samples = new DataView(bytes.buffer, offset, numSamples * 2);
+      const buffer = audioContext.createBuffer(1, numSamples, sampleRate);
+      const channel = buffer.getChannelData(0);
+      for (let i = 0; i < numSamples; i++) {
+        channel[i] = samples.getInt16(2 * i, true) / 32768;
+      }
+      const source = audioContext.createBufferSource();
+      source.buffer = buffer;
+      source.connect(audioContext.destination);
+      if (!lastSource) {
+        // A small lead absorbs the jitter between the first chunks.
+        playTime = audioContext.currentTime + 0.1;
+        onStart();
+      }
+      playTime = Math.max(playTime, audioContext.currentTime);
+      source.start(playTime);
+      playTime += buffer.duration;
+      lastSource = source;
+    }
+    if (lastSource) {
+      const source = lastSource;
+      await new Promise((resolve) => { source.onended = resolve; });
+    }
+  } finally {
+    await audioContext.close();
+  }
+};
+
 const EmbeddingModal: FC<{
   onClose: () => void;
 }> = ({ onClose }) => {
@@ -368,10 +426,26 @@ const EmbeddingModal: FC<{
       const formData = new FormData();
       formData.append("audio", inputAudio);
       formData.append("name", embeddingName.trim());
-      setStatus("Generating embedding (this may take a moment)...");
       const res = await fetch("/api/generate-embedding", { method: "POST", body: formData });
-      const data = await res.json();
-      if (res.ok) {
+      let data = await res.json();
+      if (!res.ok) {
+        setStatus(`Error: ${data.error}`);
+        return;
+      }
+      // The embedding is generated in the background, poll the job until it is done.
+      while (data.status === "queued" || data.status === "running") {
+        setStatus(data.status === "queued"
+          ? "Waiting for the embedding job to start..."
+          : `Generating embedding... ${Math.round(data.progress * 100)}%`);
+        await new Promise((resolve) => setTimeout(resolve, 500));
+        const jobRes = await fetch(`/api/generate-embedding/${data.id}`);
+        data = await jobRes.json();
+        if (!jobRes.ok) {
+          setStatus(`Error: ${data.error}`);
+          return;
+        }
+      }
+      if (data.status === "done") {
         setStatus(`Embedding created: ${data.embedding}`);
       } else {
         setStatus(`Error: ${data.error}`);
@@ -393,17 +467,14 @@ const EmbeddingModal: FC<{
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({ name: embeddingName.trim(), text: testText.trim() }),
       });
-      if (!res.ok) {
+      if (!res.ok || !res.body) {
         const data = await res.json();
         setStatus(`Error: ${data.error}`);
         return;
       }
-      const blob = await res.blob();
-      const url = URL.createObjectURL(blob);
-      const audio = new Audio(url);
-      audio.onended = () => { URL.revokeObjectURL(url); setStatus(null); };
-      audio.play();
-      setStatus("Playing test audio...");
+      // Audio is streamed as it is generated, playback starts with the first frames.
+      await playStreamedWav(res.body, () => setStatus("Playing test audio..."));
+      setStatus(null);
     } catch (e) {
       setStatus(`Error: ${e instanceof Error ? e.message : String(e)}`);
     } finally {
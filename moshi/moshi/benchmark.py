@@ -0,0 +1,188 @@
+# Copyright (c) Kyutai, all rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Micro-benchmarks of the streaming hot path, on scaled-down models with random weights.
+
+The models keep the structure of the real configs in `models.loaders` (codebooks, delays,
+context, depformer per step weights...), with smaller dimensions and fewer layers, so that
+they run on a laptop CPU without any checkpoint. Results are written as JSON, and can be
+compared against a stored baseline to measure a change to the streaming modules.
+
+Example:
+    moshi-benchmark -o after.json --baseline before.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from typing import Callable
+
+import numpy as np
+import torch
+
+from .models import loaders, LMModel, LMGen, MimiModel
+from .modules.rope import apply_rope
+from .modules.transformer import RingKVCache
+from .utils.sampling import sample_token
+
+
+# Scaled-down versions of the configs in `models.loaders`.
+_seanet_kwargs = {**loaders._seanet_kwargs, "n_filters": 8, "dimension": 64}
+_quantizer_kwargs = {**loaders._quantizer_kwargs, "dimension": 32,
+                     "input_dimension": 64, "output_dimension": 64}
+_transformer_kwargs = {**loaders._transformer_kwargs, "d_model": 64, "num_heads": 4, "num_layers": 2,
+                       "dim_feedforward": 256, "input_dimension": 64, "output_dimensions": [64]}
+_lm_kwargs = {**loaders._lm_kwargs, "dim": 256, "num_heads": 4, "num_layers": 4, "dep_q": 16,
+              "depformer_dim": 128, "depformer_dim_feedforward": int(4.125 * 128),
+              "depformer_num_heads": 4, "depformer_num_layers": 2}
+
+
+def _time(fn: Callable[[], object], warmup: int, iters: int) -> dict:
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(iters):
+        begin = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - begin)
+    ms = np.array(durations) * 1000
+    return {
+        "mean_ms": float(ms.mean()),
+        "median_ms": float(np.median(ms)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "iters": iters,
+    }
+
+
+def build_models(device: torch.device, dtype: torch.dtype) -> tuple[MimiModel, LMModel]:
+    mimi = loaders.build_mimi(device, _seanet_kwargs, _quantizer_kwargs, _transformer_kwargs)
+    mimi.set_num_codebooks(8)
+    lm = LMModel(device=device, dtype=dtype, **_lm_kwargs)
+    lm.eval()
+    return mimi, lm
+
+
+def run_benchmarks(args) -> dict:
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    B = args.batch_size
+    mimi, lm = build_models(device, dtype)
+    frame_size = int(mimi.sample_rate / mimi.frame_rate)
+    lm_gen = LMGen(lm, device=device, sample_rate=mimi.sample_rate, frame_rate=mimi.frame_rate)
+    results: dict[str, dict] = {}
+
+    def bench(name: str, fn: Callable[[], object]):
+        results[name] = _time(fn, args.warmup, args.iters)
+        print(f"{name:>24}: {results[name]['median_ms']:8.3f} ms (p90 {results[name]['p90_ms']:.3f})",
+              file=sys.stderr)
+
+    # Sampling, rope and KV cache on their own, with the shapes of the LM.
+    text_logits = torch.randn(B, 1, lm.text_card, device=device)
+    audio_logits = torch.randn(B, 1, lm.card, device=device)
+    bench("sample_token_text", lambda: sample_token(text_logits, True, 0.7, 25))
+    bench("sample_token_audio", lambda: sample_token(audio_logits, True, 0.8, 250))
+
+    heads = _lm_kwargs["num_heads"]
+    dim_per_head = _lm_kwargs["dim"] // heads
+    q = torch.randn(B, heads, 1, dim_per_head, device=device, dtype=dtype)
+    k = torch.randn(B, heads, 1, dim_per_head, device=device, dtype=dtype)
+    offset = torch.zeros(B, device=device, dtype=torch.long)
+    bench("apply_rope", lambda: apply_rope(q, k, offset))
+
+    kv_cache = RingKVCache(B, heads, dim_per_head, _lm_kwargs["context"], device=device, dtype=dtype)
+    bench("RingKVCache.complete", lambda: kv_cache.complete(k, v=k))
+
+    # Mimi, streaming one frame at a time.
+    with mimi.streaming(B):
+        pcm = torch.randn(B, 1, frame_size, device=device) * 0.1
+        bench("MimiModel.encode", lambda: mimi.encode(pcm))
+        codes = mimi.encode(pcm)
+        bench("MimiModel.decode", lambda: mimi.decode(codes))
+
+    # LMGen, moved past the initial delays first.
+    with lm_gen.streaming(B):
+        user_codes = torch.randint(0, lm.card, (B, 8, 1), device=device)
+        while lm_gen.step(user_codes) is None:
+            pass
+        bench("LMGen.step", lambda: lm_gen.step(user_codes))
+
+        embeddings = lm.embed_codes(lm._get_initial_token().expand(1, -1, -1))
+        bench("LMGen.step_embeddings", lambda: lm_gen.step_embeddings(embeddings))
+
+    text_token = torch.zeros(B, device=device, dtype=torch.long)
+    transformer_out = torch.randn(B, 1, lm.dim, device=device, dtype=dtype)
+    audio_tokens = torch.randint(0, lm.card, (B, lm.dep_q), device=device)
+    # As in a conversation: the agent tokens are sampled, the user tokens are given.
+    audio_provided = torch.zeros(B, lm.dep_q, device=device, dtype=torch.bool)
+    audio_provided[:, 8:] = True
+    bench("LMGen.depformer_step",
+          lambda: lm_gen.depformer_step(text_token, transformer_out, audio_tokens, audio_provided))
+
+    return {
+        "config": {
+            "device": str(device),
+            "dtype": args.dtype,
+            "batch_size": B,
+            "threads": torch.get_num_threads(),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Print the speedups against `baseline`, and return the benchmarks slower by more than `tolerance`."""
+    regressions = []
+    print(f"{'benchmark':>24} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:>24} {'-':>10} {result['median_ms']:10.3f}")
+            continue
+        ratio = result["median_ms"] / base["median_ms"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print(f"{name:>24} {base['median_ms']:10.3f} {result['median_ms']:10.3f} {ratio:7.2f}{flag}")
+    if report["config"] != baseline.get("config"):
+        print("warning: the baseline was measured with a different config", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", type=str, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", type=str, help="JSON results to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative slowdown of the median above which a benchmark is a regression.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--threads", type=int, help="Number of torch threads, defaults to torch's choice.")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    with torch.no_grad():
+        report = run_benchmarks(args)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
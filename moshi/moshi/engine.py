@@ -0,0 +1,779 @@
+# Copyright (c) Kyutai, all rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Batched inference engine, running concurrent chat sessions through shared Mimi/LMGen slots."""
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+import time
+from typing import Any, Callable, Iterator, Optional
+
+import numpy as np
+import torch
+
+from .metrics import ENGINE_STAGES, Metrics, SessionMetrics, StageTimer
+from .models import MimiModel, LMGen
+from .modules.streaming import StreamingStateDict
+from .utils.logging import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+class PCMRingBuffer:
+    """Fixed capacity FIFO of float32 PCM samples, read back one frame at a time.
+
+    The capacity is a multiple of `frame_size`, and frames are always read from a multiple of
+    `frame_size`, so that a frame is never split by the wrap around and can be returned as a view.
+    Once full, the oldest frames are dropped to make room for the new samples.
+
+    Args:
+        frame_size (int): number of samples per frame.
+        max_frames (int): capacity, in frames.
+    """
+    def __init__(self, frame_size: int, max_frames: int = 64):
+        self.frame_size = frame_size
+        self.capacity = frame_size * max_frames
+        self._data = np.zeros(self.capacity, dtype=np.float32)
+        self._start = 0
+        self._length = 0
+        # Total number of frames dropped because the buffer was full.
+        self.dropped = 0
+        # Index in the stream of the oldest frame, i.e. number of frames read, skipped or dropped.
+        self.position = 0
+
+    @property
+    def num_frames(self) -> int:
+        return self._length // self.frame_size
+
+    def _drop_frames(self, count: int):
+        self.dropped += self.skip_frames(count)
+
+    def write(self, pcm: np.ndarray):
+        n = pcm.shape[-1]
+        if n > self.capacity:
+            # Only the most recent samples fit.
+            self.dropped += n // self.frame_size - self.capacity // self.frame_size
+            self.position += n // self.frame_size - self.capacity // self.frame_size
+            pcm = pcm[n - self.capacity:]
+            n = self.capacity
+        excess = self._length + n - self.capacity
+        if excess > 0:
+            self._drop_frames(-(-excess // self.frame_size))
+            if self._length + n > self.capacity:
+                # Left with a partial frame, which is dropped as well.
+                self._start = self._length = 0
+        end = (self._start + self._length) % self.capacity
+        first = min(n, self.capacity - end)
+        self._data[end: end + first] = pcm[:first]
+        self._data[: n - first] = pcm[first:]
+        self._length += n
+
+    def skip_frames(self, count: int) -> int:
+        """Discard up to `count` of the oldest frames, returns how many were discarded.
+        Unlike the frames lost to a full buffer, those are not counted in `dropped`."""
+        count = min(count, self.num_frames)
+        self._start = (self._start + count * self.frame_size) % self.capacity
+        self._length -= count * self.frame_size
+        self.position += count
+        return count
+
+    def read_frame(self) -> np.ndarray:
+        """Pop the oldest frame. The returned view is only valid until the next `write`."""
+        assert self.num_frames > 0, "no frame available"
+        frame = self._data[self._start: self._start + self.frame_size]
+        self._start = (self._start + self.frame_size) % self.capacity
+        self._length -= self.frame_size
+        self.position += 1
+        return frame
+
+
+@dataclass
+class ChatSession:
+    """A conversation served by the `BatchedEngine`.
+
+    The owner of the session feeds the input PCM with `BatchedEngine.push_pcm`, and gets
+    a `(pcm, text_token, input_index)` tuple for each generated frame from `outputs`, where
+    `input_index` is the index of the input frame of that step, None if the input was late.
+    `None` is put in `outputs` if the engine drops the session.
+    """
+    voice_prompt_embeddings: Optional[torch.Tensor] = None
+    voice_prompt_cache: Optional[torch.Tensor] = None
+    text_prompt_tokens: Optional[list[int]] = None
+    temp_text: float = 0.7
+    top_k_text: int = 25
+    temp: float = 0.8
+    top_k: int = 250
+    seed: Optional[int] = None
+    # Identifies the system prompts and sampling setup, e.g. a hash of the personality file,
+    # so that the state after the system prompts can be reused. None disables the reuse.
+    prompt_key: Optional[str] = None
+    # Checked before each chunk of the system prompts, so it should not wait on any I/O.
+    is_alive: Optional[Callable[[], bool]] = None
+    slot: Optional[int] = None
+    active: bool = False
+    closed: bool = False
+    frames: Optional[PCMRingBuffer] = None
+    # Receives the stage times of the frames of the session, and its system prompts duration.
+    metrics: Optional[SessionMetrics] = None
+    outputs: asyncio.Queue = field(default_factory=asyncio.Queue)
+    ready: Optional[asyncio.Future] = None
+    # Why the engine refused or dropped the session, if it did.
+    error: Optional[str] = None
+
+
+@dataclass
+class ProfileCapture:
+    """A torch.profiler capture of the next `frames` steps of a session, see `BatchedEngine.profile`.
+
+    `done` is resolved with the paths of the Chrome trace and of the key averages table.
+    """
+    session: ChatSession
+    frames: int
+    output_prefix: Path
+    done: asyncio.Future
+    profiler: Optional[torch.profiler.profile] = None
+    captured: int = 0
+
+
+class PromptCache:
+    """LRU of the LMGen streaming states right after the system prompts.
+
+    Each entry holds a batch size 1 snapshot, with the KV caches stored up to the prompt length.
+
+    Args:
+        max_entries (int): number of snapshots kept, 0 disables the cache.
+        max_bytes (int or None): total size of the tensors of the snapshots kept, None for no limit.
+    """
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[StreamingStateDict, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[StreamingStateDict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: str, snapshot: StreamingStateDict):
+        if self.max_entries <= 0:
+            return
+        size = sum(value.numel() * value.element_size()
+                   for value in snapshot.values() if isinstance(value, torch.Tensor))
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous[1]
+        self._entries[key] = (snapshot, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+
+def _next_step(core: Iterator) -> tuple[bool, Any]:
+    try:
+        return False, next(core)
+    except StopIteration as e:
+        return True, e.value
+
+
+def _init_worker_thread():
+    # Grad mode is per thread, the server only disables it for the main thread.
+    torch.set_grad_enabled(False)
+
+
+class InferenceWorker:
+    """Dedicated thread owning the models: all the model compute is submitted to it,
+    so that the event loop serving the connections is never blocked by a forward pass."""
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="inference", initializer=_init_worker_thread)
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self._executor.submit(fn, *args)
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """Run `fn(*args)` on the worker thread, and wait for its result without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class BatchedEngine:
+    """Runs up to `batch_size` chat sessions with a single batched forward per frame.
+
+    Mimi and LMGen stream with a batch size of `batch_size`, each session owning one
+    batch entry (slot). A joining session runs its system prompts in a batch size 1 state,
+    a chunk at a time after each frame so that the other sessions keep streaming, and that state
+    is then copied into a free slot. Once every active session has an input frame (or after
+    `max_wait` seconds, the missing frames being replaced with silence), all the slots are
+    stepped together.
+
+    With `batch_size == 1`, the system prompts run directly in the batched state, so that
+    no extra state is needed and the behavior is the same as a single streaming session.
+
+    The scheduling runs on the event loop, while everything touching the models runs on
+    `worker`, so the connections are served while a frame is being computed.
+
+    Args:
+        mimi (MimiModel): Mimi, used to encode the input and decode the output of all slots.
+        lm_gen (LMGen): the LM generator, shared by all the slots.
+        batch_size (int): number of sessions that can be served concurrently.
+        device (torch.device or str): device of the models.
+        prompt_chunks_per_tick (int): number of system prompt chunks run after each frame
+            while other sessions are active, see `LMGen.prefill_chunk_size`.
+        max_wait (float or None): how long to wait for the input of the late sessions, in seconds,
+            once at least one session has a frame. Defaults to half a frame.
+        seed_fn (callable): used to seed the random generators with `ChatSession.seed`
+            when a session starts its system prompts.
+        prompt_cache_size (int): number of post system prompts states kept for sessions
+            with a `prompt_key`, restored instead of running the system prompts again.
+        prompt_cache_bytes (int or None): limit on the total size of those states, None for no limit.
+        metrics (Metrics or None): receives the stage times of each step, created if not given.
+        max_lag (float or None): input backlog of a session, in seconds, above which its oldest
+            frames are skipped so that it gets back to `target_lag`. None never skips frames.
+        target_lag (float): input backlog kept when skipping frames, in seconds.
+        max_real_time_factor (float or None): mean step time over the frame period, over the last
+            `overload_steps` steps, above which the engine is overloaded and refuses new sessions
+            instead of slowing down the active ones. None never refuses sessions.
+        overload_steps (int): number of recent steps used to detect an overload.
+        silence_bypass_frames (int or None): experimental, after that many steps where the input of
+            every slot is digital silence, the Mimi encoder is skipped and the constant codes of
+            silence are used instead, until some slot gets a non silent frame. Those only approximate
+            the codes the encoder would give, and the encoder state (conv buffers and transformer
+            context) is reset when the input resumes, so the codes that follow differ from those of
+            an encoder that ran all along. None, the default, always runs the encoder.
+    """
+    def __init__(self, mimi: MimiModel, lm_gen: LMGen, batch_size: int,
+                 device: str | torch.device, prompt_chunks_per_tick: int = 1,
+                 max_wait: Optional[float] = None,
+                 seed_fn: Callable[[int], object] = torch.manual_seed,
+                 prompt_cache_size: int = 4, prompt_cache_bytes: Optional[int] = None,
+                 metrics: Optional[Metrics] = None,
+                 max_lag: Optional[float] = 1., target_lag: float = 0.16,
+                 max_real_time_factor: Optional[float] = 1., overload_steps: int = 25,
+                 silence_bypass_frames: Optional[int] = None):
+        self.mimi = mimi
+        self.lm_gen = lm_gen
+        self.batch_size = batch_size
+        self.device = device
+        self.frame_size = int(mimi.sample_rate / mimi.frame_rate)
+        self.prompt_chunks_per_tick = prompt_chunks_per_tick
+        self.max_wait = 0.5 / mimi.frame_rate if max_wait is None else max_wait
+        self.seed_fn = seed_fn
+        self.prompt_cache = PromptCache(prompt_cache_size, prompt_cache_bytes)
+        self.worker = InferenceWorker()
+        self.metrics = Metrics(mimi.frame_rate) if metrics is None else metrics
+        self.max_lag_frames = None if max_lag is None else max(1, int(max_lag * mimi.frame_rate))
+        self.target_lag_frames = max(1, int(target_lag * mimi.frame_rate))
+        self.max_real_time_factor = max_real_time_factor
+        self.overload_steps = overload_steps
+        self.silence_bypass_frames = silence_bypass_frames
+        self._silent_steps = 0
+        # Set once the encoder was skipped, its state no longer matches the input and is reset
+        # before encoding again.
+        self._encoder_stale = False
+        self._silence_codes = lm_gen.silence_codes.expand(batch_size, -1, -1)
+        self.metrics.gauges["joining_sessions"] = lambda: len(self._joining)
+        self.metrics.gauges["prompt_cache_entries"] = lambda: len(self.prompt_cache)
+        self.metrics.gauges["overloaded"] = lambda: float(self.overloaded)
+        self._timer = StageTimer(device)
+        self.lm_gen.stage_timer = self._timer
+
+        self.mimi.streaming_forever(batch_size)
+        self.lm_gen.streaming_forever(batch_size)
+        self._batched_states = (self.mimi.get_streaming_state(), self.lm_gen.get_streaming_state())
+        # Batch size 1 states for the system prompts, only needed with more than one slot.
+        self._single_states: Optional[tuple[dict, dict]] = None
+        self._default_sampling = (lm_gen.temp_text, lm_gen.top_k_text, lm_gen.temp, lm_gen.top_k)
+        if batch_size > 1:
+            # Sampling params are kept in persistent tensors updated in place, as they are
+            # captured by the CUDA graphs.
+            self._temp_text = torch.full((batch_size,), lm_gen.temp_text, device=device)
+            self._top_k_text = torch.full((batch_size,), lm_gen.top_k_text, device=device, dtype=torch.long)
+            self._temp = torch.full((batch_size,), lm_gen.temp, device=device)
+            self._top_k = torch.full((batch_size,), lm_gen.top_k, device=device, dtype=torch.long)
+
+        self.slots: list[Optional[ChatSession]] = [None] * batch_size
+        self._joining: deque[ChatSession] = deque()
+        self._prompt: Optional[tuple[ChatSession, Iterator[None]]] = None
+        self._prompt_start = 0.
+        # Armed by `profile`, regions are only labelled for the profiler while a capture runs.
+        self._capture: Optional[ProfileCapture] = None
+        # Held while the batch size 1 states are in use, by a system prompt or by `run_single_stream`.
+        self._single_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._first_frame_time: Optional[float] = None
+        # Input frames of all the slots are gathered in a reusable (pinned when on CUDA) tensor,
+        # then copied into a persistent device tensor, so that no allocation happens per frame.
+        pin = torch.device(device).type == 'cuda'
+        self._input = torch.zeros((batch_size, 1, self.frame_size), dtype=torch.float32, pin_memory=pin)
+        self._input_np = self._input.numpy()[:, 0]
+        self._input_device = torch.zeros_like(self._input, device=device) if pin else self._input
+        self._use_batched_states()
+
+    @property
+    def num_active(self) -> int:
+        return sum(1 for session in self.slots if session is not None and session.active)
+
+    def _use_batched_states(self):
+        mimi_state, lm_state = self._batched_states
+        self.mimi.set_streaming_state(mimi_state)
+        self.lm_gen.set_streaming_state(lm_state)
+        if self.batch_size > 1:
+            self.lm_gen.temp_text = self._temp_text
+            self.lm_gen.top_k_text = self._top_k_text
+            self.lm_gen.temp = self._temp
+            self.lm_gen.top_k = self._top_k
+
+    def _use_single_states(self):
+        if self._single_states is None:
+            self.mimi.streaming_forever(1)
+            self.lm_gen.streaming_forever(1)
+            self._single_states = (self.mimi.get_streaming_state(), self.lm_gen.get_streaming_state())
+        mimi_state, lm_state = self._single_states
+        self.mimi.set_streaming_state(mimi_state)
+        self.lm_gen.set_streaming_state(lm_state)
+        (self.lm_gen.temp_text, self.lm_gen.top_k_text,
+         self.lm_gen.temp, self.lm_gen.top_k) = self._default_sampling
+
+    async def run_single_stream(self, fn: Callable, *args) -> Any:
+        """Run `fn(*args)` on the worker with batch size 1 streaming states swapped in, for a
+        one-off generation leaving the chat sessions untouched."""
+        try:
+            async with self._single_lock:
+                # With no session to preserve, the batched state is reset by the next system prompts.
+                in_place = self.batch_size == 1 and self.slots[0] is None
+                return await self.worker.run(self._run_single_stream, in_place, fn, *args)
+        finally:
+            # The sessions that joined meanwhile were left waiting for the lock.
+            self._wakeup.set()
+
+    async def run_single_stream_core(self, core: Iterator, progress: Optional[Callable[[Any], None]] = None) -> Any:
+        """Same as `run_single_stream`, but for a long running generation given as a generator.
+
+        Each step of `core` is submitted separately to the worker, so that the frames of the
+        active sessions are computed in between. The values yielded by `core` are passed
+        to `progress` on the event loop, and its return value is returned.
+        """
+        try:
+            async with self._single_lock:
+                in_place = self.batch_size == 1 and self.slots[0] is None
+                done = False
+                try:
+                    while not done:
+                        done, value = await self.worker.run(self._run_single_stream, in_place, _next_step, core)
+                        if not done and progress is not None:
+                            progress(value)
+                    return value
+                finally:
+                    if not done:
+                        await self.worker.run(core.close)
+        finally:
+            self._wakeup.set()
+
+    def _run_single_stream(self, in_place: bool, fn: Callable, *args) -> Any:
+        if in_place:
+            return fn(*args)
+        self._use_single_states()
+        try:
+            return fn(*args)
+        finally:
+            self._use_batched_states()
+
+    def warmup(self, steps: int = 4):
+        """Step all the slots with silence, which also moves the batched state past the
+        initial delays, as required to load slots into it. Blocks until done."""
+        self.worker.submit(self._warmup, steps).result()
+
+    def _warmup(self, steps: int):
+        self._input_np[:] = 0
+        for _ in range(steps):
+            self._step()
+        if torch.device(self.device).type == 'cuda':
+            torch.cuda.synchronize()
+
+    async def join(self, session: ChatSession) -> bool:
+        """Queue the session, and wait for its system prompts to be done.
+
+        Returns False if the session was dropped before being ready."""
+        session.ready = asyncio.get_running_loop().create_future()
+        if session.frames is None:
+            session.frames = PCMRingBuffer(self.frame_size)
+        self._joining.append(session)
+        if self.num_active + len(self._joining) > self.batch_size:
+            logger.info(f"all {self.batch_size} slots are busy, session waiting for a free slot")
+        self._wakeup.set()
+        return await session.ready
+
+    def leave(self, session: ChatSession):
+        """Release the slot of the session, or cancel its pending system prompts."""
+        session.closed = True
+        if session in self._joining:
+            self._joining.remove(session)
+        if session.slot is not None and self.slots[session.slot] is session and session.active:
+            self.slots[session.slot] = None
+        session.active = False
+        if session.ready is not None and not session.ready.done():
+            session.ready.set_result(False)
+        self._wakeup.set()
+
+    def push_pcm(self, session: ChatSession, pcm: np.ndarray):
+        """Feed input samples for the session, of any length. The engine steps a full frame at a time."""
+        frames = session.frames
+        dropped = frames.dropped
+        frames.write(pcm)
+        if frames.dropped > dropped:
+            logger.warning(f"input buffer full, dropped {frames.dropped - dropped} frames")
+        if frames.num_frames:
+            self._wakeup.set()
+
+    def _record(self, name: str):
+        if self._capture is not None:
+            return torch.profiler.record_function(name)
+        return nullcontext()
+
+    def _step(self, silent: bool = False) -> Optional[tuple[torch.Tensor, torch.Tensor]]:
+        if silent:
+            # Constant codes standing for silence, the encoder state is left behind.
+            codes = self._silence_codes
+            self._encoder_stale = True
+        else:
+            if self._encoder_stale:
+                # The encoder restarts without the context of the input before the bypass, this is
+                # a behaviour change from always encoding, hence the bypass being opt-in.
+                self.mimi.reset_encoder_streaming()
+                self._encoder_stale = False
+            if self._input_device is not self._input:
+                self._input_device.copy_(self._input, non_blocking=True)
+            with self._record("MimiModel.encode"):
+                codes = self.mimi.encode(self._input_device)
+        self._timer.mark("mimi_encode")
+        out = None
+        for c in range(codes.shape[-1]):
+            with self._record("LMGen.step"):
+                tokens = self.lm_gen.step(codes[:, :, c: c + 1])
+            if tokens is None:
+                continue
+            assert tokens.shape[1] == self.lm_gen.lm_model.dep_q + 1
+            with self._record("MimiModel.decode"):
+                main_pcm = self.mimi.decode(tokens[:, 1:9])
+            self._timer.mark("mimi_decode")
+            out = main_pcm.cpu(), tokens[:, 0, 0].cpu()
+        if out is None and self._input_device is not self._input:
+            # Nothing synchronized with the copy, which must be done before `_input` is refilled.
+            torch.cuda.current_stream().synchronize()
+        return out
+
+    def _timed_step(self, silent: bool = False) -> tuple[Optional[tuple[torch.Tensor, torch.Tensor]], dict[str, float]]:
+        begin = time.perf_counter()
+        self._timer.start()
+        try:
+            out = self._step(silent)
+        finally:
+            # `_step` synchronizes with the device, so the stage times are available.
+            stages = self._timer.stop()
+        stages["engine_step"] = time.perf_counter() - begin
+        return out, stages
+
+    async def profile(self, session: ChatSession, frames: int, output_prefix: str | Path) -> tuple[Path, Path]:
+        """Profile the next `frames` steps of the batch while `session` is in it, with CPU activities
+        (and CUDA ones on CUDA) and the input shapes.
+
+        Writes `<output_prefix>.trace.json`, to open in chrome://tracing or Perfetto, and
+        `<output_prefix>.txt` with the key averages. A single capture can be armed at a time.
+        Returns both paths, once written, possibly with fewer frames if the session leaves.
+        """
+        if self._capture is not None:
+            raise RuntimeError("a profiler capture is already armed")
+        done = asyncio.get_running_loop().create_future()
+        self._capture = ProfileCapture(session, frames, Path(output_prefix), done)
+        return await done
+
+    def _profiled_step(self, capture: ProfileCapture, silent: bool):
+        if capture.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.device(self.device).type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            capture.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            capture.profiler.start()
+            self.lm_gen.record_regions = True
+        with self._record(f"BatchedEngine.step#{capture.captured}"):
+            result = self._timed_step(silent)
+        capture.captured += 1
+        if capture.captured >= capture.frames:
+            self._stop_capture(capture)
+        return result
+
+    def _stop_capture(self, capture: ProfileCapture):
+        self.lm_gen.record_regions = False
+        if capture.profiler is not None:
+            capture.profiler.stop()
+
+    async def _end_capture(self, capture: ProfileCapture):
+        if capture.captured < capture.frames:
+            # Cut short, the profiler is still running.
+            await self.worker.run(self._stop_capture, capture)
+        if capture.done.done():
+            return
+        if capture.profiler is None:
+            capture.done.set_exception(RuntimeError("the session left before any frame was profiled"))
+            return
+        trace_path = capture.output_prefix.with_name(capture.output_prefix.name + ".trace.json")
+        table_path = capture.output_prefix.with_name(capture.output_prefix.name + ".txt")
+
+        def _export():
+            capture.output_prefix.parent.mkdir(parents=True, exist_ok=True)
+            capture.profiler.export_chrome_trace(str(trace_path))
+            averages = capture.profiler.key_averages(group_by_input_shape=True)
+            table_path.write_text(averages.table(sort_by="self_cpu_time_total", row_limit=100), encoding="utf-8")
+
+        try:
+            # Exporting takes a while for long captures, and touches no model.
+            await asyncio.to_thread(_export)
+        except Exception as e:
+            capture.done.set_exception(e)
+            return
+        logger.info(f"wrote the profile of {capture.captured} frames to {trace_path}")
+        capture.done.set_result((trace_path, table_path))
+
+    @property
+    def overloaded(self) -> bool:
+        """Whether the recent steps are too slow to keep up with real time, see `max_real_time_factor`."""
+        if self.max_real_time_factor is None or len(self.metrics.engine_step.recent) < self.overload_steps:
+            return False
+        return self.metrics.real_time_factor(self.overload_steps) > self.max_real_time_factor
+
+    def _skip_backlog(self):
+        # When the steps do not keep up, the input piles up and the answers come later and later.
+        # Skipping the oldest input brings the sessions back to real time, at the cost of some user audio.
+        for slot, session in enumerate(self.slots):
+            if session is None or not session.active or session.frames.num_frames <= self.max_lag_frames:
+                continue
+            skipped = session.frames.skip_frames(session.frames.num_frames - self.target_lag_frames)
+            self.metrics.count("skipped_input_frames", skipped, session.metrics)
+            logger.warning(f"slot {slot} fell {skipped + self.target_lag_frames} frames behind, "
+                           f"skipped {skipped} input frames")
+
+    async def _tick(self):
+        if self.max_lag_frames is not None:
+            self._skip_backlog()
+        input_indices: list[Optional[int]] = [None] * self.batch_size
+        for slot, session in enumerate(self.slots):
+            if session is not None and session.active and session.frames.num_frames:
+                input_indices[slot] = session.frames.position
+                self._input_np[slot] = session.frames.read_frame()
+            else:
+                self._input_np[slot] = 0
+        self._first_frame_time = None
+        silent = False
+        if self.silence_bypass_frames is not None:
+            # Checked on the host copy, so that it costs no device synchronization.
+            self._silent_steps = 0 if self._input_np.any() else self._silent_steps + 1
+            silent = self._silent_steps > self.silence_bypass_frames
+            if silent:
+                self.metrics.count("bypassed_encoder_steps")
+        capture = self._capture
+        if capture is not None and not capture.session.active:
+            self._capture = None
+            await self._end_capture(capture)
+            capture = None
+        if capture is None:
+            out, stages = await self.worker.run(self._timed_step, silent)
+        else:
+            out, stages = await self.worker.run(self._profiled_step, capture, silent)
+            if capture.captured >= capture.frames:
+                self._capture = None
+                # The export runs in the background, the sessions keep streaming.
+                asyncio.create_task(self._end_capture(capture))
+        metrics = self.metrics
+        metrics.engine_step.observe(stages["engine_step"])
+        for stage in ENGINE_STAGES:
+            if stage in stages:
+                metrics.stages[stage].observe(stages[stage])
+        if out is None:
+            return
+        main_pcm, text_tokens = out
+        # Sessions that left in the meantime are skipped.
+        for slot, session in enumerate(self.slots):
+            if session is not None and session.active:
+                if session.metrics is not None:
+                    session.metrics.frames += 1
+                    for stage in ENGINE_STAGES:
+                        if stage in stages:
+                            session.metrics.observe(stage, stages[stage])
+                session.outputs.put_nowait((main_pcm[slot, 0].numpy(), int(text_tokens[slot]), input_indices[slot]))
+
+    def _prompt_core(self, session: ChatSession) -> Iterator[None]:
+        if session.seed is not None:
+            self.seed_fn(session.seed)
+        self.mimi.reset_streaming()
+        snapshot = None
+        if session.prompt_key is not None:
+            snapshot = self.prompt_cache.get(session.prompt_key)
+        if snapshot is not None:
+            self.lm_gen.set_streaming_state_inplace(dict(snapshot))
+            logger.info("restored the system prompts state from the prompt cache")
+            return
+        self.lm_gen.reset_streaming()
+        yield from self.lm_gen.step_system_prompts_core(self.mimi)
+        if session.prompt_key is not None and self.prompt_cache.max_entries > 0:
+            self.prompt_cache.put(session.prompt_key, self.lm_gen.snapshot_streaming_state())
+
+    async def _start_prompt(self):
+        if self._prompt is not None or not self._joining or self._single_lock.locked():
+            return
+        free = [slot for slot, session in enumerate(self.slots) if session is None]
+        if not free:
+            return
+        if self.num_active and self.overloaded:
+            # Another session would slow down all the active ones, the new sessions are shed instead.
+            session = self._joining.popleft()
+            session.error = "server overloaded, try again later"
+            self.metrics.count("shed_sessions")
+            logger.warning(f"overloaded at {self.metrics.real_time_factor(self.overload_steps):.2f}x "
+                           f"real time, refusing a new session")
+            session.ready.set_result(False)
+            return
+        await self._single_lock.acquire()
+        session = self._joining.popleft()
+        session.slot = free[0]
+        self.slots[session.slot] = session
+        self._prompt = session, self._prompt_core(session)
+        self._prompt_start = time.monotonic()
+
+    async def _end_prompt(self, session: ChatSession, done: bool):
+        try:
+            if done and not session.closed:
+                await self.worker.run(self._load_slot, session)
+        finally:
+            self._prompt = None
+            self._single_lock.release()
+        if not done or session.closed:
+            if self.slots[session.slot] is session:
+                self.slots[session.slot] = None
+            if not session.ready.done():
+                session.ready.set_result(False)
+            return
+        self.metrics.observe_prompt(time.monotonic() - self._prompt_start, session.metrics)
+        session.active = True
+        session.ready.set_result(True)
+
+    def _load_slot(self, session: ChatSession):
+        slot = session.slot
+        if self.batch_size > 1:
+            _, lm_state = self._single_states
+            self.lm_gen.load_streaming_slot(lm_state, slot)
+            self.mimi.reset_streaming_slot(slot)
+            self._temp_text[slot] = session.temp_text
+            self._top_k_text[slot] = session.top_k_text
+            self._temp[slot] = session.temp
+            self._top_k[slot] = session.top_k
+        else:
+            self.mimi.reset_streaming()
+
+    async def _advance_prompt(self, chunks: Optional[int]):
+        session, core = self._prompt
+        alive = not session.closed
+        if alive and session.is_alive is not None:
+            alive = session.is_alive()
+        if not alive:
+            await self.worker.run(core.close)
+            await self._end_prompt(session, done=False)
+            return
+        if await self.worker.run(self._resume_prompt, session, core, chunks):
+            await self._end_prompt(session, done=True)
+
+    def _resume_prompt(self, session: ChatSession, core: Iterator[None], chunks: Optional[int]) -> bool:
+        """Run up to `chunks` chunks of the system prompts, returns True once they are done."""
+        if self.batch_size > 1:
+            self._use_single_states()
+        lm_gen = self.lm_gen
+        lm_gen.voice_prompt_audio = None
+        lm_gen.voice_prompt_embeddings = session.voice_prompt_embeddings
+        lm_gen.voice_prompt_cache = session.voice_prompt_cache
+        lm_gen.text_prompt_tokens = session.text_prompt_tokens
+        if self.batch_size == 1:
+            lm_gen.temp_text, lm_gen.top_k_text = session.temp_text, session.top_k_text
+            lm_gen.temp, lm_gen.top_k = session.temp, session.top_k
+        try:
+            # The core yields before each chunk, so each iteration runs the previous chunk.
+            for count, _ in enumerate(core, 1):
+                if chunks is not None and count == chunks:
+                    return False
+            return True
+        finally:
+            if self.batch_size > 1:
+                self._use_batched_states()
+
+    async def _wait(self, timeout: Optional[float]):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        """Scheduling loop, to run as a task on the event loop serving the sessions."""
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._start_prompt()
+                active = [session for session in self.slots if session is not None and session.active]
+                ready = sum(1 for session in active if session.frames.num_frames)
+                timeout = None
+                if not ready:
+                    self._first_frame_time = None
+                else:
+                    now = time.monotonic()
+                    if self._first_frame_time is None:
+                        self._first_frame_time = now
+                    timeout = self.max_wait - (now - self._first_frame_time)
+                    if ready == len(active) or timeout <= 0:
+                        await self._tick()
+                        if self._prompt is not None:
+                            await self._advance_prompt(self.prompt_chunks_per_tick)
+                        await asyncio.sleep(0)
+                        continue
+                if self._prompt is not None:
+                    # Nothing else to run, the system prompts can go in one go, or a chunk at a
+                    # time while the active sessions are waiting for their input.
+                    await self._advance_prompt(None if not active else self.prompt_chunks_per_tick)
+                    await asyncio.sleep(0)
+                    continue
+            except Exception as e:
+                logger.exception(f"batched engine failure, dropping all sessions: {e}")
+                await self._drop_all()
+                continue
+            await self._wait(timeout)
+
+    async def _drop_all(self):
+        sessions = list(self._joining) + [session for session in self.slots if session is not None]
+        if self._capture is not None:
+            capture, self._capture = self._capture, None
+            await self._end_capture(capture)
+        if self._prompt is not None:
+            self._prompt = None
+            self._single_lock.release()
+        self._joining.clear()
+        self.slots = [None] * self.batch_size
+        await self.worker.run(self._use_batched_states)
+        for session in sessions:
+            session.error = "inference engine failure"
+            session.closed = True
+            session.active = False
+            if session.ready is not None and not session.ready.done():
+                session.ready.set_result(False)
+            session.outputs.put_nowait(None)
@@ -0,0 +1,232 @@
+# Copyright (c) Kyutai, all rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Headless load generator for the `/api/chat` websocket of the server.
+
+Opens N concurrent chat sessions, streams recorded or synthetic user audio at real-time pace,
+and reports per session the time to handshake, the frame round-trip latency percentiles,
+the late and dropped frames, and the text token throughput.
+
+Each frame of agent audio is matched with the frame of user audio it answers, which the server
+gives ahead of the audio of the frame when asked with `frame_index=1`. Input frames skipped by
+the server when it falls behind are never answered, and count as dropped.
+
+Example:
+    moshi-loadtest --personality-id abc123 -n 4 --duration 60 --audio user.wav
+"""
+import argparse
+import asyncio
+from collections import deque
+from dataclasses import asdict, dataclass, field
+import json
+import time
+from typing import Optional
+
+import aiohttp
+import numpy as np
+import sphn
+
+from .client_utils import AnyPrinter, Printer, RawPrinter
+
+
+SAMPLE_RATE = 24000
+FRAME_RATE = 12.5
+FRAME_SIZE = int(SAMPLE_RATE / FRAME_RATE)
+
+
+@dataclass
+class SessionStats:
+    index: int
+    handshake: Optional[float] = None
+    frames_sent: int = 0
+    frames_received: int = 0
+    # Input frames answered by an output frame, the others were skipped or lost.
+    frames_answered: int = 0
+    late_frames: int = 0
+    text_tokens: int = 0
+    duration: float = 0.
+    error: Optional[str] = None
+    round_trips: list[float] = field(default_factory=list)
+
+    @property
+    def dropped_frames(self) -> int:
+        return self.frames_sent - self.frames_answered
+
+    def summary(self) -> dict:
+        data = asdict(self)
+        round_trips = data.pop("round_trips")
+        data["dropped_frames"] = self.dropped_frames
+        data["text_tokens_per_sec"] = self.text_tokens / self.duration if self.duration else 0.
+        data.update(_percentiles(round_trips))
+        return data
+
+
+def _percentiles(values: list[float], prefix: str = "rtt") -> dict:
+    if not values:
+        return {f"{prefix}_p50": None, f"{prefix}_p90": None, f"{prefix}_p99": None, f"{prefix}_max": None}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {f"{prefix}_p50": float(p50), f"{prefix}_p90": float(p90), f"{prefix}_p99": float(p99),
+            f"{prefix}_max": float(max(values))}
+
+
+def synthetic_audio(duration: float) -> np.ndarray:
+    """Speech-like user input: bursts of a modulated tone, separated by silences."""
+    t = np.arange(int(duration * SAMPLE_RATE)) / SAMPLE_RATE
+    tone = 0.1 * np.sin(2 * np.pi * 180 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+    talking = (t % 4.) < 2.
+    return (tone * talking).astype(np.float32)
+
+
+async def run_session(args, index: int, pcm: np.ndarray, printer: Optional[AnyPrinter]) -> SessionStats:
+    stats = SessionStats(index)
+    url = f"{args.url}/api/chat?personality_id={args.personality_id}&frame_index=1"
+    frame_period = 1 / FRAME_RATE
+    num_frames = int(args.duration * FRAME_RATE)
+    num_input_frames = max(1, pcm.shape[-1] // FRAME_SIZE)
+    if pcm.shape[-1] < FRAME_SIZE:
+        pcm = np.pad(pcm, (0, FRAME_SIZE - pcm.shape[-1]))
+    send_times: list[float] = []
+    begin = time.monotonic()
+    try:
+        async with aiohttp.ClientSession() as client, client.ws_connect(url) as ws:
+            # Everything before the handshake is the system prompts of the session.
+            message = await ws.receive()
+            if message.type != aiohttp.WSMsgType.BINARY or message.data[:1] != b"\x00":
+                raise RuntimeError(f"no handshake, got {message.type} {message.data!r}")
+            stats.handshake = time.monotonic() - begin
+            start = time.monotonic()
+            opus_writer = sphn.OpusStreamWriter(SAMPLE_RATE)
+            opus_reader = sphn.OpusStreamReader(SAMPLE_RATE)
+            received_samples = 0
+            # Input frame answered by each output frame whose audio is not complete yet.
+            input_indices: deque[int] = deque()
+
+            async def send_loop():
+                for k in range(num_frames):
+                    await asyncio.sleep(max(0., start + k * frame_period - time.monotonic()))
+                    offset = (k % num_input_frames) * FRAME_SIZE
+                    opus_writer.append_pcm(pcm[offset: offset + FRAME_SIZE])
+                    send_times.append(time.monotonic())
+                    stats.frames_sent += 1
+                    msg = opus_writer.read_bytes()
+                    if len(msg) > 0:
+                        await ws.send_bytes(b"\x01" + msg)
+                # Leaves time for the last frames to come back.
+                await asyncio.sleep(args.late_threshold)
+
+            async def recv_loop():
+                nonlocal received_samples
+                async for message in ws:
+                    if message.type != aiohttp.WSMsgType.BINARY or not message.data:
+                        break
+                    kind, payload = message.data[0], message.data[1:]
+                    if kind == 1:
+                        opus_reader.append_bytes(payload)
+                        received_samples += opus_reader.read_pcm().shape[-1]
+                        now = time.monotonic()
+                        while (stats.frames_received + 1) * FRAME_SIZE <= received_samples:
+                            index = input_indices.popleft() if input_indices else -1
+                            if 0 <= index < len(send_times):
+                                rtt = now - send_times[index]
+                                stats.round_trips.append(rtt)
+                                stats.frames_answered += 1
+                                if rtt > args.late_threshold:
+                                    stats.late_frames += 1
+                            stats.frames_received += 1
+                    elif kind == 7:
+                        input_indices.append(int(payload))
+                    elif kind == 2:
+                        stats.text_tokens += 1
+                        if printer is not None:
+                            printer.print_token(payload.decode("utf-8", errors="replace"))
+
+            receiver = asyncio.create_task(recv_loop())
+            try:
+                await send_loop()
+            finally:
+                receiver.cancel()
+                stats.duration = time.monotonic() - start
+    except Exception as e:
+        stats.error = str(e)
+        if printer is not None:
+            printer.log("error", f"session {index}: {e}")
+    return stats
+
+
+def _format(value: Optional[float], scale: float = 1000.) -> str:
+    return "-" if value is None else f"{value * scale:.0f}"
+
+
+def print_report(summaries: list[dict]):
+    header = ("session", "handshake_ms", "p50_ms", "p90_ms", "p99_ms", "late", "dropped", "tok/s", "error")
+    print(" ".join(f"{name:>12}" for name in header))
+    for s in summaries:
+        row = (s["index"], _format(s["handshake"]), _format(s["rtt_p50"]), _format(s["rtt_p90"]),
+               _format(s["rtt_p99"]), s["late_frames"], s["dropped_frames"],
+               f"{s['text_tokens_per_sec']:.1f}", s["error"] or "")
+        print(" ".join(f"{str(value):>12}" for value in row))
+
+
+async def run(args) -> dict:
+    if args.audio is not None:
+        pcm, _ = sphn.read(args.audio, sample_rate=SAMPLE_RATE)
+        pcm = pcm[0].astype(np.float32)
+    else:
+        pcm = synthetic_audio(max(args.duration, 8.))
+    # Only the first session is printed, the text of concurrent sessions would be interleaved.
+    printer: AnyPrinter = Printer() if not args.raw else RawPrinter()
+    if not args.quiet:
+        printer.print_header()
+
+    async def _delayed(index: int) -> SessionStats:
+        await asyncio.sleep(index * args.ramp)
+        return await run_session(args, index, pcm, printer if index == 0 and not args.quiet else None)
+
+    sessions = await asyncio.gather(*(_delayed(index) for index in range(args.sessions)))
+    if not args.quiet:
+        printer.log("info", "done")
+    summaries = [stats.summary() for stats in sessions]
+    all_round_trips = [rtt for stats in sessions for rtt in stats.round_trips]
+    overall = {
+        "sessions": args.sessions,
+        "failed": sum(1 for stats in sessions if stats.error is not None),
+        "late_frames": sum(stats.late_frames for stats in sessions),
+        "dropped_frames": sum(stats.dropped_frames for stats in sessions),
+        **_percentiles(all_round_trips),
+        **_percentiles([stats.handshake for stats in sessions if stats.handshake is not None], "handshake"),
+    }
+    return {"overall": overall, "sessions": summaries}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", type=str, default="ws://localhost:8998", help="Base url of the server.")
+    parser.add_argument("--personality-id", type=str, required=True, help="Personality of all the sessions.")
+    parser.add_argument("-n", "--sessions", type=int, default=1, help="Number of concurrent sessions.")
+    parser.add_argument("--duration", type=float, default=30., help="Audio streamed per session, in seconds.")
+    parser.add_argument("--audio", type=str, help="User audio to stream, looped. Synthetic audio if omitted.")
+    parser.add_argument("--ramp", type=float, default=0.,
+                        help="Delay between the start of two consecutive sessions, in seconds.")
+    parser.add_argument("--late-threshold", type=float, default=0.5,
+                        help="Round trip above which a frame is counted as late, in seconds.")
+    parser.add_argument("--json", type=str, help="Also write the report to this JSON file.")
+    parser.add_argument("--raw", action="store_true", help="Print the text of the first session without formatting.")
+    parser.add_argument("--quiet", action="store_true", help="Only print the final report.")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report["sessions"])
+    overall = report["overall"]
+    print(f"overall: {overall['failed']}/{overall['sessions']} failed, rtt p50 {_format(overall['rtt_p50'])} ms, "
+          f"p99 {_format(overall['rtt_p99'])} ms, {overall['late_frames']} late, "
+          f"{overall['dropped_frames']} dropped frames")
+    print(f"handshake: p50 {_format(overall['handshake_p50'])} ms, p90 {_format(overall['handshake_p90'])} ms, "
+          f"max {_format(overall['handshake_max'])} ms")
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
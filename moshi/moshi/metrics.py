@@ -0,0 +1,298 @@
+# Copyright (c) Kyutai, all rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Latency metrics of the chat pipeline, exported in the Prometheus text format.
+
+Each frame goes through the stages `STAGES`, from the Opus decoding of the user audio to the
+websocket send of the agent audio. The time spent in each stage is aggregated per session and
+for the whole server into `RollingHistogram`s: cumulative bucket counts for Prometheus
+histograms, plus a window of the most recent values for quantiles.
+"""
+from collections import deque
+import math
+import time
+from typing import Callable, Optional
+
+import torch
+
+
+# Stages of a frame, in pipeline order. The engine stages are shared by all the sessions of a batch.
+STAGES = ("opus_decode", "mimi_encode", "lm_main", "depformer", "mimi_decode", "opus_encode", "ws_send")
+ENGINE_STAGES = ("mimi_encode", "lm_main", "depformer", "mimi_decode")
+# Bucket upper bounds, in seconds, from 0.5 ms to the 80 ms frame period and a few frames beyond.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.04, 0.06, 0.08, 0.12, 0.16, 0.32, 0.64, 1.28)
+
+
+class RollingHistogram:
+    """Histogram with fixed buckets, which also keeps the `window` most recent values.
+
+    Args:
+        buckets (tuple of float): increasing upper bounds of the buckets, +Inf is implicit.
+        window (int): number of recent values kept for `quantile` and `recent_mean`.
+    """
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS, window: int = 512):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.recent: deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> float:
+        """Quantile `q` of the recent values, NaN when there is none."""
+        if not self.recent:
+            return math.nan
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def recent_mean(self, last: Optional[int] = None) -> float:
+        """Mean of the recent values, or of the `last` ones only. NaN when there is none."""
+        values = list(self.recent)[-last:] if last else self.recent
+        return sum(values) / len(values) if values else math.nan
+
+
+class StageTimer:
+    """Times consecutive stages of a frame, each `mark` ending the stage started by the previous one.
+
+    On CUDA, events are recorded on the current stream and only read by `stop`, which must happen
+    once the device is synchronized with the last mark, so the timing adds no synchronization.
+    Outside of `start` / `stop`, `mark` does nothing.
+
+    Args:
+        device (torch.device or str): device on which the stages run.
+    """
+    def __init__(self, device: str | torch.device):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.active = False
+        self._stages: list[str] = []
+        # Events, or perf counter values on CPU, one more than the stages.
+        self._marks: list = []
+        self._events: list = []
+
+    def _record(self):
+        if self.cuda:
+            if len(self._marks) == len(self._events):
+                self._events.append(torch.cuda.Event(enable_timing=True))
+            event = self._events[len(self._marks)]
+            event.record()
+            self._marks.append(event)
+        else:
+            self._marks.append(time.perf_counter())
+
+    def start(self):
+        self._stages.clear()
+        self._marks.clear()
+        self.active = True
+        self._record()
+
+    def mark(self, stage: str):
+        if not self.active:
+            return
+        self._stages.append(stage)
+        self._record()
+
+    def stop(self) -> dict[str, float]:
+        """Duration of each stage in seconds, summed over repeated marks."""
+        self.active = False
+        durations: dict[str, float] = {}
+        for index, stage in enumerate(self._stages):
+            begin, end = self._marks[index], self._marks[index + 1]
+            elapsed = begin.elapsed_time(end) / 1000 if self.cuda else end - begin
+            durations[stage] = durations.get(stage, 0.) + elapsed
+        return durations
+
+
+class SessionMetrics:
+    """Metrics of a single chat session, see `Metrics.open_session`."""
+    def __init__(self, session_id: str, labels: dict[str, str], window: int):
+        self.session_id = session_id
+        self.labels = {"session": session_id, **labels}
+        self.stages = {stage: RollingHistogram(window=window) for stage in STAGES}
+        self.prompt_seconds: Optional[float] = None
+        self.handshake_seconds: Optional[float] = None
+        self.frames = 0
+        self.counters: dict[str, int] = {}
+        # Queue depths and other values read when exporting, e.g. the input backlog in frames.
+        self.gauges: dict[str, Callable[[], float]] = {}
+
+    def observe(self, stage: str, seconds: float):
+        self.stages[stage].observe(seconds)
+
+
+class Metrics:
+    """Registry of the latency metrics of the server, exported by `render`.
+
+    Args:
+        frame_rate (float): frame rate of the models, for the real-time factor.
+        window (int): number of recent frames used for the quantiles and real-time factors.
+    """
+    def __init__(self, frame_rate: float, window: int = 512):
+        self.frame_period = 1 / frame_rate
+        self.window = window
+        self.stages = {stage: RollingHistogram(window=window) for stage in STAGES}
+        # Whole batched step on the inference worker, including the transfers.
+        self.engine_step = RollingHistogram(window=window)
+        self.prompt = RollingHistogram(buckets=(0.1, 0.25, 0.5, 1., 2., 4., 8., 16., 32.), window=window)
+        # From the websocket being accepted to the handshake byte, system prompts included.
+        self.handshake = RollingHistogram(buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1., 2., 4., 8., 16., 32.),
+                                          window=window)
+        self.sessions: dict[str, SessionMetrics] = {}
+        self.counters: dict[str, int] = {}
+        self.gauges: dict[str, Callable[[], float]] = {}
+
+    def open_session(self, session_id: str, **labels: str) -> SessionMetrics:
+        metrics = SessionMetrics(session_id, labels, self.window)
+        self.sessions[session_id] = metrics
+        return metrics
+
+    def close_session(self, metrics: SessionMetrics):
+        self.sessions.pop(metrics.session_id, None)
+
+    def observe(self, stage: str, seconds: float, session: Optional[SessionMetrics] = None):
+        self.stages[stage].observe(seconds)
+        if session is not None:
+            session.observe(stage, seconds)
+
+    def count(self, name: str, value: int = 1, session: Optional[SessionMetrics] = None):
+        """Increment the counter `name`, e.g. for the load shedding events."""
+        self.counters[name] = self.counters.get(name, 0) + value
+        if session is not None:
+            session.counters[name] = session.counters.get(name, 0) + value
+
+    def observe_prompt(self, seconds: float, session: Optional[SessionMetrics] = None):
+        self.prompt.observe(seconds)
+        if session is not None:
+            session.prompt_seconds = seconds
+
+    def observe_handshake(self, seconds: float, session: Optional[SessionMetrics] = None):
+        self.handshake.observe(seconds)
+        if session is not None:
+            session.handshake_seconds = seconds
+
+    def real_time_factor(self, last: Optional[int] = None) -> float:
+        """Recent mean time of a batched step over the frame period, above 1 the sessions fall behind."""
+        return self.engine_step.recent_mean(last) / self.frame_period
+
+    def session_real_time_factor(self, session: SessionMetrics) -> float:
+        """Recent mean time of a frame through all the stages over the frame period."""
+        means = [histogram.recent_mean() for histogram in session.stages.values() if histogram.recent]
+        return sum(means) / self.frame_period if means else math.nan
+
+    def render(self) -> str:
+        """All the metrics, in the Prometheus text exposition format."""
+        lines: list[str] = []
+        _header(lines, "moshi_stage_seconds", "histogram", "Time spent per frame in each stage of the chat pipeline.")
+        for stage, histogram in self.stages.items():
+            _histogram(lines, "moshi_stage_seconds", {"stage": stage}, histogram)
+        _header(lines, "moshi_stage_recent_seconds", "summary",
+                f"Quantiles of the stage times over the last {self.window} frames, "
+                "_sum and _count cover all the frames.")
+        for stage, histogram in self.stages.items():
+            _summary(lines, "moshi_stage_recent_seconds", {"stage": stage}, histogram)
+        _header(lines, "moshi_engine_step_seconds", "histogram", "Time of a batched step of the inference engine.")
+        _histogram(lines, "moshi_engine_step_seconds", {}, self.engine_step)
+        _header(lines, "moshi_real_time_factor", "gauge",
+                "Recent mean engine step time over the frame period, above 1 the sessions fall behind real time.")
+        _sample(lines, "moshi_real_time_factor", {}, self.real_time_factor())
+        _header(lines, "moshi_prompt_seconds", "histogram", "Duration of the system prompts phase of the sessions.")
+        _histogram(lines, "moshi_prompt_seconds", {}, self.prompt)
+        _header(lines, "moshi_handshake_seconds", "histogram",
+                "Time from the websocket being accepted to the handshake, system prompts included.")
+        _histogram(lines, "moshi_handshake_seconds", {}, self.handshake)
+        for name, gauge in self.gauges.items():
+            _header(lines, f"moshi_{name}", "gauge", name.replace("_", " ").capitalize() + ".")
+            _sample(lines, f"moshi_{name}", {}, gauge())
+        for name, value in self.counters.items():
+            _header(lines, f"moshi_{name}_total", "counter", name.replace("_", " ").capitalize() + ".")
+            _sample(lines, f"moshi_{name}_total", {}, value)
+
+        sessions = list(self.sessions.values())
+        _header(lines, "moshi_active_sessions", "gauge", "Number of chat sessions connected.")
+        _sample(lines, "moshi_active_sessions", {}, len(sessions))
+        if not sessions:
+            return "\n".join(lines) + "\n"
+        _header(lines, "moshi_session_stage_seconds", "summary",
+                f"Quantiles of the stage times of each session over its last {self.window} frames, "
+                "_sum and _count cover all its frames.")
+        for session in sessions:
+            for stage, histogram in session.stages.items():
+                _summary(lines, "moshi_session_stage_seconds", {**session.labels, "stage": stage}, histogram)
+        _header(lines, "moshi_session_real_time_factor", "gauge",
+                "Recent mean frame time through all the stages of the session over the frame period.")
+        for session in sessions:
+            _sample(lines, "moshi_session_real_time_factor", session.labels, self.session_real_time_factor(session))
+        _header(lines, "moshi_session_frames_total", "counter", "Frames generated for the session.")
+        for session in sessions:
+            _sample(lines, "moshi_session_frames_total", session.labels, session.frames)
+        _header(lines, "moshi_session_prompt_seconds", "gauge", "Duration of the system prompts of the session.")
+        for session in sessions:
+            if session.prompt_seconds is not None:
+                _sample(lines, "moshi_session_prompt_seconds", session.labels, session.prompt_seconds)
+        _header(lines, "moshi_session_handshake_seconds", "gauge", "Time to handshake of the session.")
+        for session in sessions:
+            if session.handshake_seconds is not None:
+                _sample(lines, "moshi_session_handshake_seconds", session.labels, session.handshake_seconds)
+        names = sorted({name for session in sessions for name in session.counters})
+        for name in names:
+            _header(lines, f"moshi_session_{name}_total", "counter", name.replace("_", " ").capitalize() + ".")
+            for session in sessions:
+                _sample(lines, f"moshi_session_{name}_total", session.labels, session.counters.get(name, 0))
+        names = sorted({name for session in sessions for name in session.gauges})
+        for name in names:
+            _header(lines, f"moshi_session_{name}", "gauge", name.replace("_", " ").capitalize() + ".")
+            for session in sessions:
+                if name in session.gauges:
+                    _sample(lines, f"moshi_session_{name}", session.labels, session.gauges[name]())
+        return "\n".join(lines) + "\n"
+
+
+def _header(lines: list[str], name: str, kind: str, help: str):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _sample(lines: list[str], name: str, labels: dict[str, str], value: float):
+    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+
+def _histogram(lines: list[str], name: str, labels: dict[str, str], histogram: RollingHistogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts):
+        cumulative += count
+        _sample(lines, f"{name}_bucket", {**labels, "le": _format_value(bound)}, cumulative)
+    _sample(lines, f"{name}_sum", labels, histogram.sum)
+    _sample(lines, f"{name}_count", labels, histogram.count)
+
+
+def _summary(lines: list[str], name: str, labels: dict[str, str], histogram: RollingHistogram):
+    # The quantiles only cover the recent values, while _sum and _count stay cumulative like
+    # those of the histograms, so that rates computed from them are still meaningful.
+    for q in (0.5, 0.9, 0.99):
+        _sample(lines, name, {**labels, "quantile": str(q)}, histogram.quantile(q))
+    _sample(lines, f"{name}_sum", labels, histogram.sum)
+    _sample(lines, f"{name}_count", labels, histogram.count)
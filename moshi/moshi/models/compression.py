@@ -98,6 +98,9 @@ class _MimiState:
     def reset(self):
         pass
 
+    def reset_slot(self, slot: int):
+        pass
+
 
 class MimiModel(CompressionModel[_MimiState]):
     """Mimi model operating on the raw waveform.
@@ -365,6 +368,18 @@ class MimiModel(CompressionModel[_MimiState]):
         emb = self._to_framerate(emb)
         return emb
 
+    def reset_encoder_streaming(self):
+        """Reset the streaming state of the encoder side only, the decoder keeps streaming.
+
+        Used when the encoder was skipped for some frames, e.g. known-constant input, and its state
+        no longer matches what was decoded."""
+        for module in (self.encoder, self.encoder_transformer, getattr(self, "downsample", None)):
+            if module is None:
+                continue
+            for child in module.modules():
+                if isinstance(child, StreamingModule) and child._streaming_state is not None:
+                    child._streaming_state.reset()
+
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         """Encode the given input tensor to quantized representation.
 
@@ -29,6 +29,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+from contextlib import nullcontext
 from dataclasses import dataclass
 from functools import partial
 from os.path import splitext
@@ -40,9 +41,11 @@ import torch
 import librosa
 
 from ..utils.sampling import sample_token
-from ..utils.compile import CUDAGraphed
+from ..metrics import StageTimer
+from ..utils.compile import CUDAGraphed, no_cuda_graph
 from ..modules.streaming import StreamingContainer, StreamingModule
 from ..modules.transformer import (
+    StreamingMultiheadAttention,
     StreamingTransformer,
     create_norm_fn,
 )
@@ -194,6 +197,101 @@ def encode_from_sphn(mimi, samples):
             break
 
 
+def load_voice_prompt_audio(filepath: str, sample_rate: int) -> np.ndarray:
+    """Load a voice prompt clip as mono audio of shape (1, T), normalized to -24 LUFS."""
+    raw_audio = load_audio(filepath, sample_rate)
+    raw_audio = normalize_audio(raw_audio, sample_rate, -24.0)
+    # Keep shape (1, T) because the encoder expects channels-first
+    if raw_audio.ndim == 1:
+        raw_audio = raw_audio[None, :]
+    return raw_audio
+
+
+def _encoder_context(mimi) -> Optional[int]:
+    """Smallest attention context of the Mimi encoder transformer, which is also the capacity
+    of its ring KV caches, or None if unbounded."""
+    contexts = [module.context for module in mimi.encoder_transformer.modules()
+                if isinstance(module, StreamingMultiheadAttention) and module.context is not None]
+    return min(contexts) if contexts else None
+
+
+def encode_voice_prompts(mimi, clips: List[np.ndarray], frame_size: int,
+                         chunk_frames: int = 64) -> List[torch.Tensor]:
+    """Encode whole voice prompt clips with Mimi, batching the clips together.
+
+    Each clip of shape (1, T) is zero padded to a whole number of frames, like `_iterate_audio`
+    does, and the batch is streamed through a dedicated Mimi streaming state up to `chunk_frames`
+    frames at a time. The streaming state of `mimi`, if any, is left untouched.
+
+    The ring KV caches of the encoder transformer hold exactly its context, so once they wrap
+    around, the last keys of a chunk would overwrite keys the first queries of the chunk still
+    attend to. Chunks are shortened so that this never happens, and past that point the frames go
+    one at a time, as in `encode_from_sphn`. The attention is then the same as frame by frame,
+    and the codes match those of `encode_from_sphn` up to floating point rounding, bit for bit
+    with `chunk_frames=1`.
+
+    Returns:
+        the codes of each clip, with shape [1, K, num_frames].
+    """
+    device = next(mimi.parameters()).device
+    lengths = [-(-clip.shape[-1] // frame_size) for clip in clips]
+    num_frames = max(lengths)
+    # Padding every clip to the same number of frames only adds frames after the end of
+    # the shorter clips, which, the model being causal, does not change their codes.
+    audio = np.zeros((len(clips), 1, num_frames * frame_size), dtype=np.float32)
+    for idx, clip in enumerate(clips):
+        audio[idx, 0, :clip.shape[-1]] = clip[0]
+    audio_t = torch.from_numpy(audio).to(device)
+    context = _encoder_context(mimi)
+    steps_per_frame = int(round(mimi.encoder_frame_rate / mimi.frame_rate))
+
+    def _encode() -> torch.Tensor:
+        codes = []
+        frame = 0
+        while frame < num_frames:
+            chunk = min(chunk_frames, num_frames - frame)
+            if context is not None and (frame + chunk) * steps_per_frame > context:
+                chunk = max(1, min(chunk, context // steps_per_frame - frame))
+            # The CUDA graphs of Mimi are captured for a given shape, this is a one-off anyway.
+            with no_cuda_graph():
+                codes.append(mimi.encode(audio_t[..., frame * frame_size: (frame + chunk) * frame_size]))
+            frame += chunk
+        return torch.cat(codes, dim=-1)
+
+    if mimi.is_streaming:
+        previous_state = mimi.get_streaming_state()
+        mimi.streaming_forever(len(clips))
+        try:
+            codes = _encode()
+        finally:
+            mimi.set_streaming_state(previous_state)
+    else:
+        with mimi.streaming(len(clips)):
+            codes = _encode()
+    return [codes[idx: idx + 1, :, :length] for idx, length in enumerate(lengths)]
+
+
+def load_voice_prompt_state(source, device: str | torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+    """Load the `(embeddings, cache)` saved for a voice prompt, from a path or a file object."""
+    state = torch.load(source, weights_only=True)
+    return state["embeddings"].to(device), state["cache"].to(device)
+
+
+def save_voice_prompt_state(path, embeddings: torch.Tensor, cache: torch.Tensor):
+    """Save the `(embeddings, cache)` of a voice prompt, to a path or a file object, to be loaded
+    with `load_voice_prompt_state`."""
+    torch.save({"embeddings": embeddings.detach().cpu(), "cache": cache}, path)
+
+
+def decode_voice_prompt_state(base64_data: str, device: str | torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+    """Same as `load_voice_prompt_state`, for base64-encoded .pt data."""
+    import base64
+    import io
+
+    pt_bytes = base64.b64decode(base64_data)
+    return load_voice_prompt_state(io.BytesIO(pt_bytes), device)
+
+
 class ScaledEmbedding(torch.nn.Embedding):
     """Boost learning rate for embeddings (with `scale`).
 
@@ -448,12 +546,20 @@ class LMModel(StreamingContainer):
         sequence: torch.Tensor,
     ) -> tuple[torch.Tensor, torch.Tensor]:
         return self.forward_embeddings(self.embed_codes(sequence))
-    
-    def forward_embeddings(self, input_t: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+
+    def forward_codes_transformer(self, sequence: torch.Tensor) -> torch.Tensor:
+        """Same as `forward_codes` without the text head, when the logits are not needed."""
+        return self.forward_transformer(self.embed_codes(sequence))
+
+    def forward_transformer(self, input_t: torch.Tensor) -> torch.Tensor:
         transformer_out = self.transformer(input_t)
         if self.out_norm:
             transformer_out = self.out_norm(transformer_out)
         assert isinstance(transformer_out, torch.Tensor)
+        return transformer_out
+    
+    def forward_embeddings(self, input_t: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        transformer_out = self.forward_transformer(input_t)
         text_logits = self.text_linear(transformer_out)
         text_logits = text_logits[:, None]
         return transformer_out, text_logits
@@ -536,15 +642,48 @@ class LMModel(StreamingContainer):
 class _LMGenState:
     cache: torch.Tensor
     provided: torch.Tensor
+    # [K, CT] CPU mirror of `provided`, True where provided for the whole batch. It tells if a step
+    # is fully forced without synchronizing with the device.
+    provided_cpu: torch.Tensor
     initial: torch.Tensor
     graphed_main: CUDAGraphed
     graphed_embeddings: CUDAGraphed
     graphed_depth: CUDAGraphed
+    graphed_forced: CUDAGraphed
+    ungenerated_token_id: int
     offset: int = 0
 
     def reset(self):
         self.offset = 0
         self.provided[:] = False
+        self.provided_cpu[:] = False
+
+    def reset_slot(self, slot: int):
+        """Clear the tokens of the entry `slot`, as if none had been generated or provided yet.
+
+        The offset is shared by the whole batch and is left as is: the entry does not go through
+        the initial steps again, so it is meant to be loaded with `load_slot` before it streams.
+        """
+        self.cache[slot].fill_(self.ungenerated_token_id)
+        self.provided[slot] = False
+        # Only True where provided for the whole batch, which no longer includes `slot`.
+        self.provided_cpu[:] = False
+
+    def load_slot(self, other: "_LMGenState", slot: int):
+        """Load the batch size 1 state `other` into the entry `slot`.
+
+        The offset is shared by the whole batch, so the circular token cache of `other` is rolled
+        to line up `other.offset` with `self.offset`. This is only valid once both are past the
+        initial steps, where the delayed codebooks are filled with the initial token.
+        """
+        CT = self.cache.shape[-1]
+        # The cache has room for max_delay + 3 steps, see `LMGen._init_streaming_state`.
+        max_delay = CT - 3
+        assert self.offset > max_delay and other.offset > max_delay, (self.offset, other.offset)
+        shift = (self.offset - other.offset) % CT
+        self.cache[slot : slot + 1].copy_(other.cache.roll(shift, dims=-1))
+        self.provided[slot : slot + 1].copy_(other.provided.roll(shift, dims=-1))
+        self.provided_cpu &= other.provided_cpu.roll(shift, dims=-1)
 
 
 @torch.no_grad()
@@ -641,6 +780,8 @@ class LMGen(StreamingModule[_LMGenState]):
         save_voice_prompt_embeddings: bool = False,
         sample_rate: int = 32000,
         frame_rate: int = FRAME_RATE_HZ,
+        prefill_chunk_size: int = 128,
+        depformer_agent_only: bool = False,
     ):
         assert not lm_model.training, "generation shouldn't be used in training mode."
         super().__init__()
@@ -653,6 +794,10 @@ class LMGen(StreamingModule[_LMGenState]):
         self.top_k_text = top_k_text
         self.text_prompt_tokens = text_prompt_tokens
         self.audio_silence_frame_cnt = audio_silence_frame_cnt
+        self.prefill_chunk_size = prefill_chunk_size
+        # Only sample the codebooks of the agent stream with the depformer, the tokens of the user stream
+        # are then those provided, or `zero_token_id` when missing. Exact as long as the user stream is given.
+        self.depformer_agent_only = depformer_agent_only
         self.voice_prompt = None
         self.zero_text_code = 3  # PAD token id in the text tokenizer
         self._frame_rate = frame_rate
@@ -662,11 +807,17 @@ class LMGen(StreamingModule[_LMGenState]):
         duration = self._frame_size / self._sample_rate
         sine = create_sinewave(duration, self._sample_rate)
         self._sine_frame = torch.tensor(sine, device=device).unsqueeze(0).unsqueeze(0)  # (1,1,T)
+        # [1, 8, 1] Mimi codes of a frame of silence and of the sine wave. They stand for the agent and
+        # user audio of the system prompts, and for known-constant input frames, without running Mimi.
+        self.silence_codes = torch.as_tensor(SILENCE_TOKENS, dtype=torch.long, device=lm_model.device).view(1, 8, 1)
+        self.sine_codes = torch.as_tensor(SINE_TOKENS, dtype=torch.long, device=lm_model.device).view(1, 8, 1)
         self.check = check
         self.report_loss = report_loss
         if report_loss:
             return_logits = True
         self.return_logits = return_logits
+        assert not (depformer_agent_only and return_logits), \
+            "Logits of the user stream are not computed with `depformer_agent_only`."
         self.max_delay = max(
             lm_model.delays
         )  # with delays, we need to generate a few more time steps.
@@ -674,9 +825,20 @@ class LMGen(StreamingModule[_LMGenState]):
             lm_model.delays, device=lm_model.device, dtype=torch.long
         )
         self.save_voice_prompt_embeddings = save_voice_prompt_embeddings
-        self.voice_prompt_audio: Optional[torch.Tensor] = None
+        self.voice_prompt_audio: Optional[np.ndarray] = None
+        # Codes of `voice_prompt_audio` when encoded ahead, see `load_voice_prompt`.
+        self.voice_prompt_codes: Optional[torch.Tensor] = None
         self.voice_prompt_cache: Optional[torch.Tensor] = None
         self.voice_prompt_embeddings: Optional[torch.Tensor] = None
+        # Marks the end of the main transformer and depformer stages of `step`, see `StageTimer`.
+        self.stage_timer: Optional[StageTimer] = None
+        # Labels the main transformer and depformer in torch.profiler traces, see `_record`.
+        self.record_regions = False
+
+    def _record(self, name: str):
+        if self.record_regions:
+            return torch.profiler.record_function(name)
+        return nullcontext()
 
     def _init_streaming_state(self, batch_size: int) -> _LMGenState:
         lm_model = self.lm_model
@@ -694,14 +856,17 @@ class LMGen(StreamingModule[_LMGenState]):
             device=lm_model.device,
             dtype=torch.bool
         )
+        provided_cpu = torch.zeros(provided.shape[1:], dtype=torch.bool)
 
         disable = lm_model.device.type != 'cuda'
         # disable = True # DEBUG
         graphed_main = CUDAGraphed(lm_model.forward_codes, disable=disable)
         graphed_embeddings = CUDAGraphed(lm_model.forward_embeddings, disable=disable)
         graphed_depth = CUDAGraphed(self.depformer_step, disable=disable)
+        graphed_forced = CUDAGraphed(lm_model.forward_codes_transformer, disable=disable)
 
-        return _LMGenState(cache, provided, initial, graphed_main, graphed_embeddings, graphed_depth)
+        return _LMGenState(cache, provided, provided_cpu, initial, graphed_main, graphed_embeddings,
+                           graphed_depth, graphed_forced, lm_model.ungenerated_token_id)
     
     @torch.no_grad()
     def prepare_step_input(self,
@@ -736,6 +901,7 @@ class LMGen(StreamingModule[_LMGenState]):
                 write_position = (state.offset + delay) % CT
                 state.cache[:, k, write_position : write_position + 1] = input_tokens[:, q_other]
                 state.provided[:, k, write_position : write_position + 1] = True
+                state.provided_cpu[k, write_position] = True
 
         if moshi_tokens is not None:
             assert moshi_tokens.dim() == 3, "Shape should be [B, K, T]."
@@ -751,11 +917,13 @@ class LMGen(StreamingModule[_LMGenState]):
                 write_position = (state.offset + delay) % CT
                 state.cache[:, k, write_position : write_position + 1] = moshi_tokens[:, q_moshi]
                 state.provided[:, k, write_position : write_position + 1] = True
+                state.provided_cpu[k, write_position] = True
 
         if text_token is not None:
             write_position = (state.offset + lm_model.delays[0]) % CT
             state.cache[:, 0, write_position] = text_token
             state.provided[:, 0, write_position] = True
+            state.provided_cpu[0, write_position] = True
 
         for k, delay in enumerate(lm_model.delays):
             # Only for the very beginning, we extend the initial token for the acoustic
@@ -763,6 +931,7 @@ class LMGen(StreamingModule[_LMGenState]):
             if state.offset <= delay:
                 state.cache[:, k, state.offset % CT] = state.initial[:, k, 0]
                 state.provided[:, k, state.offset % CT] = True
+                state.provided_cpu[k, state.offset % CT] = True
 
         ####
         # Perform inference at state.offset - 1 (model_input); forcing with tokens at state.offset (target) when provided
@@ -813,15 +982,26 @@ class LMGen(StreamingModule[_LMGenState]):
         embeddings = None
         if return_embeddings:
             embeddings = self.lm_model.embed_codes(input_)
-        transformer_out, text_logits = state.graphed_main(input_)
-        output = self.process_transformer_output(
-            transformer_out,
-            text_logits,
-            provided_,
-            target_,
-            model_input_position,
-            target_position,
-        )
+        if self._is_forced_step(target_position):
+            # Every token is provided, only the KV cache of the transformer needs to be updated.
+            with self._record("LMGen.main_transformer"):
+                state.graphed_forced(input_)
+            if self.stage_timer is not None:
+                self.stage_timer.mark("lm_main")
+            output = self._end_forced_step(model_input_position)
+        else:
+            with self._record("LMGen.main_transformer"):
+                transformer_out, text_logits = state.graphed_main(input_)
+            if self.stage_timer is not None:
+                self.stage_timer.mark("lm_main")
+            output = self.process_transformer_output(
+                transformer_out,
+                text_logits,
+                provided_,
+                target_,
+                model_input_position,
+                target_position,
+            )
         if return_embeddings:
             return output, embeddings
         return output
@@ -839,6 +1019,11 @@ class LMGen(StreamingModule[_LMGenState]):
             if prepared_inputs is not None:
                 break
         _, provided_, target_, model_input_position, target_position = prepared_inputs
+        # Voice prompt embeddings are stored for a single stream, shared by the whole batch.
+        embeddings = embeddings.expand(state.cache.shape[0], -1, -1)
+        if self._is_forced_step(target_position):
+            self.lm_model.forward_transformer(embeddings)
+            return self._end_forced_step(model_input_position)
         transformer_out, text_logits = state.graphed_embeddings(embeddings)
         return self.process_transformer_output(
             transformer_out,
@@ -849,6 +1034,101 @@ class LMGen(StreamingModule[_LMGenState]):
             target_position,
         )
 
+    def _is_forced_step(self, target_position: int) -> bool:
+        """Whether all the tokens at `target_position` are provided, for the whole batch,
+        in which case there is nothing to sample. Never the case if logits are expected."""
+        if self.return_logits or self.report_loss:
+            return False
+        return bool(self._streaming_state.provided_cpu[:, target_position].all())
+
+    def _end_forced_step(self, model_input_position: int) -> Optional[torch.Tensor]:
+        # What is left of `process_transformer_output` when nothing is sampled.
+        state = self._streaming_state
+        state.provided[:, :, model_input_position] = False
+        state.provided_cpu[:, model_input_position] = False
+        return self._collect_output()
+
+    def _collect_output(self) -> Optional[torch.Tensor]:
+        """Returns the tokens for `state.offset - max_delay`, once available, and moves to the next step."""
+        state = self._streaming_state
+        if state.offset <= self.max_delay:
+            state.offset += 1
+            return None
+
+        B = state.cache.shape[0]
+        CT = state.cache.shape[2]
+        gen_delays_cuda = self.delays_cuda[: self.lm_model.dep_q + 1]
+        index = (
+            ((state.offset - self.max_delay + gen_delays_cuda) % CT)
+            .view(1, -1, 1)
+            .expand(B, -1, 1)
+        )
+        out = state.cache.gather(dim=2, index=index)
+        state.offset += 1
+        return out
+
+    @torch.no_grad()
+    def prepare_forced_step(self,
+                            input_tokens: torch.Tensor=None,
+                            moshi_tokens: torch.Tensor=None,
+                            text_token: torch.Tensor=None,
+                            ) -> Optional[torch.Tensor]:
+        """Bookkeeping of `step` for a step where all the tokens are provided, without running the model.
+
+        As nothing is sampled, the state ends up exactly as with `step`. Returns the input tokens of the
+        transformer for that step `[B, K, 1]`, to be run later on with `prefill`, or None for the very
+        first step, which has no model input.
+        """
+        state = self._streaming_state
+        prepared_inputs = self.prepare_step_input(input_tokens, moshi_tokens, text_token)
+        if prepared_inputs is None:
+            return None
+        input_, _, _, model_input_position, _ = prepared_inputs
+        # The cache entry is recycled by the next steps, and the model only runs later on.
+        input_ = input_.clone()
+        state.provided[:, :, model_input_position] = False
+        state.provided_cpu[:, model_input_position] = False
+        state.offset += 1
+        return input_
+
+    @torch.no_grad()
+    def prefill(self, inputs: list[torch.Tensor], embeddings: bool = False) -> Iterator[int]:
+        """Run the transformer on the inputs of the last `len(inputs)` forced steps,
+        several steps at a time. Yields before each chunk of at most `prefill_chunk_size` steps,
+        the number of steps already run, as `prepare_forced_step` is done with all of them upfront.
+
+        Args:
+            inputs (list of torch.Tensor): returned by `prepare_forced_step`, in order,
+                or the matching embeddings `[B, 1, D]` if `embeddings` is True.
+            embeddings (bool): whether `inputs` are embeddings rather than tokens.
+        """
+        if not inputs:
+            return
+        state = self._streaming_state
+        if embeddings:
+            sequence = torch.cat(inputs, dim=1).expand(state.cache.shape[0], -1, -1)
+        else:
+            sequence = torch.cat(inputs, dim=2)
+        T = len(inputs)
+        # Position in the transformer KV cache of the first step, the very first step has no model input.
+        position = state.offset - 1 - T
+        capacity = self.lm_model.context
+        start = 0
+        while start < T:
+            chunk = min(T - start, self.prefill_chunk_size)
+            if capacity is not None and position + chunk > capacity:
+                # Once the ring KV cache wraps around, the keys needed by the first steps of a chunk
+                # would be overwritten by the last ones, so only the room left is used in one go.
+                chunk = max(1, min(chunk, capacity - position))
+            yield start
+            # Nothing is sampled, so the text head is skipped.
+            if embeddings:
+                self.lm_model.forward_transformer(sequence[:, start: start + chunk])
+            else:
+                self.lm_model.forward_codes_transformer(sequence[:, :, start: start + chunk])
+            start += chunk
+            position += chunk
+
     @torch.no_grad()
     def process_transformer_output(self, transformer_out, text_logits, provided_, target_, model_input_position, target_position):
         state = self._streaming_state
@@ -868,12 +1148,21 @@ class LMGen(StreamingModule[_LMGenState]):
 
         next_text_token = torch.where(provided_[:, 0, 0], target_[:, 0, 0], sampled_text_token)
 
-        if self.return_logits:
-            sampled_audio_tokens, audio_logits = state.graphed_depth(next_text_token, transformer_out, target_[:,lm_model.audio_offset:,0], provided_[:,lm_model.audio_offset:,0]) # [B, K_audio, Card_audio]
-        else:
-            sampled_audio_tokens = state.graphed_depth(next_text_token, transformer_out, target_[:,lm_model.audio_offset:,0], provided_[:,lm_model.audio_offset:,0])
+        with self._record("LMGen.depformer_step"):
+            audio_target = target_[:, lm_model.audio_offset:, 0]
+            audio_provided = provided_[:, lm_model.audio_offset:, 0]
+            if self.return_logits:
+                # [B, K_audio, Card_audio]
+                sampled_audio_tokens, audio_logits = state.graphed_depth(
+                    next_text_token, transformer_out, audio_target, audio_provided)
+            else:
+                sampled_audio_tokens = state.graphed_depth(
+                    next_text_token, transformer_out, audio_target, audio_provided)
+        if self.stage_timer is not None:
+            self.stage_timer.mark("depformer")
 
         state.provided[:, :, model_input_position] = False
+        state.provided_cpu[:, model_input_position] = False
         ####
         # Fill cache with generated tokens at state.offset (where not provided)
 
@@ -907,148 +1196,137 @@ class LMGen(StreamingModule[_LMGenState]):
         ####
         # Collect outputs for state.offset - max_delay
 
-        if state.offset <= self.max_delay:
-            state.offset += 1
-            if self.report_loss:
-                return None, report
-            if self.return_logits:
-                return None, None
-            else:
-                return None
-        
-        B = state.cache.shape[0]
-        CT = state.cache.shape[2]
-        gen_delays_cuda = self.delays_cuda[: lm_model.dep_q + 1]
-        index = (
-            ((state.offset - self.max_delay + gen_delays_cuda) % CT)
-            .view(1, -1, 1)
-            .expand(B, -1, 1)
-        )
-        out = state.cache.gather(dim=2, index=index)
-
-        state.offset += 1
+        out = self._collect_output()
         if self.report_loss:
             return out, report
-        elif self.return_logits and not self.report_loss:
+        elif self.return_logits:
+            if out is None:
+                return None, None
             return out, (text_logits.clone(), audio_logits.clone())
         else:
             return out
 
-    def load_voice_prompt(self, voice_prompt: str):
-        
+    def load_voice_prompt(self, voice_prompt: str, audio: Optional[np.ndarray] = None,
+                          codes: Optional[torch.Tensor] = None):
+        """Use the clip `voice_prompt` as voice prompt.
+
+        `audio` and `codes`, as given by `load_voice_prompt_audio` and `encode_voice_prompts`,
+        save the loading and the encoding of the clip when they were done ahead, e.g. batched
+        with other clips.
+        """
         self.voice_prompt = voice_prompt
-        raw_audio = load_audio(
-            voice_prompt, self._sample_rate,
-        )  # shape: (1, T) for mono
-  
-        # Normalize to -24 LUFS (mono-safe)        
-        raw_audio = normalize_audio(raw_audio, self._sample_rate, -24.0)
-
-        # Keep shape (1, T) because your encoder expects channels-first
-        if raw_audio.ndim == 1:
-            raw_audio = raw_audio[None, :]
-
-        self.voice_prompt_audio = raw_audio
+        if audio is None:
+            audio = load_voice_prompt_audio(voice_prompt, self._sample_rate)
+        self.voice_prompt_audio = audio
+        self.voice_prompt_codes = codes
         self.voice_prompt_cache: Optional[torch.Tensor] = None
         self.voice_prompt_embeddings: Optional[torch.Tensor] = None
 
     def load_voice_prompt_embeddings(self, path: str):
         self.voice_prompt = path
-        state = torch.load(path, weights_only=True)
-
         self.voice_prompt_audio = None
-        self.voice_prompt_embeddings = state["embeddings"].to(self.lm_model.device)
-        self.voice_prompt_cache = state["cache"].to(self.lm_model.device)
+        self.voice_prompt_embeddings, self.voice_prompt_cache = load_voice_prompt_state(
+            path, self.lm_model.device)
 
     def load_voice_prompt_embeddings_from_data(self, base64_data: str, cache_key: str = ""):
         """Load voice prompt embeddings from base64-encoded .pt data."""
-        import base64
-        import io
-
-        pt_bytes = base64.b64decode(base64_data)
-        state = torch.load(io.BytesIO(pt_bytes), weights_only=True)
-
         self.voice_prompt = cache_key
         self.voice_prompt_audio = None
-        self.voice_prompt_embeddings = state["embeddings"].to(self.lm_model.device)
-        self.voice_prompt_cache = state["cache"].to(self.lm_model.device)
+        self.voice_prompt_embeddings, self.voice_prompt_cache = decode_voice_prompt_state(
+            base64_data, self.lm_model.device)
 
     def _encode_zero_frame(self) -> torch.Tensor:
-        return torch.as_tensor(
-            SILENCE_TOKENS,
-            dtype=torch.long,
-            device=self.lm_model.device,
-        ).view(1, 8, 1)
+        return self.silence_codes
 
     def _encode_sine_frame(self) -> torch.Tensor:
-        return torch.as_tensor(
-            SINE_TOKENS,
-            dtype=torch.long,
-            device=self.lm_model.device,
-        ).view(1, 8, 1)
+        return self.sine_codes
 
     def _encode_voice_prompt_frames(self, mimi):
-        return encode_from_sphn(
-            mimi,
-            _iterate_audio(
-                self.voice_prompt_audio,
-                sample_interval_size=self._frame_size,
-                pad=True,
-            ),
-        )
+        codes = self.voice_prompt_codes
+        if codes is None:
+            (codes,) = encode_voice_prompts(mimi, [self.voice_prompt_audio], self._frame_size)
+        return codes.split(1, dim=-1)
 
-    def _step_voice_prompt_frame(self,
-                                 voice_prompt_frame_tokens: torch.Tensor,
-                                 saved_embeddings: Optional[list[torch.Tensor]]=None,
-                                 ):
+    def _prepare_voice_prompt_frame(self, voice_prompt_frame_tokens: torch.Tensor) -> Optional[torch.Tensor]:
         # Always use zero_text_code during voice prompt
-        out = self.step(
+        return self.prepare_forced_step(
             moshi_tokens=voice_prompt_frame_tokens,
             text_token=self.zero_text_code,
             input_tokens=self._encode_sine_frame(),
-            return_embeddings=self.save_voice_prompt_embeddings,
         )
-        if out is not None and self.save_voice_prompt_embeddings:
-            _, embeddings = out
-            saved_embeddings.append(embeddings)
 
     def _step_voice_prompt_core(self, mimi) -> Iterator[None]:
         """Shared core for stepping through the voice prompt.
 
         This generator yields at each *checkpoint* where the async wrapper may want to
         consult `is_alive`. The core itself is intentionally unaware of connection state.
+        All the tokens of the prompt are known, so the transformer runs on chunks of steps,
+        see `prefill`.
         """
         if self.voice_prompt_embeddings is not None:
             # Replay stored voice prompt embeddings
-            for next_embed in self.voice_prompt_embeddings:
-                yield
-                self.step_embeddings(next_embed)
+            needed_input_tokens = self.lm_model.num_codebooks - AUDIO_TOKENS_PER_STREAM - 1
+            _dummy_audio_token = self.lm_model._get_initial_token()
+            for _ in self.voice_prompt_embeddings:
+                # Same as `step_embeddings`, the very first step has no model input.
+                while self.prepare_forced_step(
+                    input_tokens=_dummy_audio_token[:, 1:1+needed_input_tokens],
+                    moshi_tokens=_dummy_audio_token[:, 1+needed_input_tokens:],
+                    text_token=self.zero_text_code,
+                ) is None:
+                    pass
+            yield from self.prefill(list(self.voice_prompt_embeddings), embeddings=True)
 
             state = self._streaming_state
             state.cache.copy_(self.voice_prompt_cache)
             return
 
         elif self.voice_prompt_audio is not None:
-            saved_embeddings = []
-            for voice_prompt_frame_tokens in self._encode_voice_prompt_frames(mimi):
-                yield
-                self._step_voice_prompt_frame(
-                    voice_prompt_frame_tokens,
-                    saved_embeddings
-                )
+            inputs = yield from self._step_voice_prompt_audio_core(mimi)
             # One last checkpoint before any optional save (nice-to-have for async disconnect)
             yield
 
             if self.save_voice_prompt_embeddings:
-                # Offset int(self._streaming_state.offset) is not needed since calling step() for len(voice_prompt_frame_tokens)
-                # and calling step_embeddings() for len(voice_prompt_embeddings) will increment offset by the same amount
-                torch.save(
-                    {
-                        "embeddings": torch.stack(saved_embeddings, dim=0).detach().cpu(),
-                        "cache": self._streaming_state.cache
-                    },
-                    splitext(self.voice_prompt)[0] + ".pt",
-                )
+                save_voice_prompt_state(
+                    splitext(self.voice_prompt)[0] + ".pt", *self._voice_prompt_state(inputs))
+
+    def _step_voice_prompt_audio_core(self, mimi) -> Iterator[int]:
+        """Steps through the frames of `voice_prompt_audio`, returns the model inputs of the steps."""
+        inputs = []
+        for voice_prompt_frame_tokens in self._encode_voice_prompt_frames(mimi):
+            input_ = self._prepare_voice_prompt_frame(voice_prompt_frame_tokens)
+            if input_ is not None:
+                inputs.append(input_)
+        yield from self.prefill(inputs)
+        return inputs
+
+    def _voice_prompt_state(self, inputs: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        embeddings = torch.stack([self.lm_model.embed_codes(input_) for input_ in inputs], dim=0)
+        # Offset int(self._streaming_state.offset) is not needed since calling step() for len(voice_prompt_frame_tokens)
+        # and calling step_embeddings() for len(voice_prompt_embeddings) will increment offset by the same amount
+        return embeddings, self._streaming_state.cache
+
+    def extract_voice_prompt_state_core(self, mimi) -> Iterator[int]:
+        """Run only the voice prompt of `voice_prompt_audio`, and return the `(embeddings, cache)`
+        to store for it, see `save_voice_prompt_state`. The streaming state should be freshly reset.
+
+        Those only depend on the voice prompt, so unlike `save_voice_prompt_embeddings`, the
+        following phases of the system prompts are not run. Yields before each chunk of steps
+        the number of voice prompt steps already run, see `prefill`.
+        """
+        assert self.voice_prompt_audio is not None, "Use `load_voice_prompt` first."
+        inputs = yield from self._step_voice_prompt_audio_core(mimi)
+        embeddings, cache = self._voice_prompt_state(inputs)
+        return embeddings.detach().cpu(), cache.clone()
+
+    def extract_voice_prompt_state(self, mimi) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Same as `extract_voice_prompt_state_core`, running all the steps at once."""
+        core = self.extract_voice_prompt_state_core(mimi)
+        while True:
+            try:
+                next(core)
+            except StopIteration as e:
+                return e.value
 
     def _step_voice_prompt(self, mimi):
         # Sync path intentionally does not support `is_alive` / disconnect checks.
@@ -1063,13 +1341,16 @@ class LMGen(StreamingModule[_LMGenState]):
     def _step_audio_silence_core(self) -> Iterator[None]:
         # For slots of silence (default 0.5s) after voice/text prompts
         # (agent text, user audio, agent audio) : (PADs, silence, sine)
+        inputs = []
         for _ in range(self.audio_silence_frame_cnt):
-            yield
-            self.step(
+            input_ = self.prepare_forced_step(
                 moshi_tokens=self._encode_zero_frame(),
                 text_token=self.zero_text_code,
                 input_tokens=self._encode_sine_frame(),
             )
+            if input_ is not None:
+                inputs.append(input_)
+        yield from self.prefill(inputs)
         logger.info('Done loading audio silence.')
 
     def _step_audio_silence(self):
@@ -1083,13 +1364,16 @@ class LMGen(StreamingModule[_LMGenState]):
                 break
 
     def _step_text_prompt_core(self) -> Iterator[None]:
-        for text_prompt_token in self.text_prompt_tokens:
-            yield
-            self.step(
+        inputs = []
+        for text_prompt_token in self.text_prompt_tokens or []:
+            input_ = self.prepare_forced_step(
                 moshi_tokens=self._encode_zero_frame(),
                 text_token=text_prompt_token,
                 input_tokens=self._encode_sine_frame(),
             )
+            if input_ is not None:
+                inputs.append(input_)
+        yield from self.prefill(inputs)
         logger.info('Done loading text prompt.')
 
 
@@ -1103,6 +1387,17 @@ class LMGen(StreamingModule[_LMGenState]):
             if is_alive is not None and not await is_alive():
                 break
 
+    def step_system_prompts_core(self, mimi) -> Iterator[Optional[int]]:
+        """Chains all the system prompt phases, yielding before each chunk of steps the progress
+        of the current phase, see `prefill`.
+
+        This lets a scheduler interleave the prompt of a new stream with other work.
+        """
+        yield from self._step_voice_prompt_core(mimi)
+        yield from self._step_audio_silence_core()
+        yield from self._step_text_prompt_core()
+        yield from self._step_audio_silence_core()
+
     async def step_system_prompts_async(self, mimi, is_alive: Optional[Callable]=None):
         await self._step_voice_prompt_async(mimi, is_alive)
         await self._step_audio_silence_async(is_alive)
@@ -1128,8 +1423,11 @@ class LMGen(StreamingModule[_LMGenState]):
         depformer_tokens: list[torch.Tensor] = []
         depformer_logits: list[torch.Tensor] = []
         assert not lm_model.depformer.is_streaming
+        num_sampled = lm_model.dep_q
+        if self.depformer_agent_only:
+            num_sampled = min(num_sampled, AUDIO_TOKENS_PER_STREAM)
         with lm_model.depformer.streaming(B):
-            for cb_index in range(lm_model.dep_q):
+            for cb_index in range(num_sampled):
                 input_ = prev_token[:, None, None]
                 logits = lm_model.forward_depformer(cb_index, input_, transformer_out)
                 if self.return_logits:
@@ -1152,6 +1450,13 @@ class LMGen(StreamingModule[_LMGenState]):
                 )
                 depformer_tokens.append(next_token)
 
+        if num_sampled < lm_model.dep_q:
+            user_tokens = torch.where(
+                audio_provided[:, num_sampled:],
+                audio_tokens[:, num_sampled:],
+                torch.full_like(audio_tokens[:, num_sampled:], lm_model.zero_token_id),
+            )
+            depformer_tokens.extend(user_tokens.unbind(dim=1))
         assert len(depformer_tokens) == lm_model.dep_q, (
             len(depformer_tokens),
             lm_model.dep_q,
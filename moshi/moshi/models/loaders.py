@@ -127,19 +127,21 @@ def _is_safetensors(path: Path | str) -> bool:
     return Path(path).suffix in (".safetensors", ".sft", ".sfts")
 
 
-def get_mimi(filename: str | Path,
-             device: torch.device | str = 'cpu') -> MimiModel:
-    """Return a pretrained Mimi model."""
-    encoder = SEANetEncoder(**_seanet_kwargs)
-    decoder = SEANetDecoder(**_seanet_kwargs)
+def build_mimi(device: torch.device | str = 'cpu',
+               seanet_kwargs: dict = _seanet_kwargs,
+               quantizer_kwargs: dict = _quantizer_kwargs,
+               transformer_kwargs: dict = _transformer_kwargs) -> MimiModel:
+    """Return a Mimi model with random weights, e.g. a scaled-down one for benchmarks."""
+    encoder = SEANetEncoder(**seanet_kwargs)
+    decoder = SEANetDecoder(**seanet_kwargs)
     encoder_transformer = transformer.ProjectedTransformer(
-        device=device, **_transformer_kwargs
+        device=device, **transformer_kwargs
     )
     decoder_transformer = transformer.ProjectedTransformer(
-        device=device, **_transformer_kwargs
+        device=device, **transformer_kwargs
     )
     quantizer = SplitResidualVectorQuantizer(
-        **_quantizer_kwargs,
+        **quantizer_kwargs,
     )
     model = MimiModel(
         encoder,
@@ -155,6 +157,13 @@ def get_mimi(filename: str | Path,
         decoder_transformer=decoder_transformer,
     ).to(device=device)
     model.eval()
+    return model
+
+
+def get_mimi(filename: str | Path,
+             device: torch.device | str = 'cpu') -> MimiModel:
+    """Return a pretrained Mimi model."""
+    model = build_mimi(device)
     if _is_safetensors(filename):
         load_model(model, filename)
     else:
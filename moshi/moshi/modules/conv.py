@@ -185,6 +185,11 @@ class _StreamingConv1dState:
     def reset(self):
         self.padding_to_add = self.original_padding_to_add
 
+    def reset_slot(self, slot: int):
+        # The padding is shared by the whole batch, once consumed the left context
+        # of the slot is reset by the underlying `RawStreamingConv1d`.
+        pass
+
 
 class StreamingConv1d(StreamingModule[_StreamingConv1dState]):
     """Conv1d with some builtin handling of asymmetric or causal padding
@@ -282,6 +287,9 @@ class _StreamingConvTr1dState:
     def reset(self):
         pass
 
+    def reset_slot(self, slot: int):
+        pass
+
 
 class StreamingConvTranspose1d(StreamingModule[_StreamingConvTr1dState]):
     """ConvTranspose1d with some builtin handling of asymmetric or causal padding
@@ -41,7 +41,8 @@ def apply_rope(
     Args:
         q (torch.Tensor): queries, shape `[B, T, H, D]`.
         k (torch.Tensor): keys, shape `[B, T, H, D]`.
-        offset (int): current offset, e.g. when streaming.
+        offset (torch.Tensor): current offset, e.g. when streaming, shape `[1]` or `[B]`
+            when each batch entry has its own offset.
         max_period (float): maximum period for the cos and sin.
         time_before_heads (bool):  if True, expected [B, T, H, D], else [B, H, T ,D]
     """
@@ -57,11 +58,11 @@ def apply_rope(
 
     ds = torch.arange(D // 2, device=q.device, dtype=torch.float32)
     freqs = torch.exp(ds * (-math.log(max_period) * 2 / D))
-    ts = offset.float() + torch.arange(T, device=q.device, dtype=torch.float32)
+    ts = offset.float().view(-1, 1) + torch.arange(T, device=q.device, dtype=torch.float32)
     if time_before_heads:
-        ts = ts.view(-1, 1, 1)
+        ts = ts.view(-1, T, 1, 1)
     else:
-        ts = ts.view(1, -1, 1)
+        ts = ts.view(-1, 1, T, 1)
 
     dims = q.shape[:-1]
     q = q.view(*dims, D // 2, 2)
@@ -48,6 +48,9 @@ class Resetable(Protocol):
     def reset(self) -> None:
         pass
 
+    def reset_slot(self, slot: int) -> None:
+        pass
+
 
 State = TypeVar("State", bound=Resetable)
 StreamingStateDict = dict[str, Union[torch.Tensor, int, float, str, bool, None]]
@@ -72,6 +75,7 @@ def is_dataclass_instance(obj):
 def _restore_streaming_state_pt(value: torch.Tensor,
                                 name: str,
                                 state_dict: dict[str, torch.Tensor],
+                                truncated: bool = False,
                                 ):
     """Restore the streaming state from the given pt_state dict
     
@@ -83,9 +87,19 @@ def _restore_streaming_state_pt(value: torch.Tensor,
         Name of the tensor in the state dict.
     state_dict: StreamingStateDict
         Flattened state dict containing the values to set.
+    truncated : bool
+        If True, only the leading entries along the time dimension (dim -2) may have been
+        saved, see `RingKVCache.asdict`, and only those are restored.
     """
     if name in state_dict:
-        value.copy_(state_dict[name].to(value.device))
+        saved = state_dict[name]
+        if truncated:
+            assert (saved.shape[:-2] == value.shape[:-2] and saved.shape[-1] == value.shape[-1]
+                    and saved.shape[-2] <= value.shape[-2]), (name, saved.shape, value.shape)
+            value = value[..., :saved.shape[-2], :]
+        else:
+            assert saved.shape == value.shape, (name, saved.shape, value.shape)
+        value.copy_(saved.to(value.device))
         state_dict.pop(name)
     else:
         raise KeyError(f"Expected to find a streaming state for {name}.")
@@ -148,7 +162,8 @@ def _restore_streaming_state_from_keys(streaming_state: State,
         full_key = f"{prefix}.{key}"
         existing_value = getattr(streaming_state, key)
         if isinstance(existing_value, torch.Tensor):
-            _restore_streaming_state_pt(existing_value, full_key, state_dict)
+            truncated = key in getattr(streaming_state, "truncated_state_keys", ())
+            _restore_streaming_state_pt(existing_value, full_key, state_dict, truncated)
         elif isinstance(existing_value, (int, float, str, bool, type(None))):
             if full_key in state_dict:
                 restored_value = state_dict[full_key]
@@ -354,6 +369,40 @@ class StreamingModule(abc.ABC, torch.nn.Module, Generic[State]):
 
         self._apply_named_streaming(_reset)
 
+    def reset_streaming_slot(self, slot: int):
+        """Reset a single batch entry of the streaming state, leaving the other entries untouched.
+
+        This is what allows a batched streaming module to have independent streams joining
+        and leaving while the other entries keep streaming.
+        """
+
+        def _reset_slot(name: str, module: StreamingModule):
+            state = module._streaming_state
+            if state is None:
+                raise ValueError(
+                    f"Trying to reset a streaming slot, but {name} wasn't streaming."
+                )
+            state.reset_slot(slot)
+
+        self._apply_named_streaming(_reset_slot)
+
+    def load_streaming_slot(self, state: dict[str, Any], slot: int):
+        """Copy a batch size 1 streaming state, as returned by `get_streaming_state`,
+        into the batch entry `slot` of the current streaming state.
+
+        Only the states of the LM streaming stack implement `load_slot`.
+        """
+        state = dict(state)
+
+        def _load_slot(name: str, module: StreamingModule):
+            if name not in state:
+                raise RuntimeError(f"Expected to find a streaming state for {name}.")
+            module._streaming_state.load_slot(state.pop(name), slot)
+
+        self._apply_named_streaming(_load_slot)
+        if state:
+            raise RuntimeError(f"Some states were not consumed: {list(state.keys())}")
+
     def get_streaming_state(self) -> dict[str, Any]:
         """Return the complete streaming state, including that of sub-modules."""
         state: dict[str, Any] = {}
@@ -390,6 +439,17 @@ class StreamingModule(abc.ABC, torch.nn.Module, Generic[State]):
         with open(metadata_save_path, "wt", encoding="utf-8") as fout:
             json.dump(state_dict_metadata, fout)
 
+    def snapshot_streaming_state(self) -> StreamingStateDict:
+        """Return a copy of the streaming state, flattened like `load_streaming_state` does,
+        that can be restored later on with `set_streaming_state_inplace(dict(snapshot))`.
+        """
+        state_dict: dict[str, torch.Tensor] = {}
+        state_dict_metadata: dict[str, Union[int, float, str, None]] = {}
+        _flatten_streaming_state(state_dict, state_dict_metadata, self.get_streaming_state(), prefix="")
+        snapshot: StreamingStateDict = {key: value.clone() for key, value in state_dict.items()}
+        snapshot.update(state_dict_metadata)
+        return snapshot
+
     def set_streaming_state_inplace(self, state: StreamingStateDict):
         """
         Set the streaming state in-place, including that of
@@ -425,6 +485,12 @@ class _NullState:
     def reset(self) -> None:
         pass
 
+    def reset_slot(self, slot: int) -> None:
+        pass
+
+    def load_slot(self, other: "_NullState", slot: int) -> None:
+        pass
+
 
 class StreamingContainer(StreamingModule[_NullState]):
     def _init_streaming_state(self, batch_size: int) -> _NullState:
@@ -440,6 +506,15 @@ class _StreamingAddState:
         self.previous_x = None
         self.previous_y = None
 
+    def reset_slot(self, slot: int):
+        # Both inputs have the same length in steady state, so those are usually empty.
+        if self.previous_x is not None:
+            self.previous_x = self.previous_x.clone()
+            self.previous_x[slot] = 0
+        if self.previous_y is not None:
+            self.previous_y = self.previous_y.clone()
+            self.previous_y[slot] = 0
+
 
 class StreamingAdd(StreamingModule[_StreamingAddState]):
     def _init_streaming_state(self, batch_size: int) -> _StreamingAddState:
@@ -468,6 +543,13 @@ class _StreamingConvState:
     def reset(self):
         self.previous = None
 
+    def reset_slot(self, slot: int):
+        # A fresh stream is left padded with zeros, which is what the slot will now see.
+        if self.previous is not None:
+            # `previous` might be a view on the last input, which we should not modify.
+            self.previous = self.previous.clone()
+            self.previous[slot] = 0
+
 
 class RawStreamingConv1d(torch.nn.Conv1d, StreamingModule[_StreamingConvState]):
     def __init__(self, *args, **kwargs):
@@ -513,11 +595,17 @@ class RawStreamingConv1d(torch.nn.Conv1d, StreamingModule[_StreamingConvState]):
 
 @dataclass
 class _StreamingConvTrState:
+    # Stored without the bias, so that zeros mean "no contribution from the past".
     partial: torch.Tensor | None = None
 
     def reset(self):
         self.partial = None
 
+    def reset_slot(self, slot: int):
+        if self.partial is not None:
+            self.partial = self.partial.clone()
+            self.partial[slot] = 0
+
 
 class RawStreamingConvTranspose1d(
     torch.nn.ConvTranspose1d, StreamingModule[_StreamingConvTrState]
@@ -555,16 +643,16 @@ class RawStreamingConvTranspose1d(
                 # of the `partial` tensor corresponds to the first time step of `out` as anything
                 # coming before the first time step of `out` would have been already flushed.
                 PT = partial.shape[-1]
-                if self.bias is not None:
-                    out[..., :PT] += partial - self.bias[:, None]
-                else:
-                    out[..., :PT] += partial
+                out[..., :PT] += partial
             # The input is T, the output is S * (T - 1) + K.
             # The offset of the left of the next frame will be S * T
             # so everything between 0 and S * T is ready to be output, and we need
             # to keep in the internal state everything beyond that, i.e. S (T - 1) + K - S T = K - S
             invalid_steps = kernel - stride
             partial = out[..., OT - invalid_steps :]
+            if self.bias is not None:
+                # The bias is already included in the next output frames.
+                partial = partial - self.bias[:, None]
             out = out[..., : OT - invalid_steps]
             self._streaming_state.partial = partial
             return out
@@ -232,6 +232,9 @@ class KVCacheResult(tp.NamedTuple):
 class RingKVCache:
     """Efficient streaming KVCache to be compatible with Cuda Graph.
 
+    Each batch entry keeps its own end offset, so that entries of the batch can be
+    reset or loaded independently (see `reset_slot` and `load_slot`).
+
     Args:
         batch_size (int): Batch size.
         num_heads (int): Number of heads in the attention.
@@ -239,6 +242,8 @@ class RingKVCache:
         device (torch.device): Device on which to initialize the cache.
         dtype (torch.dtype): dtype to use for the cache.
     """
+    # Saved by `asdict` up to the last written entry along the time dimension only.
+    truncated_state_keys = ("cache",)
 
     def __init__(
         self,
@@ -255,29 +260,40 @@ class RingKVCache:
             device=device,
             dtype=dtype,
         )
-        self.end_offset = torch.zeros(1, device=device, dtype=torch.long)
+        self.end_offset = torch.zeros(batch_size, device=device, dtype=torch.long)
 
     def reset(self):
         self.end_offset.zero_()
 
+    def reset_slot(self, slot: int):
+        self.end_offset[slot] = 0
+
+    def load_slot(self, other: "RingKVCache", slot: int):
+        assert other.capacity == self.capacity, (other.capacity, self.capacity)
+        self.cache[:, slot : slot + 1].copy_(other.cache)
+        self.end_offset[slot : slot + 1].copy_(other.end_offset)
+
     def complete(self, k: torch.Tensor, v: torch.Tensor) -> KVCacheResult:
         assert k.shape[:-1] == v.shape[:-1], (k.shape, v.shape)
         B, H, T, D = k.shape
-        indexes = torch.arange(T, device=self.end_offset.device, dtype=self.end_offset.dtype) + self.end_offset
-        indexes = indexes % self.capacity
-        self.cache[0].index_copy_(2, indexes, k)
-        self.cache[1].index_copy_(2, indexes, v)
+        indexes = torch.arange(T, device=self.end_offset.device, dtype=self.end_offset.dtype)
+        indexes = (indexes + self.end_offset.view(-1, 1)) % self.capacity
+        # indexes is [B, T], we write each batch entry at its own position.
+        indexes = indexes.view(B, 1, T, 1).expand(-1, H, -1, D)
+        self.cache[0].scatter_(2, indexes, k)
+        self.cache[1].scatter_(2, indexes, v)
         self.end_offset.add_(T)
 
         keys = self.cache[0]
         values = self.cache[1]
+        end_offset = self.end_offset.view(-1, 1)
 
         indexes = torch.arange(
             self.capacity, device=self.end_offset.device, dtype=torch.long
         )
-        invalid = indexes >= self.end_offset
+        invalid = indexes >= end_offset
 
-        end_index = self.end_offset % self.capacity
+        end_index = end_offset % self.capacity
         delta = indexes - end_index
 
         # If last key is for step S, and capacity is C, last key was written at index S % C.
@@ -291,15 +307,19 @@ class RingKVCache:
 
         positions = torch.where(
             delta <= 0,
-            self.end_offset + delta,
-            self.end_offset + delta - self.capacity,
+            end_offset + delta,
+            end_offset + delta - self.capacity,
         )
         positions = torch.where(invalid, torch.full_like(positions, -1), positions)
 
+        # positions is [B, capacity].
         return KVCacheResult(keys, values, positions)
 
     def asdict(self):
-        return {"cache": self.cache, "end_offset": self.end_offset}
+        # Entries past the end offset of every batch entry were never written, so they are left out
+        # when saving the state. Restoring the end offset keeps them masked.
+        used = min(int(self.end_offset.max().item()), self.capacity)
+        return {"cache": self.cache[..., :used, :], "end_offset": self.end_offset}
 
 
 @dataclass
@@ -313,6 +333,16 @@ class _MHAState:
         self.offset.zero_()
         self.offset_cpu = 0
 
+    def reset_slot(self, slot: int):
+        self.kv_cache.reset_slot(slot)
+        self.offset[slot] = 0
+
+    def load_slot(self, other: "_MHAState", slot: int):
+        # `offset_cpu` is shared by the batch, and only used with `weights_per_step`,
+        # which never streams with more than one slot.
+        self.kv_cache.load_slot(other.kv_cache, slot)
+        self.offset[slot : slot + 1].copy_(other.offset)
+
 
 class StreamingMultiheadAttention(StreamingModule[_MHAState]):
     """Similar to `nn.MultiheadAttention` but with support for streaming, causal evaluation.
@@ -386,7 +416,7 @@ class StreamingMultiheadAttention(StreamingModule[_MHAState]):
         )
         return _MHAState(
             kv_cache,
-            offset=torch.zeros(1, device=device, dtype=torch.long),
+            offset=torch.zeros(batch_size, device=device, dtype=torch.long),
             offset_cpu=0,
         )
 
@@ -424,10 +454,11 @@ class StreamingMultiheadAttention(StreamingModule[_MHAState]):
 
         k, v, pos_k = self._complete_kv(k, v)
         if self.causal:
-            pos_k = pos_k.view(1, -1)
-            pos_q = offset + torch.arange(T, device=q.device, dtype=torch.long).view(
-                -1, 1
-            )
+            # Positions are per batch entry, giving an attention bias of shape [B, 1, T, S].
+            pos_k = pos_k.view(-1, 1, 1, pos_k.shape[-1])
+            pos_q = offset.view(-1, 1, 1, 1) + torch.arange(
+                T, device=q.device, dtype=torch.long
+            ).view(-1, 1)
             delta = pos_q - pos_k
             attn_bias = (pos_k >= 0) & (delta >= 0)
             if self.context is not None:
@@ -454,6 +485,12 @@ class _LayerState:
     def reset(self):
         self.offset_cpu = 0
 
+    def reset_slot(self, slot: int):
+        pass
+
+    def load_slot(self, other: "_LayerState", slot: int):
+        pass
+
 
 class StreamingTransformerLayer(StreamingModule[_LayerState]):
     """TransformerLayer with Streaming / Causal support.
@@ -623,6 +660,12 @@ class _TransformerState:
     def reset(self):
         self.offset.zero_()
 
+    def reset_slot(self, slot: int):
+        self.offset[slot] = 0
+
+    def load_slot(self, other: "_TransformerState", slot: int):
+        self.offset[slot : slot + 1].copy_(other.offset)
+
 
 class StreamingTransformer(StreamingModule[_TransformerState]):
     """Transformer with Streaming / Causal support.
@@ -693,7 +736,7 @@ class StreamingTransformer(StreamingModule[_TransformerState]):
 
     def _init_streaming_state(self, batch_size: int) -> _TransformerState:
         device = next(self.parameters()).device
-        return _TransformerState(offset=torch.zeros(1, device=device, dtype=torch.long))
+        return _TransformerState(offset=torch.zeros(batch_size, device=device, dtype=torch.long))
 
     def forward(self, x: torch.Tensor, *args, **kwargs):
         B, T, C = x.shape
@@ -0,0 +1,162 @@
+# Copyright (c) Kyutai, all rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Offline rendering: runs a personality against recorded user audio, file to file.
+
+All the input files are streamed together through the slots of a `BatchedEngine`, with no
+real-time pacing, and for each of them the agent audio and transcript are written to disk.
+
+Example:
+    moshi-offline --personality Personalities/Jane_abc123.json user1.wav user2.wav -o renders
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+from pathlib import Path
+import time
+
+from huggingface_hub import hf_hub_download
+import numpy as np
+import sentencepiece
+import sphn
+import torch
+
+from .engine import BatchedEngine, ChatSession
+from .models import loaders, LMGen
+from .models.lm import load_audio
+from .personality import EmbeddingCache, EmbeddingStore, personality_session, text_prompt_tokens
+from .utils.logging import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+async def _render_session(engine: BatchedEngine, session: ChatSession,
+                          pcm: np.ndarray) -> tuple[np.ndarray, list[int]]:
+    """Stream `pcm` through the session a frame at a time, returns the agent audio and text tokens."""
+    if not await engine.join(session):
+        raise RuntimeError("session dropped by the inference engine")
+    frame_size = engine.frame_size
+    num_frames = -(-pcm.shape[-1] // frame_size)
+    padded = np.zeros(num_frames * frame_size, dtype=np.float32)
+    padded[:pcm.shape[-1]] = pcm
+    out_pcm = []
+    text_tokens = []
+    try:
+        for offset in range(0, padded.shape[-1], frame_size):
+            # A single frame is in flight per session, so that all the sessions step in lockstep.
+            engine.push_pcm(session, padded[offset: offset + frame_size])
+            out = await session.outputs.get()
+            if out is None:
+                raise RuntimeError("session dropped by the inference engine")
+            main_pcm, text_token, _ = out
+            out_pcm.append(main_pcm)
+            text_tokens.append(text_token)
+    finally:
+        engine.leave(session)
+    return np.concatenate(out_pcm, axis=-1), text_tokens
+
+
+async def render(engine: BatchedEngine, sessions: list[ChatSession],
+                 inputs: list[np.ndarray]) -> list[tuple[np.ndarray, list[int]]]:
+    """Render all the sessions, each fed with its input PCM, `engine.batch_size` at a time."""
+    engine_task = asyncio.create_task(engine.run())
+    try:
+        return await asyncio.gather(
+            *(_render_session(engine, session, pcm) for session, pcm in zip(sessions, inputs)))
+    finally:
+        engine_task.cancel()
+
+
+def _tokens_to_text(text_tokenizer: sentencepiece.SentencePieceProcessor, text_tokens: list[int]) -> str:
+    # 0 = EPAD (end-of-padding), 3 = PAD — skip non-content tokens
+    pieces = [text_tokenizer.id_to_piece(token) for token in text_tokens if token not in (0, 3)]  # type: ignore
+    return "".join(pieces).replace("▁", " ").strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", nargs="+", type=str, help="User audio files, one conversation each.")
+    parser.add_argument("--personality", type=str, required=True, help="Path to a personality JSON file.")
+    parser.add_argument("-o", "--output-dir", type=str, default="offline_renders",
+                        help="Directory receiving <input>.wav and <input>.txt for each input.")
+
+    parser.add_argument("--tokenizer", type=str, help="Path to a local tokenizer file.")
+    parser.add_argument("--moshi-weight", type=str, help="Path to a local checkpoint file for Moshi.")
+    parser.add_argument("--mimi-weight", type=str, help="Path to a local checkpoint file for Mimi.")
+    parser.add_argument("--hf-repo", type=str, default=loaders.DEFAULT_REPO,
+                        help="HF repo to look into, defaults PersonaPlex. "
+                             "Use this to select a different pre-trained model.")
+    parser.add_argument("--device", type=str, default="cuda", help="Device on which to run, defaults to 'cuda'.")
+    parser.add_argument("--batch-size", type=int,
+                        help="Number of inputs rendered together, defaults to the number of inputs.")
+    parser.add_argument("--cpu-offload", action="store_true",
+                        help="Offload LM model layers to CPU when GPU memory is insufficient. "
+                             "Requires 'accelerate' package.")
+
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    batch_size = args.batch_size or len(args.inputs)
+
+    mimi_weight = args.mimi_weight or hf_hub_download(args.hf_repo, loaders.MIMI_NAME)
+    moshi_weight = args.moshi_weight or hf_hub_download(args.hf_repo, loaders.MOSHI_NAME)
+    tokenizer = args.tokenizer or hf_hub_download(args.hf_repo, loaders.TEXT_TOKENIZER_NAME)
+
+    logger.info(f"loading mimi from {mimi_weight}")
+    mimi = loaders.get_mimi(mimi_weight, device)
+    text_tokenizer = sentencepiece.SentencePieceProcessor(tokenizer)  # type: ignore
+    logger.info(f"loading moshi from {moshi_weight}")
+    lm = loaders.get_moshi_lm(moshi_weight, device=device, cpu_offload=args.cpu_offload)
+    lm.eval()
+    lm_gen = LMGen(lm,
+                   audio_silence_frame_cnt=int(0.5 * mimi.frame_rate),
+                   sample_rate=mimi.sample_rate,
+                   device=device,
+                   frame_rate=mimi.frame_rate,
+                   depformer_agent_only=True,
+    )
+    # Frames are fed as fast as they are generated, the engine should never step a partial batch
+    # because some session is late, and there is no real time to keep up with.
+    engine = BatchedEngine(mimi, lm_gen, batch_size, device, max_wait=1.,
+                           max_lag=None, max_real_time_factor=None)
+    engine.warmup()
+
+    personality_bytes = Path(args.personality).read_bytes()
+    personality_data = json.loads(personality_bytes.decode("utf-8"))
+    # All the inputs share the same system prompts, which only run once thanks to the prompt cache.
+    prompt_key = hashlib.sha256(personality_bytes).hexdigest()
+    # The embedding store lives next to the personality files, as laid out by the server.
+    embedding_store = EmbeddingStore(Path(args.personality).parent / "EmbeddingStore")
+    # Decoded once, then shared by all the sessions.
+    embedding_cache = EmbeddingCache(1 << 30)
+    text_tokens = text_prompt_tokens(personality_data, text_tokenizer)
+    sessions = [personality_session(personality_data, text_tokenizer, device, prompt_key=prompt_key,
+                                    embedding_store=embedding_store, embedding_cache=embedding_cache,
+                                    text_tokens=text_tokens)
+                for _ in args.inputs]
+    inputs = [load_audio(path, mimi.sample_rate)[0] for path in args.inputs]
+
+    begin = time.time()
+    results = asyncio.run(render(engine, sessions, inputs))
+    elapsed = time.time() - begin
+    engine.worker.shutdown()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    duration = 0.
+    for path, (pcm, text_tokens) in zip(args.inputs, results):
+        stem = Path(path).stem
+        sphn.write_wav(str(output_dir / f"{stem}.wav"), pcm, mimi.sample_rate)
+        (output_dir / f"{stem}.txt").write_text(_tokens_to_text(text_tokenizer, text_tokens) + "\n",
+                                                 encoding="utf-8")
+        duration += pcm.shape[-1] / mimi.sample_rate
+        logger.info(f"rendered {path} to {output_dir / stem}.wav")
+    logger.info(f"rendered {duration:.1f}s of audio in {elapsed:.1f}s, "
+                f"{duration / max(elapsed, 1e-6):.1f}x real time")
+
+
+if __name__ == "__main__":
+    with torch.no_grad():
+        main()
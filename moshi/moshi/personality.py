@@ -0,0 +1,432 @@
+# Copyright (c) Kyutai, all rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Personality files, as saved by the web UI, and the chat sessions they configure.
+
+The voice embedding of a personality is kept out of its JSON, in an `EmbeddingStore`, and
+referenced by its hash in `embeddingHash`. Older files inline it as base64 in `embeddingData`,
+they are still loaded and are moved to the store by `migrate_personality_file`.
+
+Decoded voice embeddings are kept on the model device by an `EmbeddingCache`, and shared by
+all the sessions using the same voice. `PersonalityIndex` keeps the parsed files in memory by id,
+so that listing and looking up personalities does not touch the files that did not change.
+"""
+import base64
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from functools import partial
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Callable, Optional
+
+import safetensors.torch
+import sentencepiece
+import torch
+
+from .engine import ChatSession
+from .models.lm import decode_voice_prompt_state
+from .utils.logging import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+def write_atomic(path: Path, data: bytes):
+    """Write `data` aside then rename it to `path`, so that a reader never sees a partial file."""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+class EmbeddingStore:
+    """Content-addressed store of voice prompt states, one `<sha256>.safetensors` file each.
+
+    Files are only ever written once, under the hash of their content, so they can be shared
+    by any number of personalities, and loading memory maps them instead of parsing them.
+
+    Args:
+        root (Path or str): directory of the store, created if missing.
+    """
+    def __init__(self, root: Path | str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, digest: str) -> Path:
+        return self.root / f"{digest}.safetensors"
+
+    def __contains__(self, digest: str) -> bool:
+        return self.path(digest).exists()
+
+    def put(self, embeddings: torch.Tensor, cache: torch.Tensor) -> str:
+        """Store the `(embeddings, cache)` of a voice prompt, returns their hash."""
+        data = safetensors.torch.save({
+            "embeddings": embeddings.detach().cpu().contiguous(),
+            "cache": cache.detach().cpu().contiguous(),
+        })
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not path.exists():
+            write_atomic(path, data)
+        return digest
+
+    def put_pt(self, source) -> str:
+        """Store a voice prompt state saved as a .pt by `save_voice_prompt_state`, from a path or a file object."""
+        state = torch.load(source, weights_only=True, map_location="cpu")
+        return self.put(state["embeddings"], state["cache"])
+
+    def load(self, digest: str, device: str | torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+        """Load the `(embeddings, cache)` stored under `digest`, see `load_voice_prompt_state`."""
+        tensors = safetensors.torch.load_file(self.path(digest), device=str(device))
+        return tensors["embeddings"], tensors["cache"]
+
+
+VoicePromptState = tuple[torch.Tensor, torch.Tensor]
+
+
+class EmbeddingCache:
+    """LRU of decoded voice prompt states `(embeddings, cache)` on the model device, with a budget in bytes.
+
+    The tensors are only read by the system prompts, so the sessions of all the personalities
+    with the same voice share a single copy. Can be used from any thread; two sessions missing
+    the same key at once may both load it, only one copy is kept.
+
+    Args:
+        max_bytes (int): total size of the tensors kept, 0 disables the cache.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[VoicePromptState, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key: str, load: Callable[[], VoicePromptState]) -> VoicePromptState:
+        """The state cached under the content hash `key`, or loaded by `load` and cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+        # Loading reads a file, the other keys stay available meanwhile.
+        state = load()
+        size = sum(t.numel() * t.element_size() for t in state)
+        if size > self.max_bytes:
+            return state
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._entries[key] = (state, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+        return state
+
+
+def migrate_personality_file(path: Path, store: EmbeddingStore) -> bool:
+    """Move the inline `embeddingData` of a personality file to `store`, returns True if the file changed."""
+    data = json.loads(path.read_text(encoding="utf-8"))
+    embedding_data_b64 = data.pop("embeddingData", None)
+    if embedding_data_b64 is None:
+        return False
+    if embedding_data_b64:
+        data["embeddingHash"] = store.put_pt(io.BytesIO(base64.b64decode(embedding_data_b64)))
+    write_atomic(path, json.dumps(data, indent=2).encode("utf-8"))
+    return True
+
+
+def personality_filename(name: str, pid: str) -> str:
+    """Build a filename like 'MyPersonality_abc123.json' from name + id."""
+    safe_name = "".join(c if c.isalnum() or c in (" ", "-", "_") else "" for c in name).strip().replace(" ", "_")
+    return f"{safe_name}_{pid}.json" if safe_name else f"{pid}.json"
+
+
+# Fields of a personality file kept by `PersonalityIndex`: those edited by the web UI, and the
+# reference to the voice embedding. Anything else stays in the file only.
+PERSONALITY_FIELDS = ("id", "name", "avatar", "shortDescription", "description", "additionalText",
+                      "embedding", "embeddingHash", "textTemperature", "textTopk", "audioTemperature",
+                      "audioTopk", "seed")
+
+
+@dataclass
+class PersonalityEntry:
+    """A personality file, as indexed by `PersonalityIndex`."""
+    id: str
+    path: Path
+    # Identify the version of the file that was parsed.
+    mtime_ns: int
+    size: int
+    # Hash of the file content, which all the system prompts depend on.
+    sha256: str
+    # The `PERSONALITY_FIELDS` of the file.
+    metadata: dict
+    # Tokens of the text prompt, see `text_prompt_tokens`, once the index has a tokenizer.
+    text_prompt_tokens: Optional[list[int]] = None
+
+    def copy(self) -> "PersonalityEntry":
+        tokens = None if self.text_prompt_tokens is None else list(self.text_prompt_tokens)
+        return replace(self, metadata=dict(self.metadata), text_prompt_tokens=tokens)
+
+
+class PersonalityIndex:
+    """In-memory index of the personality files of a directory, by personality id.
+
+    Files are only parsed again when their mtime or size changes: `get` checks the file of the
+    entry, and `list` rescans the directory when its mtime changed, i.e. when a file was added,
+    removed or replaced. The writes of `save` and `delete` update the index directly. Files with
+    a legacy inline embedding are moved to `store` when indexed. Once `set_text_tokenizer` is
+    called, the text prompt of each file is also tokenized when indexed.
+
+    The public methods can be called from any thread, and return copies that the caller may modify.
+
+    Args:
+        directory (Path): the personalities directory, created if missing.
+        store (EmbeddingStore): store receiving the inline embeddings of the legacy files.
+    """
+    def __init__(self, directory: Path, store: EmbeddingStore):
+        self.directory = directory
+        self.store = store
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._entries: dict[str, PersonalityEntry] = {}
+        self._ids_by_name: dict[str, str] = {}
+        # Directory mtime as of the last scan.
+        self._dir_mtime_ns: Optional[int] = None
+        self.text_tokenizer: Optional[sentencepiece.SentencePieceProcessor] = None
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def set_text_tokenizer(self, text_tokenizer: sentencepiece.SentencePieceProcessor):
+        """Tokenize the text prompts of all the entries, and of the files indexed from now on."""
+        with self._lock:
+            self.text_tokenizer = text_tokenizer
+            for entry in self._entries.values():
+                entry.text_prompt_tokens = text_prompt_tokens(entry.metadata, text_tokenizer)
+
+    def _entry(self, pid: str, path: Path, stat: os.stat_result, content: bytes, data: dict) -> PersonalityEntry:
+        metadata = {key: data[key] for key in PERSONALITY_FIELDS if key in data}
+        if "embeddingData" in data:
+            # Legacy inline embedding that could not be moved to the store, still needed by the sessions.
+            metadata["embeddingData"] = data["embeddingData"]
+        tokens = text_prompt_tokens(metadata, self.text_tokenizer) if self.text_tokenizer is not None else None
+        return PersonalityEntry(pid, path, stat.st_mtime_ns, stat.st_size, hashlib.sha256(content).hexdigest(),
+                                metadata, tokens)
+
+    def _load(self, path: Path, stat: os.stat_result) -> Optional[PersonalityEntry]:
+        try:
+            content = path.read_bytes()
+            data = json.loads(content.decode("utf-8"))
+        except Exception as e:
+            logger.warning(f"Failed to read personality {path}: {e}")
+            return None
+        if "embeddingData" in data:
+            try:
+                if migrate_personality_file(path, self.store):
+                    logger.info(f"moved the inline embedding of {path.name} to {self.store.root}")
+                    stat = path.stat()
+                    content = path.read_bytes()
+                    data = json.loads(content.decode("utf-8"))
+            except Exception as e:
+                # The file is only replaced once the embedding is stored, so it is still indexed as is.
+                logger.warning(f"Failed to move the inline embedding of {path.name} to the store: {e}")
+        # Old format without name prefix, or without id in the file.
+        pid = data.get("id") or path.stem.rsplit("_", 1)[-1]
+        return self._entry(pid, path, stat, content, data)
+
+    def _add(self, entry: PersonalityEntry):
+        previous = self._entries.get(entry.id)
+        if previous is not None and previous.path != entry.path:
+            self._ids_by_name.pop(previous.path.name, None)
+        self._entries[entry.id] = entry
+        self._ids_by_name[entry.path.name] = entry.id
+
+    def _remove(self, pid: str):
+        entry = self._entries.pop(pid, None)
+        if entry is not None:
+            self._ids_by_name.pop(entry.path.name, None)
+
+    def _dir_changed(self) -> bool:
+        return self.directory.stat().st_mtime_ns != self._dir_mtime_ns
+
+    def _own_write(self, dir_mtime_ns: int):
+        # After a write of the index itself, the new directory mtime needs no rescan, unless
+        # something else changed the directory since the last scan.
+        if dir_mtime_ns == self._dir_mtime_ns:
+            self._dir_mtime_ns = self.directory.stat().st_mtime_ns
+
+    def refresh(self):
+        """Bring the index up to date with the directory, only parsing the new and modified files."""
+        with self._lock:
+            # Read first, so that a change during the scan triggers another one.
+            self._dir_mtime_ns = self.directory.stat().st_mtime_ns
+            seen = set()
+            with os.scandir(self.directory) as it:
+                for dir_entry in it:
+                    if not dir_entry.name.endswith(".json") or not dir_entry.is_file():
+                        continue
+                    seen.add(dir_entry.name)
+                    stat = dir_entry.stat()
+                    pid = self._ids_by_name.get(dir_entry.name)
+                    entry = self._entries.get(pid) if pid is not None else None
+                    if entry is not None and (entry.mtime_ns, entry.size) == (stat.st_mtime_ns, stat.st_size):
+                        continue
+                    if pid is not None:
+                        self._remove(pid)
+                    entry = self._load(Path(dir_entry.path), stat)
+                    if entry is not None:
+                        self._add(entry)
+            for name in set(self._ids_by_name) - seen:
+                self._remove(self._ids_by_name[name])
+
+    def _get(self, pid: str) -> Optional[PersonalityEntry]:
+        entry = self._entries.get(pid)
+        if entry is None:
+            # Maybe a file added by hand since the last scan.
+            if self._dir_changed():
+                self.refresh()
+            return self._entries.get(pid)
+        try:
+            stat = entry.path.stat()
+        except FileNotFoundError:
+            self.refresh()
+            return self._entries.get(pid)
+        if (entry.mtime_ns, entry.size) != (stat.st_mtime_ns, stat.st_size):
+            updated = self._load(entry.path, stat)
+            self._remove(pid)
+            if updated is None:
+                return None
+            self._add(updated)
+            return updated if updated.id == pid else None
+        return entry
+
+    def get(self, pid: str) -> Optional[PersonalityEntry]:
+        """The up to date entry of the personality `pid`, or None if there is no such personality."""
+        with self._lock:
+            entry = self._get(pid)
+            return None if entry is None else entry.copy()
+
+    def list(self) -> list[dict]:
+        """The metadata of the personalities, by filename, as given to the web UI."""
+        with self._lock:
+            if self._dir_changed():
+                self.refresh()
+            entries = sorted(self._entries.values(), key=lambda entry: entry.path.name)
+            return [{key: value for key, value in entry.metadata.items() if key != "embeddingData"}
+                    for entry in entries]
+
+    def save(self, data: dict) -> PersonalityEntry:
+        """Write the personality `data`, named after its name and id, replacing any previous file."""
+        with self._lock:
+            pid = data["id"]
+            path = self.directory / personality_filename(data.get("name", ""), pid)
+            content = json.dumps(data, indent=2).encode("utf-8")
+            dir_mtime_ns = self.directory.stat().st_mtime_ns
+            write_atomic(path, content)
+            previous = self._entries.get(pid)
+            if previous is not None and previous.path != path:
+                previous.path.unlink(missing_ok=True)
+            entry = self._entry(pid, path, path.stat(), content, data)
+            self._add(entry)
+            self._own_write(dir_mtime_ns)
+            return entry.copy()
+
+    def delete(self, pid: str) -> bool:
+        """Delete the file of the personality `pid`, returns False if there is no such personality."""
+        with self._lock:
+            entry = self._get(pid)
+            if entry is None:
+                return False
+            dir_mtime_ns = self.directory.stat().st_mtime_ns
+            entry.path.unlink(missing_ok=True)
+            self._remove(pid)
+            self._own_write(dir_mtime_ns)
+            return True
+
+
+def wrap_with_system_tags(text: str) -> str:
+    """Add system tags as the model expects if they are missing.
+    Example:
+        "<system> You enjoy having a good conversation. Have a deep conversation about technology.
+        Your name is Jane. <system>"
+    """
+    cleaned = text.strip()
+    if cleaned.startswith("<system>") and cleaned.endswith("<system>"):
+        return cleaned
+    return f"<system> {cleaned} <system>"
+
+
+def text_prompt_tokens(data: dict, text_tokenizer: sentencepiece.SentencePieceProcessor) -> Optional[list[int]]:
+    """Tokens of the text prompt of the personality `data`, its description then its additional text."""
+    text_prompt = data.get("description", "")
+    additional_text = data.get("additionalText", "")
+    if not text_prompt:
+        return None
+    tokens = text_tokenizer.encode(wrap_with_system_tags(text_prompt))
+    if additional_text:
+        tokens = tokens + text_tokenizer.encode(additional_text)
+    return tokens
+
+
+def personality_session(data: dict, text_tokenizer: sentencepiece.SentencePieceProcessor,
+                        device: str | torch.device, prompt_key: Optional[str] = None,
+                        embedding_store: Optional[EmbeddingStore] = None,
+                        embedding_cache: Optional[EmbeddingCache] = None,
+                        text_tokens: Optional[list[int]] = None) -> ChatSession:
+    """Build the `ChatSession` configured by the personality `data`: voice embedding,
+    text prompt, sampling params and seed.
+
+    Args:
+        data (dict): the parsed personality JSON.
+        text_tokenizer (SentencePieceProcessor): tokenizer of the text prompt.
+        device (torch.device or str): device of the model, for the voice embedding.
+        prompt_key (str or None): see `ChatSession.prompt_key`.
+        embedding_store (EmbeddingStore or None): store holding the voice embedding of `embeddingHash`.
+        embedding_cache (EmbeddingCache or None): cache of the decoded voice embeddings.
+        text_tokens (list of int or None): tokens of the text prompt if already known,
+            e.g. `PersonalityEntry.text_prompt_tokens`, otherwise they are computed.
+    """
+    session = ChatSession(prompt_key=prompt_key)
+
+    # Voice embedding: load from the embedding store, or from the legacy inline embeddingData
+    embedding_hash = data.get("embeddingHash", "")
+    embedding_data_b64 = data.get("embeddingData", "")
+    key = None
+    if embedding_hash and embedding_store is not None:
+        key = embedding_hash
+        load = partial(embedding_store.load, embedding_hash, device)
+    elif embedding_data_b64:
+        key = hashlib.sha256(embedding_data_b64.encode("ascii")).hexdigest()
+        load = partial(decode_voice_prompt_state, embedding_data_b64, device)
+    if key is not None:
+        state = embedding_cache.get(key, load) if embedding_cache is not None else load()
+        session.voice_prompt_embeddings, session.voice_prompt_cache = state
+
+    # Text prompt
+    if text_tokens is None:
+        text_tokens = text_prompt_tokens(data, text_tokenizer)
+    session.text_prompt_tokens = text_tokens
+
+    # Sampling params
+    session.temp_text = float(data.get("textTemperature", 0.7))
+    session.top_k_text = max(1, int(data.get("textTopk", 25)))
+    session.temp = float(data.get("audioTemperature", 0.8))
+    session.top_k = max(1, int(data.get("audioTopk", 250)))
+
+    # Seed
+    seed_value = data.get("seed", -1)
+    seed = int(seed_value) if seed_value is not None else None
+    if seed is not None and seed != -1:
+        session.seed = seed
+    return session
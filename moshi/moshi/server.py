@@ -26,7 +26,11 @@
 
 import argparse
 import asyncio
-import base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import partial
+import io
 import json
 import os
 from pathlib import Path
@@ -34,7 +38,8 @@ import random
 import tarfile
 import secrets
 import sys
-from typing import Literal, Optional
+import time
+from typing import Any, Callable, Iterator, Literal, Optional
 
 import aiohttp
 from aiohttp import web
@@ -47,9 +52,23 @@ from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
+from .engine import BatchedEngine, ChatSession
 from .models import loaders, MimiModel, LMModel, LMGen
+from .models.lm import (
+    encode_voice_prompts,
+    load_voice_prompt_audio,
+    save_voice_prompt_state,
+)
+from .personality import (
+    EmbeddingCache,
+    EmbeddingStore,
+    PersonalityIndex,
+    personality_session,
+    wrap_with_system_tags,
+    write_atomic,
+)
 from .utils.connection import create_ssl_context, get_lan_ip
-from .utils.logging import setup_logger, ColorizedLog
+from .utils.logging import setup_logger, ColorizedLog, random_id
 from .voice_discovery import VoiceDiscovery
 
 
@@ -67,6 +86,24 @@ def torch_auto_device(requested: Optional[DeviceString] = None) -> torch.device:
     return torch.device("cpu")
 
 
+# Bounded pool running the file reads and writes of the handlers, so that a large personality
+# or upload never blocks the event loop serving the audio of the live sessions.
+_file_io = ThreadPoolExecutor(max_workers=4, thread_name_prefix="file-io")
+
+
+async def run_file_io(fn: Callable, *args) -> Any:
+    """Run `fn(*args)` on the file I/O pool, and wait for its result without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_file_io, fn, *args)
+
+
+def _save_embedding(audio_path: str, pt_path: str, embeddings: torch.Tensor, cache: torch.Tensor):
+    """Write the .pt of a generated voice prompt state, then remove its temporary .wav."""
+    buffer = io.BytesIO()
+    save_voice_prompt_state(buffer, embeddings, cache)
+    write_atomic(Path(pt_path), buffer.getvalue())
+    Path(audio_path).unlink(missing_ok=True)
+
+
 def seed_all(seed):
     torch.manual_seed(seed)
     if torch.cuda.is_available():
@@ -78,24 +115,48 @@ def seed_all(seed):
     torch.backends.cudnn.benchmark = False
 
 
-def wrap_with_system_tags(text: str) -> str:
-    """Add system tags as the model expects if they are missing.
-    Example: "<system> You enjoy having a good conversation. Have a deep conversation about technology. Your name is Jane. <system>"
-    """
-    cleaned = text.strip()
-    if cleaned.startswith("<system>") and cleaned.endswith("<system>"):
-        return cleaned
-    return f"<system> {cleaned} <system>"
+@dataclass
+class EmbeddingJob:
+    """Voice embedding generation queued by `/api/generate-embedding`."""
+    id: str
+    name: str
+    audio_path: str
+    status: Literal["queued", "running", "done", "error"] = "queued"
+    progress: float = 0.
+    embedding: Optional[str] = None
+    error: Optional[str] = None
+
+    def to_json(self) -> dict:
+        data = asdict(self)
+        data.pop("audio_path")
+        return data
 
 
 class ServerState:
+    # Number of finished embedding jobs whose status is kept around.
+    max_finished_jobs = 32
+
     def __init__(self, mimi: MimiModel, text_tokenizer: sentencepiece.SentencePieceProcessor,
                  lm: LMModel, device: str | torch.device, voice_prompt_dir: str | None = None,
-                 save_voice_prompt_embeddings: bool = False):
+                 save_voice_prompt_embeddings: bool = False, batch_size: int = 1,
+                 prompt_cache_size: int = 4, prompt_cache_bytes: int | None = None,
+                 profile_dir: str | None = None,
+                 max_lag: float | None = 1., max_real_time_factor: float | None = 1.,
+                 silence_bypass_frames: int | None = None,
+                 embedding_store: EmbeddingStore | None = None,
+                 personality_index: PersonalityIndex | None = None,
+                 embedding_cache_size: int = 256 << 20):
         self.mimi = mimi
         self.text_tokenizer = text_tokenizer
         self.device = device
         self.voice_prompt_dir = voice_prompt_dir
+        self.embedding_store = embedding_store
+        if personality_index is None:
+            personality_index = PersonalityIndex(Path.cwd() / "Personalities", embedding_store)
+        personality_index.set_text_tokenizer(text_tokenizer)
+        self.personality_index = personality_index
+        # Decoded voice embeddings on device, shared by the sessions using the same voice.
+        self.embedding_cache = EmbeddingCache(embedding_cache_size)
         self.frame_size = int(self.mimi.sample_rate / self.mimi.frame_rate)
         self.save_voice_prompt_embeddings = save_voice_prompt_embeddings
         self.lm = lm
@@ -105,83 +166,76 @@ class ServerState:
                             device=device,
                             frame_rate=self.mimi.frame_rate,
                             save_voice_prompt_embeddings=save_voice_prompt_embeddings,
+                            # Only the agent stream is decoded, and the user stream is always given.
+                            depformer_agent_only=True,
         )
-        
-        self.lock = asyncio.Lock()
-        self.mimi.streaming_forever(1)
-        self.lm_gen.streaming_forever(1)
+        # All the chat sessions share the models through the slots of the batched engine.
+        self.engine = BatchedEngine(self.mimi, self.lm_gen, batch_size, device, seed_fn=seed_all,
+                                    prompt_cache_size=prompt_cache_size,
+                                    prompt_cache_bytes=prompt_cache_bytes, max_lag=max_lag,
+                                    max_real_time_factor=max_real_time_factor,
+                                    silence_bypass_frames=silence_bypass_frames)
+        # Text prompt of the embedding tests without text.
+        self.default_prompt_tokens = text_tokenizer.encode(
+            wrap_with_system_tags("You enjoy having a good conversation."))
+        self.embedding_jobs: OrderedDict[str, EmbeddingJob] = OrderedDict()
+        # Connected chat sessions by id, for the profiler captures. None disables `/api/profile`.
+        self.profile_dir = profile_dir
+        self.chat_sessions: dict[str, ChatSession] = {}
+        self._embedding_queue: asyncio.Queue[EmbeddingJob] = asyncio.Queue()
     
     def warmup(self):
-        for _ in range(4):
-            chunk = torch.zeros(1, 1, self.frame_size, dtype=torch.float32, device=self.device)
-            codes = self.mimi.encode(chunk)
-            for c in range(codes.shape[-1]):
-                tokens = self.lm_gen.step(codes[:, :, c: c + 1])
-                if tokens is None:
-                    continue
-                _ = self.mimi.decode(tokens[:, 1:9])
-
-        if self.device.type == 'cuda':
-            torch.cuda.synchronize()
+        self.engine.warmup()
 
 
     async def handle_chat(self, request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        clog = ColorizedLog.randomize()
+        connect_time = time.monotonic()
+        # Shared by the log prefix and the metrics labels of the session.
+        session_id = random_id()
+        clog = ColorizedLog.randomize(session_id)
         peer = request.remote  # IP
         peer_port = request.transport.get_extra_info("peername")[1]  # Port
         clog.log("info", f"Incoming connection from {peer}:{peer_port}")
 
         # Load all conversation params from the personality JSON file
         personality_id = request.query.get("personality_id", "")
+        # Opt-in, for the load generator: before the audio of each frame, a 0x07 message gives the
+        # index of the input frame it answers, or -1 if the input was late.
+        send_frame_index = request.query.get("frame_index", "") == "1"
         if not personality_id:
             clog.log("error", "No personality_id provided, closing connection")
             await ws.close(message=b"personality_id is required")
             return ws
 
-        personalities_dir = Path.cwd() / "Personalities"
-        personality_file = self._find_personality_file(personalities_dir, personality_id)
-        if not personality_file or not personality_file.exists():
+        personality = await run_file_io(self.personality_index.get, personality_id)
+        if personality is None:
             clog.log("error", f"Personality file not found for id {personality_id}")
             await ws.close(message=b"Personality not found")
             return ws
-
-        personality_data = json.loads(personality_file.read_text(encoding="utf-8"))
-
-        # Voice embedding: load from inline embeddingData stored in the personality
-        embedding_data_b64 = personality_data.get("embeddingData", "")
-        cache_key = f"personality:{personality_id}"
-
-        if embedding_data_b64:
-            if self.lm_gen.voice_prompt != cache_key:
-                self.lm_gen.load_voice_prompt_embeddings_from_data(embedding_data_b64, cache_key)
-                logger.info(f"Loaded inline embedding for personality {personality_id}")
+        personality_data = personality.metadata
+
+        # Everything the system prompts depend on is in the personality file, so the state
+        # after the system prompts can be reused for as long as the file does not change.
+        # Loading the voice embedding reads its file on a cache miss.
+        session = await run_file_io(partial(personality_session, personality_data, self.text_tokenizer, self.device,
+                                            prompt_key=personality.sha256,
+                                            embedding_store=self.embedding_store,
+                                            embedding_cache=self.embedding_cache,
+                                            text_tokens=personality.text_prompt_tokens))
+        metrics = self.engine.metrics
+        session.metrics = metrics.open_session(session_id, personality=personality_id)
+        self.chat_sessions[session_id] = session
+        if session.voice_prompt_embeddings is not None:
+            logger.info(f"Loaded embedding for personality {personality_id}")
         else:
-            clog.log("warning", f"Personality {personality_id} has no embeddingData")
-
-        # Text prompt
+            clog.log("warning", f"Personality {personality_id} has no voice embedding")
         text_prompt = personality_data.get("description", "")
-        additional_text = personality_data.get("additionalText", "")
-        if text_prompt:
-            tokens = self.text_tokenizer.encode(wrap_with_system_tags(text_prompt))
-            if additional_text:
-                tokens = tokens + self.text_tokenizer.encode(additional_text)
-            self.lm_gen.text_prompt_tokens = tokens
-        else:
-            self.lm_gen.text_prompt_tokens = None
-
-        # Sampling params
-        self.lm_gen.temp_text = float(personality_data.get("textTemperature", 0.7))
-        self.lm_gen.top_k_text = max(1, int(personality_data.get("textTopk", 25)))
-        self.lm_gen.temp = float(personality_data.get("audioTemperature", 0.8))
-        self.lm_gen.top_k = max(1, int(personality_data.get("audioTopk", 250)))
-
-        # Seed
-        seed_value = personality_data.get("seed", -1)
-        seed = int(seed_value) if seed_value is not None else None
 
         async def recv_loop():
+            # Single reader of the websocket, started before the system prompts so that
+            # a disconnect is noticed right away, and cancels the pending system prompts.
             nonlocal close
             try:
                 async for message in ws:
@@ -204,99 +258,106 @@ class ServerState:
                         continue
                     kind = message[0]
                     if kind == 1:  # audio
+                        if not streaming:
+                            # Sent before the handshake, there is no session to feed yet.
+                            continue
                         payload = message[1:]
-                        opus_reader.append_bytes(payload)
+                        # Waits when the decoder lags behind, so that the buffering stays bounded.
+                        await opus_in.put(payload)
                     else:
                         clog.log("warning", f"unknown message kind {kind}")
             finally:
                 close = True
+                self.engine.leave(session)
                 clog.log("info", "connection closed")
 
         async def opus_loop():
-            all_pcm_data = None
-
             while True:
-                if close:
-                    return
-                await asyncio.sleep(0.001)
+                payload = await opus_in.get()
+                begin = time.perf_counter()
+                opus_reader.append_bytes(payload)
                 pcm = opus_reader.read_pcm()
+                metrics.observe("opus_decode", time.perf_counter() - begin, session.metrics)
                 if pcm.shape[-1] == 0:
                     continue
-                if all_pcm_data is None:
-                    all_pcm_data = pcm
-                else:
-                    all_pcm_data = np.concatenate((all_pcm_data, pcm))
-                while all_pcm_data.shape[-1] >= self.frame_size:
-                    chunk = all_pcm_data[: self.frame_size]
-                    all_pcm_data = all_pcm_data[self.frame_size:]
-                    chunk = torch.from_numpy(chunk)
-                    chunk = chunk.to(device=self.device)[None, None]
-                    codes = self.mimi.encode(chunk)
-                    for c in range(codes.shape[-1]):
-                        tokens = self.lm_gen.step(codes[:, :, c: c + 1])
-                        if tokens is None:
-                            continue
-                        assert tokens.shape[1] == self.lm_gen.lm_model.dep_q + 1
-                        main_pcm = self.mimi.decode(tokens[:, 1:9])
-                        main_pcm = main_pcm.cpu()
-                        opus_writer.append_pcm(main_pcm[0, 0].numpy())
-                        text_token = tokens[0, 0, 0].item()
-                        # 0 = EPAD (end-of-padding), 3 = PAD — skip non-content tokens
-                        if text_token not in (0, 3):
-                            _text = self.text_tokenizer.id_to_piece(text_token)  # type: ignore
-                            _text = _text.replace("▁", " ")
-                            msg = b"\x02" + bytes(_text, encoding="utf8")
-                            await ws.send_bytes(msg)
-        async def send_loop():
+                # Buffered by the session ring buffer, until the engine steps a full frame.
+                self.engine.push_pcm(session, pcm)
+
+        async def output_loop():
             while True:
-                if close:
+                out = await session.outputs.get()
+                if out is None:
+                    clog.log("error", f"session dropped by the inference engine: {session.error}")
                     return
-                await asyncio.sleep(0.001)
+                main_pcm, text_token, input_index = out
+                if send_frame_index:
+                    # Queued before the audio of the frame, which the Opus writer may hold back.
+                    await opus_out.put(b"\x07" + str(-1 if input_index is None else input_index).encode())
+                begin = time.perf_counter()
+                opus_writer.append_pcm(main_pcm)
                 msg = opus_writer.read_bytes()
+                metrics.observe("opus_encode", time.perf_counter() - begin, session.metrics)
                 if len(msg) > 0:
-                    await ws.send_bytes(b"\x01" + msg)
+                    await opus_out.put(b"\x01" + msg)
+                # 0 = EPAD (end-of-padding), 3 = PAD — skip non-content tokens
+                if text_token not in (0, 3):
+                    _text = self.text_tokenizer.id_to_piece(text_token)  # type: ignore
+                    _text = _text.replace("▁", " ")
+                    msg = b"\x02" + bytes(_text, encoding="utf8")
+                    await ws.send_bytes(msg)
+
+        async def send_loop():
+            while True:
+                msg = await opus_out.get()
+                begin = time.perf_counter()
+                await ws.send_bytes(msg)
+                metrics.observe("ws_send", time.perf_counter() - begin, session.metrics)
 
         clog.log("info", "accepted connection")
         clog.log("info", f"personality: {personality_data.get('name', personality_id)}")
         if text_prompt:
             clog.log("info", f"text prompt: {text_prompt}")
-        if embedding_data_b64:
-            clog.log("info", f"voice embedding: loaded from personality file")
+        if session.voice_prompt_embeddings is not None:
+            clog.log("info", f"voice embedding: {personality_data.get('embeddingHash') or 'inline'}")
         close = False
-        async with self.lock:
-            if seed is not None and seed != -1:
-                seed_all(seed)
-
-            opus_writer = sphn.OpusStreamWriter(self.mimi.sample_rate)
-            opus_reader = sphn.OpusStreamReader(self.mimi.sample_rate)
-            self.mimi.reset_streaming()
-            self.lm_gen.reset_streaming()
-            async def is_alive():
-                if close or ws.closed:
-                    return False
-                try:
-                    # Check for disconnect without waiting too long
-                    msg = await asyncio.wait_for(ws.receive(), timeout=0.01)
-                    if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-                        return False
-                except asyncio.TimeoutError:
-                    # No messages → client probably still alive
-                    return True
-                except aiohttp.ClientConnectionError:
-                    return False
-                return True
-            # Reuse mimi for encoding voice prompt and then reset it before conversation starts
-            await self.lm_gen.step_system_prompts_async(self.mimi, is_alive=is_alive)
-            self.mimi.reset_streaming()
+        streaming = False
+        opus_writer = sphn.OpusStreamWriter(self.mimi.sample_rate)
+        opus_reader = sphn.OpusStreamReader(self.mimi.sample_rate)
+        # The stages of the audio pipeline wake each other up through bounded queues:
+        # recv_loop -> opus_loop (decoding) -> engine (inference) -> output_loop (encoding) -> send_loop.
+        opus_in: asyncio.Queue[bytes] = asyncio.Queue(maxsize=64)
+        opus_out: asyncio.Queue[bytes] = asyncio.Queue(maxsize=64)
+        session.metrics.gauges.update({
+            "opus_in_queue": opus_in.qsize,
+            "input_backlog_frames": lambda: session.frames.num_frames if session.frames is not None else 0,
+            "dropped_input_frames": lambda: session.frames.dropped if session.frames is not None else 0,
+            "output_queue": session.outputs.qsize,
+            "opus_out_queue": opus_out.qsize,
+        })
+        def is_alive():
+            # Maintained by recv_loop, cheap enough to be checked before each prompt chunk.
+            return not close and not ws.closed
+        session.is_alive = is_alive
+        reader = asyncio.create_task(recv_loop())
+        try:
+            # The engine runs the system prompts, then streams the session in a free slot.
+            joined = await self.engine.join(session)
             clog.log("info", "done with system prompts")
+            if not joined and session.error is not None:
+                clog.log("warning", session.error)
+                await ws.close(message=session.error.encode("utf-8"))
             # Send the handshake.
-            if await is_alive():
+            if joined and is_alive():
+                streaming = True
                 await ws.send_bytes(b"\x00")
-                clog.log("info", "sent handshake bytes")
+                handshake_seconds = time.monotonic() - connect_time
+                metrics.observe_handshake(handshake_seconds, session.metrics)
+                clog.log("info", f"sent handshake bytes, {handshake_seconds:.2f}s after connecting")
                 # Clean cancellation manager
                 tasks = [
-                    asyncio.create_task(recv_loop()),
+                    reader,
                     asyncio.create_task(opus_loop()),
+                    asyncio.create_task(output_loop()),
                     asyncio.create_task(send_loop()),
                 ]
 
@@ -310,26 +371,46 @@ class ServerState:
                         pass
                 await ws.close()
                 clog.log("info", "session closed")
+        finally:
+            self.engine.leave(session)
+            metrics.close_session(session.metrics)
+            self.chat_sessions.pop(session_id, None)
+            if not reader.done():
+                reader.cancel()
         clog.log("info", "done with connection")
         return ws
 
-    @staticmethod
-    def _personality_filename(name: str, pid: str) -> str:
-        """Build a filename like 'MyPersonality_abc123.json' from name + id."""
-        safe_name = "".join(c if c.isalnum() or c in (" ", "-", "_") else "" for c in name).strip().replace(" ", "_")
-        return f"{safe_name}_{pid}.json" if safe_name else f"{pid}.json"
-
-    @staticmethod
-    def _find_personality_file(personalities_dir: Path, pid: str) -> Path | None:
-        """Find a personality JSON by its id, regardless of the name prefix."""
-        for f in personalities_dir.glob(f"*_{pid}.json"):
-            return f
-        # Fallback: old format without name prefix
-        old = personalities_dir / f"{pid}.json"
-        return old if old.exists() else None
+    async def handle_metrics(self, request):
+        """Latency metrics of the sessions and of the inference engine, in the Prometheus text format."""
+        return web.Response(body=self.engine.metrics.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def handle_profile(self, request):
+        """Profile the next frames of a streaming session, given by the id in its logs and metrics.
+
+        Expects `{"session": <id>, "frames": <n>}`, and returns the paths of the Chrome trace
+        and of the key averages table once the capture is written."""
+        if self.profile_dir is None:
+            return web.json_response({"error": "profiling is disabled, start the server with --profile-dir"},
+                                     status=403)
+        data = await request.json()
+        session = self.chat_sessions.get(data.get("session", ""))
+        if session is None or not session.active:
+            return web.json_response({"error": "no streaming session with this id"}, status=404)
+        frames = int(data.get("frames", 50))
+        if not 1 <= frames <= 2500:
+            return web.json_response({"error": "frames must be between 1 and 2500"}, status=400)
+        prefix = Path(self.profile_dir) / f"{data['session']}_{time.strftime('%Y%m%d-%H%M%S')}"
+        try:
+            trace_path, table_path = await self.engine.profile(session, frames, prefix)
+        except RuntimeError as e:
+            return web.json_response({"error": str(e)}, status=409)
+        return web.json_response({"trace": str(trace_path), "table": str(table_path)})
 
     async def handle_generate_embedding(self, request):
-        """Accept an uploaded audio file, generate voice prompt embeddings, and save as .pt."""
+        """Accept an uploaded audio file, and queue the generation of its voice prompt embeddings as a .pt.
+
+        Returns the id of the job, whose progress is given by `handle_embedding_job`."""
         try:
             reader = await request.multipart()
 
@@ -353,88 +434,129 @@ class ServerState:
                 return web.json_response({"error": "no voice prompt directory configured"}, status=500)
 
             audio_path = os.path.join(self.voice_prompt_dir, f"{embedding_name}.wav")
-            with open(audio_path, "wb") as f:
-                f.write(audio_data)
-
-            # Enable embedding saving, load the audio, and step through prompts to generate .pt
-            prev_save = self.lm_gen.save_voice_prompt_embeddings
-            prev_text_tokens = self.lm_gen.text_prompt_tokens
-            self.lm_gen.save_voice_prompt_embeddings = True
-            self.lm_gen.text_prompt_tokens = self.text_tokenizer.encode(
-                wrap_with_system_tags("You enjoy having a good conversation.")
-            )
-            self.mimi.reset_streaming()
-            self.lm_gen.reset_streaming()
-            self.lm_gen.load_voice_prompt(audio_path)
-            self.lm_gen.step_system_prompts(self.mimi)
-            self.mimi.reset_streaming()
-            self.lm_gen.reset_streaming()
-            self.lm_gen.save_voice_prompt_embeddings = prev_save
-            self.lm_gen.text_prompt_tokens = prev_text_tokens
-
-            # Re-enter streaming mode for normal operation
-            self.mimi.streaming_forever(1)
-            self.lm_gen.streaming_forever(1)
+            await run_file_io(write_atomic, Path(audio_path), audio_data)
 
-            pt_path = os.path.splitext(audio_path)[0] + ".pt"
-            if not os.path.exists(pt_path):
-                return web.json_response({"error": "embedding file was not created"}, status=500)
-
-            # Remove the temporary .wav file now that the .pt embedding exists
-            if os.path.exists(audio_path):
-                os.unlink(audio_path)
-
-            return web.json_response({"status": "ok", "embedding": f"{embedding_name}.pt"})
+            job = EmbeddingJob(id=secrets.token_hex(8), name=embedding_name, audio_path=audio_path)
+            self.embedding_jobs[job.id] = job
+            self._embedding_queue.put_nowait(job)
+            logger.info(f"Queued embedding job {job.id} for {embedding_name}")
+            return web.json_response(job.to_json(), status=202)
         except Exception as e:
             logger.error(f"Error generating embedding: {e}")
             return web.json_response({"error": str(e)}, status=500)
 
-    async def handle_test_embedding(self, request):
-        """Load a voice embedding, run inference with a text prompt, and return generated WAV audio."""
+    async def handle_embedding_job(self, request):
+        """Status and progress of an embedding job."""
+        job = self.embedding_jobs.get(request.match_info["id"])
+        if job is None:
+            return web.json_response({"error": "unknown embedding job"}, status=404)
+        return web.json_response(job.to_json())
+
+    async def run_embedding_jobs(self):
+        """Run the queued embedding jobs, to run as a task next to the engine.
+
+        The clips of all the pending jobs are encoded with Mimi as one batch, then the LM
+        runs the jobs one at a time."""
+        while True:
+            jobs = [await self._embedding_queue.get()]
+            while not self._embedding_queue.empty():
+                jobs.append(self._embedding_queue.get_nowait())
+            audios = await asyncio.gather(
+                *(run_file_io(load_voice_prompt_audio, job.audio_path, self.mimi.sample_rate) for job in jobs),
+                return_exceptions=True)
+            loaded = []
+            for job, audio in zip(jobs, audios):
+                if isinstance(audio, Exception):
+                    self._fail_embedding_job(job, audio)
+                else:
+                    loaded.append((job, audio))
+            if loaded:
+                try:
+                    # Mimi runs in its own streaming state, the chat sessions are left untouched.
+                    all_codes = await self.engine.worker.run(
+                        encode_voice_prompts, self.mimi, [audio for _, audio in loaded], self.frame_size)
+                except Exception as e:
+                    for job, _ in loaded:
+                        self._fail_embedding_job(job, e)
+                    loaded = []
+                    all_codes = []
+                for (job, audio), codes in zip(loaded, all_codes):
+                    await self._run_embedding_job(job, audio, codes)
+            self._prune_embedding_jobs()
+
+    def _fail_embedding_job(self, job: EmbeddingJob, error: Exception):
+        logger.error(f"Error generating embedding: {error}")
+        job.status = "error"
+        job.error = str(error)
+
+    async def _run_embedding_job(self, job: EmbeddingJob, audio: np.ndarray, codes: torch.Tensor):
+        job.status = "running"
+        try:
+            def _progress(value: float):
+                job.progress = value
+            # Runs a step at a time on the inference worker in batch size 1 states,
+            # so that the chat sessions keep streaming and are left untouched.
+            embeddings, cache = await self.engine.run_single_stream_core(
+                self._generate_embedding_core(job.audio_path, audio, codes), _progress)
+            pt_path = os.path.splitext(job.audio_path)[0] + ".pt"
+            await run_file_io(_save_embedding, job.audio_path, pt_path, embeddings, cache)
+            job.embedding = os.path.basename(pt_path)
+            job.progress = 1.
+            job.status = "done"
+            logger.info(f"Embedding job {job.id} done: {job.embedding}")
+        except Exception as e:
+            self._fail_embedding_job(job, e)
+
+    def _prune_embedding_jobs(self):
+        finished = [job_id for job_id, job in self.embedding_jobs.items() if job.status in ("done", "error")]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.embedding_jobs[job_id]
+
+    def _generate_embedding_core(self, audio_path: str, audio: np.ndarray, codes: torch.Tensor) -> Iterator[float]:
+        """Generates the embeddings of `audio_path`, yielding the progress between steps,
+        and returns the `(embeddings, cache)` to save with `save_voice_prompt_state`.
+
+        Only the voice prompt is run, the embeddings and cache do not depend on the rest
+        of the system prompts."""
+        self.lm_gen.reset_streaming()
+        self.lm_gen.load_voice_prompt(audio_path, audio, codes)
+        core = self.lm_gen.extract_voice_prompt_state_core(self.mimi)
+        while True:
+            try:
+                steps = next(core)
+            except StopIteration as e:
+                embeddings, cache = e.value
+                break
+            # The offset is already past all the steps here, only the prefill tells what was run.
+            yield min(1., steps / codes.shape[-1])
+        return embeddings, cache
+
+    def _test_embedding_core(self, pt_path: str, text_tokens: list[int]) -> Iterator[Optional[np.ndarray]]:
+        """Generation of `handle_test_embedding`, yields each generated frame of PCM, or None
+        while the system prompts run so that the chat sessions can step in between."""
+        # Save and override state
+        prev_text_tokens = self.lm_gen.text_prompt_tokens
+        self.lm_gen.text_prompt_tokens = text_tokens
         try:
-            data = await request.json()
-            embedding_name = data.get("name", "").strip()
-            test_text = data.get("text", "").strip()
-
-            if not embedding_name:
-                return web.json_response({"error": "missing embedding name"}, status=400)
-
-            if self.voice_prompt_dir is None:
-                return web.json_response({"error": "no voice prompt directory configured"}, status=500)
-
-            pt_path = os.path.join(self.voice_prompt_dir, f"{embedding_name}.pt")
-            if not os.path.exists(pt_path):
-                return web.json_response({"error": f"embedding '{embedding_name}.pt' not found"}, status=404)
-
-            # Save and override state
-            prev_text_tokens = self.lm_gen.text_prompt_tokens
-            if test_text:
-                self.lm_gen.text_prompt_tokens = self.text_tokenizer.encode(
-                    wrap_with_system_tags(test_text)
-                )
-            elif self.lm_gen.text_prompt_tokens is None:
-                self.lm_gen.text_prompt_tokens = self.text_tokenizer.encode(
-                    wrap_with_system_tags("You enjoy having a good conversation.")
-                )
-
             # Load embedding and step system prompts
             self.mimi.reset_streaming()
             self.lm_gen.reset_streaming()
             self.lm_gen.load_voice_prompt_embeddings(pt_path)
-            self.lm_gen.step_system_prompts(self.mimi)
+            # None marks the prompt steps, whatever the phases yield.
+            for _ in self.lm_gen.step_system_prompts_core(self.mimi):
+                yield None
             self.mimi.reset_streaming()
 
             # Collect text tokens to feed during generation so the model speaks the text
-            gen_text_tokens = list(self.lm_gen.text_prompt_tokens) if self.lm_gen.text_prompt_tokens else []
+            gen_text_tokens = list(text_tokens)
             text_idx = 0
 
-            # Generate audio frames by feeding silence input and text tokens
+            # Generate audio frames by feeding silence input and text tokens. The silence is
+            # encoded like any user input, so the codes follow the streaming state of the encoder.
+            silence = torch.zeros(1, 1, self.frame_size, device=self.device)
             num_steps = int(self.mimi.frame_rate * 5)  # 5 seconds of output
-            generated_pcm = []
             for _ in range(num_steps):
-                codes = self.mimi.encode(
-                    torch.zeros(1, 1, self.frame_size, device=self.device)
-                )
+                codes = self.mimi.encode(silence)
                 for c in range(codes.shape[-1]):
                     # Feed text tokens one at a time to guide speech generation
                     tt = gen_text_tokens[text_idx] if text_idx < len(gen_text_tokens) else None
@@ -444,47 +566,93 @@ class ServerState:
                     if tokens is None:
                         continue
                     pcm = self.mimi.decode(tokens[:, 1:9])
-                    generated_pcm.append(pcm[0, 0].cpu().numpy())
-
-            # Restore state and re-enter streaming
+                    yield pcm[0, 0].cpu().numpy()
+        finally:
+            # Restore state
             self.lm_gen.text_prompt_tokens = prev_text_tokens
-            self.mimi.reset_streaming()
-            self.lm_gen.reset_streaming()
-            self.mimi.streaming_forever(1)
-            self.lm_gen.streaming_forever(1)
-
-            if not generated_pcm:
-                return web.json_response({"error": "no audio generated"}, status=500)
-
-            # Concatenate and write WAV to bytes
-            import tempfile
-            audio_data = np.concatenate(generated_pcm, axis=-1)
-            tmp = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-            tmp_path = tmp.name
-            tmp.close()
-            try:
-                sphn.write_wav(tmp_path, audio_data, self.mimi.sample_rate)
-                with open(tmp_path, "rb") as f:
-                    wav_bytes = f.read()
-            finally:
-                os.unlink(tmp_path)
 
-            return web.Response(
-                body=wav_bytes,
-                content_type="audio/wav",
-            )
+    async def handle_test_embedding(self, request):
+        """Load a voice embedding, run inference with a text prompt, and stream the generated audio.
+
+        The response is a WAV of unknown length, written a frame at a time as soon as it is decoded,
+        so playback can start after the first frames. Frames are generated as fast as possible."""
+        try:
+            data = await request.json()
+            embedding_name = data.get("name", "").strip()
+            test_text = data.get("text", "").strip()
+
+            if not embedding_name:
+                return web.json_response({"error": "missing embedding name"}, status=400)
+
+            if self.voice_prompt_dir is None:
+                return web.json_response({"error": "no voice prompt directory configured"}, status=500)
+
+            pt_path = os.path.join(self.voice_prompt_dir, f"{embedding_name}.pt")
+            if not await run_file_io(os.path.exists, pt_path):
+                return web.json_response({"error": f"embedding '{embedding_name}.pt' not found"}, status=404)
         except Exception as e:
             logger.error(f"Error testing embedding: {e}")
-            # Attempt to restore streaming on error
-            try:
-                self.mimi.reset_streaming()
-                self.lm_gen.reset_streaming()
-                self.mimi.streaming_forever(1)
-                self.lm_gen.streaming_forever(1)
-            except Exception:
-                pass
             return web.json_response({"error": str(e)}, status=500)
 
+        # Never the prompt left in `lm_gen` by the last chat session, which belongs to someone else.
+        personality = None
+        if not test_text and data.get("personality_id"):
+            personality = await run_file_io(self.personality_index.get, data["personality_id"])
+        if test_text:
+            text_tokens = self.text_tokenizer.encode(wrap_with_system_tags(test_text))
+        elif personality is not None and personality.text_prompt_tokens is not None:
+            text_tokens = personality.text_prompt_tokens
+        else:
+            text_tokens = self.default_prompt_tokens
+
+        response = web.StreamResponse(headers={"Content-Type": "audio/wav", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        await response.write(_streaming_wav_header(self.mimi.sample_rate))
+        frames: asyncio.Queue[Optional[np.ndarray]] = asyncio.Queue()
+
+        async def _write():
+            while (pcm := await frames.get()) is not None:
+                await response.write(_pcm16_bytes(pcm))
+
+        writer = asyncio.create_task(_write())
+
+        def _on_frame(pcm: Optional[np.ndarray]):
+            if writer.done():
+                # The client went away, raising stops the generation.
+                raise ConnectionResetError("test embedding response closed")
+            if pcm is not None:
+                frames.put_nowait(pcm)
+
+        try:
+            # Runs on the inference worker a step at a time in batch size 1 states,
+            # so that the chat sessions are left untouched and keep streaming.
+            await self.engine.run_single_stream_core(self._test_embedding_core(pt_path, text_tokens), _on_frame)
+        except Exception as e:
+            # The headers are sent, all that can be done is to end the audio early.
+            logger.error(f"Error testing embedding: {e}")
+        finally:
+            frames.put_nowait(None)
+            try:
+                await writer
+            except ConnectionError:
+                return response
+        await response.write_eof()
+        return response
+
+def _streaming_wav_header(sample_rate: int) -> bytes:
+    """Header of a mono 16 bits PCM WAV whose length is not known yet, as for a live stream."""
+    unknown = 0xFFFFFFFF
+    return (b"RIFF" + unknown.to_bytes(4, "little") + b"WAVE"
+            + b"fmt " + (16).to_bytes(4, "little") + (1).to_bytes(2, "little") + (1).to_bytes(2, "little")
+            + sample_rate.to_bytes(4, "little") + (2 * sample_rate).to_bytes(4, "little")
+            + (2).to_bytes(2, "little") + (16).to_bytes(2, "little")
+            + b"data" + unknown.to_bytes(4, "little"))
+
+
+def _pcm16_bytes(pcm: np.ndarray) -> bytes:
+    return (np.clip(pcm, -1., 1.) * 32767).astype("<i2").tobytes()
+
+
 def _get_voice_prompt_dir(voice_prompt_dir: Optional[str], hf_repo: str) -> Optional[str]:
     """
     If voice_prompt_dir is None:
@@ -580,9 +748,36 @@ def main():
                         help="HF repo to look into, defaults PersonaPlex. "
                              "Use this to select a different pre-trained model.")
     parser.add_argument("--device", type=str, default="cuda", help="Device on which to run, defaults to 'cuda'.")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of chat sessions served concurrently, batched through the same "
+                             "forward passes. Each slot needs its own KV cache, and with more than "
+                             "one slot an extra batch size 1 state is used for the system prompts.")
+    parser.add_argument("--prompt-cache-size", type=int, default=4,
+                        help="Number of personalities for which the state after the system prompts is "
+                             "kept on device, so that reconnecting skips the system prompts. "
+                             "Set to 0 to disable.")
+    parser.add_argument("--prompt-cache-mb", type=int, default=0,
+                        help="Limit on the device memory used by those states, in MB. 0 for no limit.")
+    parser.add_argument("--embedding-cache-mb", type=int, default=256,
+                        help="Size of the voice embeddings of the personalities kept decoded on device, "
+                             "in MB, so that connecting does not load them again. Set to 0 to disable.")
     parser.add_argument("--cpu-offload", action="store_true",
                         help="Offload LM model layers to CPU when GPU memory is insufficient. "
                              "Requires 'accelerate' package.")
+    parser.add_argument("--max-lag", type=float, default=1.,
+                        help="Input backlog of a session, in seconds, above which its oldest input frames "
+                             "are skipped to get back to real time. Set to 0 to never skip frames.")
+    parser.add_argument("--max-real-time-factor", type=float, default=1.,
+                        help="Recent mean step time over the frame period above which new sessions are "
+                             "refused, so that the active ones stay real time. Set to 0 to disable.")
+    parser.add_argument("--silence-bypass-frames", type=int, default=0,
+                        help="Experimental: after that many frames where the input of every session is "
+                             "digital silence, skip the Mimi encoder and feed the constant codes of "
+                             "silence. The encoder state is reset when input resumes, which changes the "
+                             "codes of the following frames. Set to 0 to always run the encoder.")
+    parser.add_argument("--profile-dir", type=str,
+                        help="Enables POST /api/profile, which writes torch.profiler captures of "
+                             "live sessions to this directory.")
     parser.add_argument(
         "--voice-prompt-dir",
         type=str,
@@ -646,78 +841,73 @@ def main():
         "status": "Waiting for model paths...",
         "ready": False,
         "loading": False,    # True while models are being loaded
+        "engine_task": None, # Scheduling loop of the batched engine
+        "embedding_task": None, # Runs the queued embedding jobs
     }
 
     voice_prompt_dir = str(args.voice_prompt_dir)
+    # Voice embeddings of the personalities, moved out of the legacy personality files when indexed.
+    # Not named 'embeddings', which would be the .pt directory on case-insensitive filesystems.
+    embedding_store = EmbeddingStore(Path.cwd() / "Personalities" / "EmbeddingStore")
+    personality_index = PersonalityIndex(Path.cwd() / "Personalities", embedding_store)
     hf_repo = args.hf_repo
     device = args.device
     cpu_offload = args.cpu_offload
+    batch_size = args.batch_size
+    prompt_cache_size = args.prompt_cache_size
+    prompt_cache_bytes = (args.prompt_cache_mb << 20) or None
+    embedding_cache_size = args.embedding_cache_mb << 20
+    profile_dir = args.profile_dir
+    # 0 disables the load shedding stages.
+    max_lag = args.max_lag or None
+    max_real_time_factor = args.max_real_time_factor or None
+    silence_bypass_frames = args.silence_bypass_frames or None
 
     # --- Standalone handlers for file-based operations (no models needed) ---
 
     async def handle_list_personalities(request):
-        personalities_dir = Path.cwd() / "Personalities"
-        personalities_dir.mkdir(exist_ok=True)
-        personalities = []
-        for f in sorted(personalities_dir.glob("*.json")):
-            try:
-                data = json.loads(f.read_text(encoding="utf-8"))
-                data.pop("embeddingData", None)
-                personalities.append(data)
-            except Exception as e:
-                logger.warning(f"Failed to read personality {f}: {e}")
-        return web.json_response(personalities)
+        return web.json_response(await run_file_io(personality_index.list))
+
+    def _save_personality(data: dict):
+        # Check if embedding changed compared to existing personality
+        embedding_filename = data.get("embedding", "")
+        data.pop("embeddingData", None)
+        # Legacy files with an inline embedding were moved to the store when indexed
+        old_entry = personality_index.get(data["id"])
+        old_data = old_entry.metadata if old_entry is not None else {}
+        old_embedding = old_data.get("embedding", "")
+        old_embedding_hash = old_data.get("embeddingHash", "")
+
+        if embedding_filename != old_embedding or not old_embedding_hash:
+            # Embedding changed or not stored yet — add the .pt file to the store and reference it
+            if embedding_filename and embedding_filename.endswith(".pt") and voice_prompt_dir is not None:
+                pt_path = os.path.join(voice_prompt_dir, embedding_filename)
+                if os.path.exists(pt_path):
+                    data["embeddingHash"] = embedding_store.put_pt(pt_path)
+                    logger.info(f"Stored embedding {pt_path} as {data['embeddingHash']}")
+        else:
+            # Embedding unchanged — preserve existing reference
+            data["embeddingHash"] = old_embedding_hash
+
+        personality_index.save(data)
 
     async def handle_save_personality(request):
-        personalities_dir = Path.cwd() / "Personalities"
-        personalities_dir.mkdir(exist_ok=True)
         try:
             data = await request.json()
             pid = data.get("id")
             if not pid:
                 return web.json_response({"error": "missing id"}, status=400)
-
-            # Check if embedding changed compared to existing personality
-            embedding_filename = data.get("embedding", "")
-            old_file = ServerState._find_personality_file(personalities_dir, pid)
-            old_embedding = ""
-            if old_file and old_file.exists():
-                old_data = json.loads(old_file.read_text(encoding="utf-8"))
-                old_embedding = old_data.get("embedding", "")
-
-            old_embedding_data = old_data.get("embeddingData", "") if old_file and old_file.exists() else ""
-
-            if embedding_filename != old_embedding or not old_embedding_data:
-                # Embedding changed or no existing embeddingData — read the .pt file and inline it
-                if embedding_filename and embedding_filename.endswith(".pt") and voice_prompt_dir is not None:
-                    pt_path = os.path.join(voice_prompt_dir, embedding_filename)
-                    if os.path.exists(pt_path):
-                        with open(pt_path, "rb") as f:
-                            pt_bytes = f.read()
-                        data["embeddingData"] = base64.b64encode(pt_bytes).decode("ascii")
-                        logger.info(f"Inlined embedding data from {pt_path} ({len(pt_bytes)} bytes)")
-            else:
-                # Embedding unchanged — preserve existing embeddingData
-                data["embeddingData"] = old_embedding_data
-
-            new_filename = ServerState._personality_filename(data.get("name", ""), pid)
-            if old_file and old_file.name != new_filename:
-                old_file.unlink()
-            filepath = personalities_dir / new_filename
-            filepath.write_text(json.dumps(data, indent=2), encoding="utf-8")
+            await run_file_io(_save_personality, data)
             return web.json_response({"status": "ok"})
         except Exception as e:
             logger.error(f"Error saving personality: {e}")
             return web.json_response({"error": str(e)}, status=500)
 
     async def handle_delete_personality(request):
-        personalities_dir = Path.cwd() / "Personalities"
         pid = request.match_info.get("id")
         if not pid:
             return web.json_response({"error": "missing id"}, status=400)
-        filepath = ServerState._find_personality_file(personalities_dir, pid)
-        if filepath and filepath.exists():
-            filepath.unlink()
+        if await run_file_io(personality_index.delete, pid):
             return web.json_response({"status": "ok"})
         return web.json_response({"error": "not found"}, status=404)
 
@@ -735,13 +925,16 @@ def main():
     settings_dir.mkdir(exist_ok=True)
     settings_file = settings_dir / "settings.json"
 
+    def _read_settings() -> Optional[dict]:
+        try:
+            return json.loads(settings_file.read_text(encoding="utf-8"))
+        except Exception:
+            return None
+
     async def handle_get_settings(request):
-        if settings_file.exists():
-            try:
-                data = json.loads(settings_file.read_text(encoding="utf-8"))
-                return web.json_response(data)
-            except Exception:
-                pass
+        data = await run_file_io(_read_settings)
+        if data is not None:
+            return web.json_response(data)
         return web.json_response({"moshiWeightsPath": "", "mimiWeightsPath": "", "textEncoderPath": ""})
 
     def _clean_path(p: str) -> str:
@@ -754,7 +947,7 @@ def main():
             for key in ("moshiWeightsPath", "mimiWeightsPath", "textEncoderPath"):
                 if key in data and isinstance(data[key], str):
                     data[key] = _clean_path(data[key])
-            settings_file.write_text(json.dumps(data, indent=2), encoding="utf-8")
+            await run_file_io(write_atomic, settings_file, json.dumps(data, indent=2).encode("utf-8"))
             return web.json_response({"status": "ok"})
         except Exception as e:
             logger.error(f"Error saving settings: {e}")
@@ -784,11 +977,26 @@ def main():
             return web.json_response({"error": "Models are still loading"}, status=503)
         return await loading_state["state"].handle_generate_embedding(request)
 
+    async def handle_embedding_job(request):
+        if not loading_state["ready"]:
+            return web.json_response({"error": "Models are still loading"}, status=503)
+        return await loading_state["state"].handle_embedding_job(request)
+
     async def handle_test_embedding(request):
         if not loading_state["ready"]:
             return web.json_response({"error": "Models are still loading"}, status=503)
         return await loading_state["state"].handle_test_embedding(request)
 
+    async def handle_profile(request):
+        if not loading_state["ready"]:
+            return web.json_response({"error": "Models are still loading"}, status=503)
+        return await loading_state["state"].handle_profile(request)
+
+    async def handle_metrics(request):
+        if not loading_state["ready"]:
+            return web.json_response({"error": "Models are still loading"}, status=503)
+        return await loading_state["state"].handle_metrics(request)
+
     # --- Background model loading task (triggered by POST /api/load-models) ---
 
     async def load_models_task(mimi_path: str, text_encoder_path: str, moshi_path: str):
@@ -820,11 +1028,23 @@ def main():
                     device=device,
                     voice_prompt_dir=voice_prompt_dir,
                     save_voice_prompt_embeddings=False,
+                    batch_size=batch_size,
+                    prompt_cache_size=prompt_cache_size,
+                    prompt_cache_bytes=prompt_cache_bytes,
+                    profile_dir=profile_dir,
+                    max_lag=max_lag,
+                    max_real_time_factor=max_real_time_factor,
+                    silence_bypass_frames=silence_bypass_frames,
+                    embedding_store=embedding_store,
+                    personality_index=personality_index,
+                    embedding_cache_size=embedding_cache_size,
                 )
                 state.warmup()
                 return state
 
             state = await asyncio.to_thread(_load_all)
+            loading_state["engine_task"] = asyncio.create_task(state.engine.run())
+            loading_state["embedding_task"] = asyncio.create_task(state.run_embedding_jobs())
             loading_state["state"] = state
             loading_state["ready"] = True
             loading_state["status"] = "Ready"
@@ -870,7 +1090,10 @@ def main():
     app.router.add_post("/api/personalities", handle_save_personality)
     app.router.add_delete("/api/personalities/{id}", handle_delete_personality)
     app.router.add_post("/api/generate-embedding", handle_generate_embedding)
+    app.router.add_get("/api/generate-embedding/{id}", handle_embedding_job)
     app.router.add_post("/api/test-embedding", handle_test_embedding)
+    app.router.add_get("/api/metrics", handle_metrics)
+    app.router.add_post("/api/profile", handle_profile)
 
     logger.info(f"Registered routes: {[r.resource.canonical for r in app.router.routes()]}")
 
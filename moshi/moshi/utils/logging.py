@@ -68,8 +68,8 @@ class ColorizedLog(object):
         print_log(level, msg, prefix=self.prefix, info_color=self.info_color)
 
     @classmethod
-    def randomize(cls):
-        cid = random_id()
+    def randomize(cls, cid: Optional[str] = None):
+        cid = cid or random_id()
         color = random.choice(["91", "92", "93", "94", "95", "96", "97"])
         prefix = colorize(f"[{cid}] ", color)
         return cls(prefix=prefix, info_color=color)
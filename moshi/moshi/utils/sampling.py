@@ -84,6 +84,26 @@ def sample_top_k(probs: torch.Tensor, k: int) -> torch.Tensor:
     return next_token
 
 
+def sample_top_k_per_row(probs: torch.Tensor, k: torch.Tensor) -> torch.Tensor:
+    """Sample next token from top K values, with a different K for each batch entry.
+
+    Args:
+        probs (torch.Tensor): Input probabilities with token candidates on the last dimension,
+            and the batch on the first one.
+        k (torch.Tensor): LongTensor of shape `[B]` giving the k in "top-k" for each batch entry.
+    Returns:
+        torch.Tensor: Sampled tokens.
+    """
+    # A full sort avoids having to synchronize to know the largest k, which keeps this CUDA Graphable.
+    probs, indices = torch.sort(probs, dim=-1, descending=True)
+    ranks = torch.arange(probs.shape[-1], device=probs.device)
+    keep = ranks < k.view(-1, *([1] * (probs.dim() - 1)))
+    probs = probs * keep
+    next_token = multinomial(probs, num_samples=1)
+    next_token = indices.gather(-1, next_token)
+    return next_token
+
+
 def sample_top_p(probs: torch.Tensor, p: float) -> torch.Tensor:
     """Sample next token from top P probabilities along the last dimension of the input probs tensor.
 
@@ -106,11 +126,17 @@ def sample_top_p(probs: torch.Tensor, p: float) -> torch.Tensor:
 def sample_token(
     logits: torch.Tensor,
     use_sampling: bool = False,
-    temp: float = 1.0,
-    top_k: int = 0,
+    temp: float | torch.Tensor = 1.0,
+    top_k: int | torch.Tensor = 0,
     top_p: float = 0.0,
 ) -> torch.Tensor:
-    """Given logits of shape [*, Card], returns a LongTensor of shape [*]."""
+    """Given logits of shape [*, Card], returns a LongTensor of shape [*].
+
+    `temp` and `top_k` can also be given as tensors of shape `[B]`, with `B` the first
+    dimension of `logits`, when each batch entry uses different sampling parameters.
+    """
+    if isinstance(temp, torch.Tensor) or isinstance(top_k, torch.Tensor):
+        return _sample_token_per_row(logits, use_sampling, temp, top_k)
     # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
     if use_sampling and temp > 0.0:
         probs = torch.softmax(logits / temp, dim=-1)
@@ -126,6 +152,29 @@ def sample_token(
     return next_token[..., 0]
 
 
+def _sample_token_per_row(
+    logits: torch.Tensor,
+    use_sampling: bool,
+    temp: float | torch.Tensor,
+    top_k: int | torch.Tensor,
+) -> torch.Tensor:
+    if not use_sampling:
+        return torch.argmax(logits, dim=-1)
+    B = logits.shape[0]
+    shape = [-1] + [1] * (logits.dim() - 1)
+    if not isinstance(temp, torch.Tensor):
+        temp = torch.full((B,), temp, device=logits.device, dtype=torch.float)
+    if not isinstance(top_k, torch.Tensor):
+        top_k = torch.full((B,), top_k, device=logits.device, dtype=torch.long)
+    # Like for `sample_token`, a non positive k means sampling from the full distribution.
+    top_k = torch.where(top_k > 0, top_k, torch.full_like(top_k, logits.shape[-1]))
+    # Rows with a zero temperature are sampled greedily, the clamp only avoids the zero division.
+    probs = torch.softmax(logits / temp.clamp(min=1e-5).view(shape), dim=-1)
+    next_token = sample_top_k_per_row(probs, top_k)[..., 0]
+    greedy = torch.argmax(logits, dim=-1)
+    return torch.where(temp.view(shape[:-1]) > 0.0, next_token, greedy)
+
+
 if __name__ == "__main__":
     torch.manual_seed(1234)
     device = "cpu"
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+
+import numpy as np
+import torch
+
+from moshi.benchmark import build_models
+from moshi.engine import BatchedEngine, ChatSession, PCMRingBuffer, PromptCache
+from moshi.models import LMGen
+
+
+def _snapshot(num_bytes: int) -> dict:
+    return {"cache": torch.zeros(num_bytes, dtype=torch.uint8), "offset": 3}
+
+
+def test_prompt_cache_evicts_least_recently_used():
+    cache = PromptCache(2)
+    cache.put("a", _snapshot(4))
+    cache.put("b", _snapshot(4))
+    assert cache.get("a") is not None
+    cache.put("c", _snapshot(4))
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_prompt_cache_disabled():
+    cache = PromptCache(0)
+    cache.put("a", _snapshot(4))
+    assert len(cache) == 0
+    assert cache.get("a") is None
+
+
+def test_prompt_cache_byte_budget():
+    cache = PromptCache(8, max_bytes=10)
+    cache.put("a", _snapshot(4))
+    cache.put("b", _snapshot(4))
+    assert cache.size == 8
+    cache.put("c", _snapshot(4))
+    assert cache.get("a") is None
+    assert cache.size == 8
+    # Larger than the whole budget, never cached.
+    cache.put("d", _snapshot(11))
+    assert cache.get("d") is None
+    assert cache.size == 8
+
+
+def test_prompt_cache_replace_entry():
+    cache = PromptCache(2, max_bytes=10)
+    cache.put("a", _snapshot(4))
+    cache.put("a", _snapshot(6))
+    assert len(cache) == 1
+    assert cache.size == 6
+    assert cache.get("a")["cache"].numel() == 6
+
+
+def _ramp(start: int, count: int) -> np.ndarray:
+    return np.arange(start, start + count, dtype=np.float32)
+
+
+def test_ring_buffer_partial_frames():
+    buffer = PCMRingBuffer(frame_size=4, max_frames=3)
+    buffer.write(_ramp(0, 3))
+    assert buffer.num_frames == 0
+    buffer.write(_ramp(3, 3))
+    assert buffer.num_frames == 1
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(0, 4))
+    assert buffer.num_frames == 0
+    buffer.write(_ramp(6, 2))
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(4, 4))
+
+
+def test_ring_buffer_wrap_around():
+    buffer = PCMRingBuffer(frame_size=4, max_frames=3)
+    buffer.write(_ramp(0, 8))
+    buffer.read_frame()
+    buffer.read_frame()
+    # Written across the end of the storage, read back in order.
+    buffer.write(_ramp(8, 10))
+    assert buffer.num_frames == 2
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(8, 4))
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(12, 4))
+    buffer.write(_ramp(18, 2))
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(16, 4))
+    assert buffer.dropped == 0
+
+
+def test_ring_buffer_overflow_drops_oldest_frames():
+    buffer = PCMRingBuffer(frame_size=4, max_frames=3)
+    buffer.write(_ramp(0, 12))
+    buffer.write(_ramp(12, 4))
+    assert buffer.dropped == 1
+    assert buffer.num_frames == 3
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(4, 4))
+
+
+def test_ring_buffer_write_larger_than_capacity():
+    buffer = PCMRingBuffer(frame_size=4, max_frames=3)
+    buffer.write(_ramp(0, 20))
+    assert buffer.dropped == 2
+    assert buffer.num_frames == 3
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(8, 4))
+
+
+def test_ring_buffer_skip_frames():
+    buffer = PCMRingBuffer(frame_size=4, max_frames=3)
+    buffer.write(_ramp(0, 10))
+    assert buffer.skip_frames(5) == 2
+    assert buffer.num_frames == 0
+    assert buffer.dropped == 0
+    buffer.write(_ramp(10, 2))
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(8, 4))
+
+
+def test_ring_buffer_position_counts_all_removed_frames():
+    buffer = PCMRingBuffer(frame_size=4, max_frames=3)
+    buffer.write(_ramp(0, 12))
+    buffer.read_frame()
+    assert buffer.position == 1
+    buffer.skip_frames(1)
+    assert buffer.position == 2
+    # Overflow drops the oldest frame, so the next read is the frame of index 3.
+    buffer.write(_ramp(12, 12))
+    assert buffer.position == 3
+    np.testing.assert_array_equal(buffer.read_frame(), _ramp(12, 4))
+
+
+def test_session_joining_during_single_stream_gets_ready():
+    torch.manual_seed(0)
+    mimi, lm = build_models(torch.device("cpu"), torch.float32)
+    lm_gen = LMGen(lm, device="cpu", sample_rate=mimi.sample_rate, frame_rate=mimi.frame_rate)
+    engine = BatchedEngine(mimi, lm_gen, 1, "cpu", max_real_time_factor=None)
+    engine.warmup()
+    release = threading.Event()
+
+    async def scenario():
+        runner = asyncio.create_task(engine.run())
+        try:
+            single = asyncio.create_task(engine.run_single_stream(release.wait))
+            while not engine._single_lock.locked():
+                await asyncio.sleep(0.01)
+            session = ChatSession()
+            joined = asyncio.create_task(engine.join(session))
+            await asyncio.sleep(0.1)
+            assert not joined.done()
+            release.set()
+            await single
+            # No other session comes and goes to wake the engine up.
+            assert await asyncio.wait_for(joined, timeout=60)
+            engine.leave(session)
+        finally:
+            release.set()
+            runner.cancel()
+
+    asyncio.run(scenario())
@@ -0,0 +1,80 @@
+import math
+
+from moshi.metrics import Metrics, RollingHistogram, _format_labels, _format_value
+
+
+def test_histogram_counts_and_quantiles():
+    histogram = RollingHistogram(buckets=(0.01, 0.1), window=3)
+    for value in (0.005, 0.01, 0.05, 0.5):
+        histogram.observe(value)
+    # Upper bounds are inclusive, the last bucket is +Inf.
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert math.isclose(histogram.sum, 0.565)
+    # Only the last `window` values are kept for the quantiles.
+    assert list(histogram.recent) == [0.01, 0.05, 0.5]
+    assert histogram.quantile(0.) == 0.01
+    assert histogram.quantile(1.) == 0.5
+    assert math.isclose(histogram.recent_mean(last=2), 0.275)
+
+
+def test_empty_histogram_is_nan():
+    histogram = RollingHistogram()
+    assert math.isnan(histogram.quantile(0.5))
+    assert math.isnan(histogram.recent_mean())
+
+
+def test_format_value():
+    assert _format_value(math.nan) == "NaN"
+    assert _format_value(math.inf) == "+Inf"
+    assert _format_value(-math.inf) == "-Inf"
+    assert _format_value(2) == "2.0"
+
+
+def test_format_labels_escaping():
+    assert _format_labels({}) == ""
+    labels = _format_labels({"a": 'say "hi"', "b": "back\\slash", "c": "two\nlines"})
+    assert labels == '{a="say \\"hi\\"",b="back\\\\slash",c="two\\nlines"}'
+
+
+def test_render_cumulative_buckets():
+    metrics = Metrics(frame_rate=12.5)
+    for value in (0.0001, 0.0001, 0.003, 10.):
+        metrics.observe("lm_main", value)
+    text = metrics.render()
+    lines = text.splitlines()
+    assert '# TYPE moshi_stage_seconds histogram' in lines
+    assert 'moshi_stage_seconds_bucket{stage="lm_main",le="0.0005"} 2.0' in lines
+    assert 'moshi_stage_seconds_bucket{stage="lm_main",le="0.002"} 2.0' in lines
+    assert 'moshi_stage_seconds_bucket{stage="lm_main",le="0.005"} 3.0' in lines
+    assert 'moshi_stage_seconds_bucket{stage="lm_main",le="+Inf"} 4.0' in lines
+    assert 'moshi_stage_seconds_count{stage="lm_main"} 4.0' in lines
+    # No step observed yet.
+    assert 'moshi_real_time_factor NaN' in lines
+    assert text.endswith("\n")
+
+
+def test_render_summary_sum_and_count_are_cumulative():
+    metrics = Metrics(frame_rate=12.5, window=2)
+    for value in (1., 2., 3., 4.):
+        metrics.observe("lm_main", value)
+    lines = metrics.render().splitlines()
+    # Quantiles of the last 2 values only.
+    assert 'moshi_stage_recent_seconds{stage="lm_main",quantile="0.5"} 4.0' in lines
+    assert 'moshi_stage_recent_seconds_sum{stage="lm_main"} 10.0' in lines
+    assert 'moshi_stage_recent_seconds_count{stage="lm_main"} 4.0' in lines
+    assert any(line.startswith("# HELP moshi_stage_recent_seconds ") and "_count cover all the frames" in line
+               for line in lines)
+
+
+def test_render_sessions():
+    metrics = Metrics(frame_rate=12.5)
+    session = metrics.open_session("abc", personality='x"y')
+    metrics.observe("opus_decode", 0.001, session)
+    metrics.count("skipped_input_frames", 3, session)
+    lines = metrics.render().splitlines()
+    assert 'moshi_active_sessions 1.0' in lines
+    assert 'moshi_skipped_input_frames_total 3.0' in lines
+    assert 'moshi_session_skipped_input_frames_total{session="abc",personality="x\\"y"} 3.0' in lines
+    metrics.close_session(session)
+    assert 'moshi_active_sessions 0.0' in metrics.render().splitlines()
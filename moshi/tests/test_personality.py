@@ -0,0 +1,112 @@
+import json
+import os
+
+import pytest
+
+from moshi.personality import EmbeddingStore, PersonalityIndex, personality_filename, write_atomic
+
+
+def _write_personality(directory, pid, name, **fields):
+    path = directory / personality_filename(name, pid)
+    write_atomic(path, json.dumps({"id": pid, "name": name, **fields}).encode("utf-8"))
+    return path
+
+
+def _touch(path, offset_s):
+    # Filesystems with a coarse mtime could miss a change made right after the scan.
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + int(offset_s * 1e9)))
+
+
+@pytest.fixture
+def index(tmp_path):
+    return PersonalityIndex(tmp_path / "personalities", EmbeddingStore(tmp_path / "embeddings"))
+
+
+def test_write_atomic_replaces_file(tmp_path):
+    path = tmp_path / "file.json"
+    write_atomic(path, b"old")
+    write_atomic(path, b"new")
+    assert path.read_bytes() == b"new"
+    assert [p.name for p in tmp_path.iterdir()] == ["file.json"]
+
+
+def test_write_atomic_failure_keeps_original(tmp_path, monkeypatch):
+    path = tmp_path / "file.json"
+    path.write_bytes(b"old")
+
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        write_atomic(path, b"new")
+    assert path.read_bytes() == b"old"
+    assert [p.name for p in tmp_path.iterdir()] == ["file.json"]
+
+
+def test_index_picks_up_new_file(index):
+    assert index.list() == []
+    _write_personality(index.directory, "p1", "Jane", description="Talk about cats.")
+    _touch(index.directory, 1)
+    assert [data["id"] for data in index.list()] == ["p1"]
+    assert index.get("p1").metadata["description"] == "Talk about cats."
+
+
+def test_index_picks_up_modified_file(index):
+    path = _write_personality(index.directory, "p1", "Jane", description="Talk about cats.")
+    _touch(index.directory, 1)
+    assert index.get("p1").metadata["description"] == "Talk about cats."
+    _write_personality(index.directory, "p1", "Jane", description="Talk about dogs.")
+    _touch(path, 1)
+    _touch(index.directory, 2)
+    assert index.get("p1").metadata["description"] == "Talk about dogs."
+    assert index.list()[0]["description"] == "Talk about dogs."
+
+
+def test_index_forgets_deleted_file(index):
+    path = _write_personality(index.directory, "p1", "Jane")
+    _touch(index.directory, 1)
+    assert len(index.list()) == 1
+    path.unlink()
+    _touch(index.directory, 2)
+    assert index.list() == []
+    assert index.get("p1") is None
+
+
+def test_index_save_and_delete(index):
+    entry = index.save({"id": "p1", "name": "Jane", "description": "Talk about cats."})
+    assert entry.path.exists()
+    assert [data["name"] for data in index.list()] == ["Jane"]
+    # Renaming moves the file.
+    renamed = index.save({"id": "p1", "name": "June", "description": "Talk about cats."})
+    assert not entry.path.exists()
+    assert [data["name"] for data in index.list()] == ["June"]
+    assert index.get("p1").path == renamed.path
+    assert index.delete("p1")
+    assert not renamed.path.exists()
+    assert index.list() == []
+    assert not index.delete("p1")
+
+
+def test_index_keeps_only_metadata_and_returns_copies(index):
+    index.save({"id": "p1", "name": "Jane", "description": "Talk about cats.", "scratch": "x" * 1000})
+    data = index.list()[0]
+    assert "scratch" not in data
+    data["name"] = "June"
+    index.get("p1").metadata["name"] = "June"
+    assert index.get("p1").metadata["name"] == "Jane"
+    assert index.list()[0]["name"] == "Jane"
+
+
+def test_index_keeps_personality_with_corrupt_inline_embedding(index):
+    # Base64 of "not a tensor", which fails to load when moved to the store.
+    path = _write_personality(index.directory, "p1", "Jane", embeddingData="bm90IGEgdGVuc29y")
+    content = path.read_bytes()
+    _touch(index.directory, 1)
+    assert [data["id"] for data in index.list()] == ["p1"]
+    assert "embeddingData" not in index.list()[0]
+    assert index.get("p1").metadata["embeddingData"] == "bm90IGEgdGVuc29y"
+    assert path.read_bytes() == content
+    assert index.delete("p1")
+    assert not path.exists()
@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from moshi.modules.streaming import _restore_streaming_state_from_keys
+from moshi.modules.transformer import RingKVCache
+
+
+def _ring_cache(batch_size: int) -> RingKVCache:
+    return RingKVCache(batch_size, num_heads=2, dim_per_head=3, capacity=8, device=torch.device("cpu"),
+                       dtype=torch.float32)
+
+
+def _state_dict(cache: RingKVCache) -> dict:
+    return {f"kv.{key}": value.clone() for key, value in cache.asdict().items()}
+
+
+def test_restore_truncated_kv_cache():
+    saved = _ring_cache(1)
+    saved.complete(torch.randn(1, 2, 5, 3), torch.randn(1, 2, 5, 3))
+    state = _state_dict(saved)
+    assert state["kv.cache"].shape[-2] == 5
+    restored = _ring_cache(1)
+    _restore_streaming_state_from_keys(restored, state, "kv", ["cache", "end_offset"], torch.device("cpu"))
+    assert torch.equal(restored.cache[..., :5, :], saved.cache[..., :5, :])
+    assert torch.equal(restored.end_offset, saved.end_offset)
+    assert not state
+
+
+def test_restore_rejects_other_batch_size():
+    saved = _ring_cache(1)
+    saved.complete(torch.randn(1, 2, 8, 3), torch.randn(1, 2, 8, 3))
+    with pytest.raises(AssertionError):
+        _restore_streaming_state_from_keys(_ring_cache(2), _state_dict(saved), "kv", ["cache", "end_offset"],
+                                           torch.device("cpu"))
@@ -0,0 +1,35 @@
+import numpy as np
+import torch
+
+from moshi.benchmark import _quantizer_kwargs, _seanet_kwargs, _transformer_kwargs
+from moshi.models import loaders
+from moshi.models.lm import _iterate_audio, encode_from_sphn, encode_voice_prompts
+
+
+def _build_mimi():
+    torch.manual_seed(1234)
+    mimi = loaders.build_mimi("cpu", _seanet_kwargs, _quantizer_kwargs, _transformer_kwargs)
+    mimi.set_num_codebooks(8)
+    return mimi
+
+
+def _frame_by_frame(mimi, clip: np.ndarray, frame_size: int) -> torch.Tensor:
+    with mimi.streaming(1):
+        return torch.cat(list(encode_from_sphn(mimi, _iterate_audio(clip, frame_size))), dim=-1)
+
+
+@torch.no_grad()
+def test_encode_voice_prompts_matches_frame_by_frame_past_the_context():
+    mimi = _build_mimi()
+    frame_size = int(mimi.sample_rate / mimi.frame_rate)
+    rng = np.random.default_rng(0)
+    # Longer than the 10 s of the encoder transformer context, and not a whole number of frames.
+    long_clip = 0.1 * rng.standard_normal((1, 11 * mimi.sample_rate + 100)).astype(np.float32)
+    short_clip = 0.1 * rng.standard_normal((1, 3 * mimi.sample_rate)).astype(np.float32)
+    expected = [_frame_by_frame(mimi, clip, frame_size) for clip in (long_clip, short_clip)]
+
+    for chunk_frames in (1, 64):
+        codes = encode_voice_prompts(mimi, [long_clip, short_clip], frame_size, chunk_frames=chunk_frames)
+        for clip_codes, clip_expected in zip(codes, expected):
+            assert clip_codes.shape == clip_expected.shape
+            assert torch.equal(clip_codes, clip_expected)